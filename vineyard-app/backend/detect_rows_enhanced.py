@@ -1,23 +1,443 @@
 
 import os
+import io
+import copy
 import json
+from functools import partial
+from contextlib import redirect_stdout
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 import rasterio
-from rasterio.transform import xy
+from rasterio.enums import MaskFlags
+from rasterio.transform import Affine
 from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.signal import find_peaks, savgol_filter
 from skimage import filters, morphology, measure
 from sklearn.cluster import DBSCAN
-from shapely.geometry import LineString, MultiLineString
+import shapely
+from pyproj import Geod
 from pathlib import Path
+from quantiles import index_percentiles
+from mask_morphology import clean_mask
+
+
+def mask_pyramid(mask, levels):
+    """
+    Coverage pyramid of a boolean mask
+
+    Level k is the mask averaged over 2^k x 2^k blocks (float32, 0-1), so thin
+    rows fade to partial coverage instead of disappearing. Returns levels + 1
+    arrays, full resolution first.
+    """
+    pyramid = [mask.astype(np.float32)]
+    for _ in range(levels):
+        h, w = pyramid[-1].shape
+        if min(h, w) < 2:
+            break
+        pyramid.append(cv2.resize(pyramid[-1], (w // 2, h // 2), interpolation=cv2.INTER_AREA))
+    return pyramid
+
+
+def row_frame(ys, xs, angle):
+    """
+    Pixel coordinates in the frame of rows at angle (degrees, image axes)
+
+    Returns (u, v): u runs along the rows and v across them, so every row has a
+    constant v. The inverse is x = u cos - v sin, y = u sin + v cos.
+    """
+    angle_rad = np.radians(angle)
+    dtype = np.result_type(xs, np.float32).type  # float32 coordinates stay float32
+    cos, sin = dtype(np.cos(angle_rad)), dtype(np.sin(angle_rad))
+    return xs * cos + ys * sin, ys * cos - xs * sin
+
+
+def frame_bounds(shape, angle):
+    """(u_offset, u_length, v_offset, v_length): whole-pixel ranges covering a raster of shape in row_frame"""
+    h, w = shape
+    u, v = row_frame(np.array([0, 0, h - 1, h - 1]), np.array([0, w - 1, 0, w - 1]), angle)
+    u_offset, v_offset = np.floor(u.min()), np.floor(v.min())
+    return u_offset, int(np.ceil(u.max()) - u_offset) + 1, v_offset, int(np.ceil(v.max()) - v_offset) + 1
+
+
+def iter_foreground(mask, block_rows=4096):
+    """Yield (ys, xs) of the True pixels of mask, block_rows image rows at a time"""
+    for top in range(0, mask.shape[0], block_rows):
+        ys, xs = np.nonzero(mask[top:top + block_rows])
+        yield (ys + top).astype(np.float32), xs.astype(np.float32)
+
+
+def projection_profile(ys, xs, angle, offset=None, length=None):
+    """
+    Foreground count along the normal of rows at angle (degrees, image axes)
+
+    Pixel coordinates are projected onto the row normal (v of row_frame) and
+    counted with np.bincount: bin k holds v in [offset + k, offset + k + 1).
+    offset defaults to the lowest projection; pass a fixed offset / length (see
+    frame_bounds) to add up profiles of tiles. Returns (profile, offset).
+    """
+    _, positions = row_frame(ys, xs, angle)
+    if offset is None:
+        offset = np.floor(positions.min())
+    return np.bincount((positions - offset).astype(np.int64), minlength=length or 0), offset
+
+
+def mask_profile(mask, angle):
+    """projection_profile of a whole mask, accumulated block by block; returns (profile, offset)"""
+    _, _, offset, length = frame_bounds(mask.shape, angle)
+    profile = np.zeros(length, dtype=np.int64)
+    for ys, xs in iter_foreground(mask):
+        profile += projection_profile(ys, xs, angle, offset, length)[0]
+    return profile, offset
+
+
+def row_field_extents(field_mask, angle, row_positions, min_pixels=10, max_gap=5):
+    """
+    Along-row extent of the field on every row, without rotating the mask
+
+    row_positions are v coordinates (row_frame). The field pixels of each row's
+    v bin are binned into whole u columns; the columns are split into segments
+    where more than max_gap columns are missing, and the longest segment with
+    more than min_pixels columns is the row's extent (the first one on ties).
+    Runs of every row are found in one pass over the sorted (row, column) keys.
+
+    Returns (rows, u_start, u_end): indices into row_positions of the rows that
+    have an extent, and its first / last u column.
+    """
+    u_offset, u_length, v_offset, v_length = frame_bounds(field_mask.shape, angle)
+    row_bins = (np.floor(np.asarray(row_positions, dtype=float)) - v_offset).astype(np.int64)
+    row_of_bin = np.full(v_length, -1, dtype=np.int64)
+    inside = (row_bins >= 0) & (row_bins < v_length)
+    row_of_bin[row_bins[inside]] = np.flatnonzero(inside)
+
+    # (row, u column) keys of the field pixels that fall on a row
+    keys = []
+    for ys, xs in iter_foreground(field_mask):
+        u, v = row_frame(ys, xs, angle)
+        rows = row_of_bin[(v - v_offset).astype(np.int64)]
+        on_row = rows >= 0
+        keys.append(rows[on_row] * u_length + (u[on_row] - u_offset).astype(np.int64))
+    keys = np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+    rows, columns = np.divmod(keys, u_length)
+
+    # Run-length segments of all rows: a new one starts at every row change or gap
+    starts = np.flatnonzero((np.diff(rows, prepend=-1) != 0) | (np.diff(columns, prepend=-max_gap - 2) > max_gap))
+    ends = np.append(starts[1:], len(rows)) - 1
+    lengths = ends - starts + 1
+    keep = lengths > min_pixels
+    starts, ends, lengths = starts[keep], ends[keep], lengths[keep]
+
+    # Longest segment per row (first on ties)
+    order = np.lexsort((starts, -lengths, rows[starts]))
+    first = order[np.diff(rows[starts][order], prepend=-1) != 0]
+
+    return rows[starts[first]], columns[starts[first]] + u_offset, columns[ends[first]] + u_offset
+
+
+def periodic_strength(profile, min_period, max_period):
+    """Largest spectrum magnitude of profile among periods in [min_period, max_period]; returns (magnitude, period)"""
+    spectrum = np.abs(np.fft.rfft(profile - profile.mean()))
+    freqs = np.fft.rfftfreq(len(profile))
+    band = np.flatnonzero((freqs >= 1 / max_period) & (freqs <= 1 / min_period))
+    if len(band) == 0:
+        return 0.0, None
+    peak = band[np.argmax(spectrum[band])]
+    return float(spectrum[peak]), 1 / freqs[peak]
+
+
+# ================================
+# SHARED ARRAYS
+# ================================
+def _share_array(array):
+    """Copy array into shared memory; returns (shm, spec) for _attach_array"""
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_array(spec):
+    """Attach to an array placed by _share_array; returns (shm, array), keep shm open while using array"""
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# ================================
+# STRIP TRACKING
+# ================================
+_TRACK_WORKER = {}
+
+
+def strip_profiles(mask, angle, strip_px, bounds, top=0, bottom=None):
+    """
+    Projection profiles of consecutive strips along the rows
+
+    Strip k holds the pixels with row_frame u in [u_offset + k strip_px,
+    u_offset + (k + 1) strip_px); its profile counts them per v bin like
+    projection_profile. bounds is frame_bounds(mask.shape, angle). Only image
+    rows [top, bottom) are binned, so blocks of the mask can be added up.
+    Returns an (n_strips, v_length) int64 array.
+    """
+    u_offset, u_length, v_offset, v_length = bounds
+    n_strips = -(-u_length // strip_px)
+    profiles = np.zeros(n_strips * v_length, dtype=np.int64)
+    for ys, xs in iter_foreground(mask[top:bottom]):
+        u, v = row_frame(ys + top, xs, angle)
+        strips = ((u - u_offset) // strip_px).astype(np.int64)
+        profiles += np.bincount(strips * v_length + (v - v_offset).astype(np.int64), minlength=len(profiles))
+    return profiles.reshape(n_strips, v_length)
+
+
+def strip_peaks(profile, period_px, min_prominence, min_coverage):
+    """
+    Row positions (v bins, sub-pixel) in one strip profile
+
+    The profile is filtered with a Gabor kernel (cosine at the row period under
+    a Gaussian of half a period), scaled so a row pattern of coverage contrast
+    c peaks at about c per pixel of strip length. This takes the whole row /
+    inter-row shape into account, so flat canopy tops do not wander. Peaks at
+    least 0.7 periods apart with a prominence of min_prominence and at least
+    min_coverage foreground pixels in their bin (no ringing off the field edge)
+    are kept and refined with a parabola through the peak bin and its
+    neighbours.
+    """
+    t = np.arange(-int(1.5 * period_px), int(1.5 * period_px) + 1)
+    wave = np.cos(2 * np.pi * t / period_px)
+    kernel = np.exp(-0.5 * (t / (0.5 * period_px)) ** 2) * wave
+    kernel -= kernel.mean()
+    kernel /= kernel @ wave
+    band = ndimage.convolve1d(profile.astype(float), kernel, mode='constant')
+    peaks, _ = find_peaks(band, distance=max(1, 0.7 * period_px), prominence=min_prominence)
+    peaks = peaks[(peaks > 0) & (peaks < len(band) - 1)]
+    peaks = peaks[profile[peaks] >= min_coverage]
+
+    left, centre, right = band[peaks - 1], band[peaks], band[peaks + 1]
+    curvature = left - 2 * centre + right
+    shift = np.divide(0.5 * (left - right), curvature, out=np.zeros_like(centre), where=curvature < 0)
+    return peaks + np.clip(shift, -0.5, 0.5)
+
+
+def link_strip_peaks(peaks_per_strip, max_shift, max_missed):
+    """
+    Link the peaks of consecutive strips into tracks
+
+    Every active track predicts its position in the next strip from the slope
+    over its last (up to) four points. A peak and a prediction are linked when
+    each is the other's nearest and they are less than max_shift apart;
+    unlinked peaks start new tracks and tracks without a peak for more than
+    max_missed strips end.
+    Returns a list of (strip indices, positions) arrays, one per track.
+    """
+    tracks = []  # [strips, positions] lists
+    active = []  # indices into tracks
+    for strip, peaks in enumerate(peaks_per_strip):
+        active = [t for t in active if strip - tracks[t][0][-1] <= max_missed + 1]
+
+        linked = np.zeros(len(peaks), dtype=bool)
+        if active and len(peaks):
+            predicted = []
+            for t in active:
+                strips, positions = tracks[t]
+                slope = 0.0
+                if len(strips) > 1:
+                    first = max(0, len(strips) - 4)
+                    slope = (positions[-1] - positions[first]) / (strips[-1] - strips[first])
+                    slope = np.clip(slope, -max_shift, max_shift)
+                predicted.append(positions[-1] + slope * (strip - strips[-1]))
+            predicted = np.array(predicted)
+
+            # Mutual nearest neighbours between the predictions and the peaks
+            nearest_peak = np.abs(peaks[None, :] - predicted[:, None]).argmin(axis=1)
+            nearest_track = np.abs(predicted[None, :] - peaks[:, None]).argmin(axis=1)
+            for i, peak in enumerate(nearest_peak):
+                if nearest_track[peak] == i and abs(peaks[peak] - predicted[i]) < max_shift:
+                    tracks[active[i]][0].append(strip)
+                    tracks[active[i]][1].append(float(peaks[peak]))
+                    linked[peak] = True
+
+        for peak in peaks[~linked]:
+            active.append(len(tracks))
+            tracks.append([[strip], [float(peak)]])
+
+    return [(np.array(strips), np.array(positions)) for strips, positions in tracks]
+
+
+def merge_tracks(tracks, max_shift):
+    """
+    Join tracks that continue each other across a longer run of missed strips
+
+    A track that starts after another one ends, less than max_shift from that
+    one's last position, continues it. Closest pairs are joined first and every
+    track continues / is continued by at most one other.
+    Returns the merged list of (strip indices, positions) arrays.
+    """
+    candidates = sorted(
+        (abs(later[1][0] - earlier[1][-1]), i, j)
+        for i, earlier in enumerate(tracks) for j, later in enumerate(tracks)
+        if later[0][0] > earlier[0][-1] and abs(later[1][0] - earlier[1][-1]) < max_shift
+    )
+    following, preceded = {}, set()
+    for _, i, j in candidates:
+        if i not in following and j not in preceded:
+            following[i] = j
+            preceded.add(j)
+
+    merged = []
+    for i in range(len(tracks)):
+        if i in preceded:
+            continue
+        chain = [i]
+        while chain[-1] in following:
+            chain.append(following[chain[-1]])
+        merged.append((np.concatenate([tracks[t][0] for t in chain]),
+                       np.concatenate([tracks[t][1] for t in chain])))
+    return merged
+
+
+def _init_track_worker(mask_spec, angle, strip_px, bounds):
+    """Process pool initializer: attach to the shared vegetation mask"""
+    shm, mask = _attach_array(mask_spec)
+    _TRACK_WORKER.update(shm=shm, mask=mask, angle=angle, strip_px=strip_px, bounds=bounds)
+
+
+def _strip_profiles_worker(block):
+    state = _TRACK_WORKER
+    return strip_profiles(state['mask'], state['angle'], state['strip_px'], state['bounds'], *block)
+
+
+def spectrum_orientation(coverage, min_period, max_period):
+    """
+    Row angle from the 2-D spectrum of a coverage raster
+
+    Evenly spaced rows concentrate their energy at the frequency normal to them,
+    so the spectrum peak among periods in [min_period, max_period] (pixels)
+    gives the row angle (degrees, image axes) and period. Returns (angle,
+    period, peak / mean magnitude in the band), or None when no frequency of
+    the raster falls in the band.
+    """
+    spectrum = np.abs(np.fft.fft2(coverage - coverage.mean()))
+    fy = np.fft.fftfreq(coverage.shape[0])[:, None]
+    fx = np.fft.fftfreq(coverage.shape[1])[None, :]
+    frequency = np.hypot(fy, fx)
+    band = (frequency >= 1 / max_period) & (frequency <= 1 / min_period)
+    if not band.any():
+        return None
+
+    band_spectrum = np.where(band, spectrum, 0)
+    peak = np.unravel_index(np.argmax(band_spectrum), spectrum.shape)
+    peak_ratio = spectrum[peak] / spectrum[band].mean()
+
+    # The frequency vector is normal to the rows
+    normal = np.degrees(np.arctan2(fy[peak[0], 0], fx[0, peak[1]]))
+    return (normal + 180) % 180 - 90, 1 / frequency[peak], float(peak_ratio)
+
+
+# ================================
+# BLOCK SEGMENTATION
+# ================================
+_BLOCK_WORKER = {}
+
+
+def orientation_regions(angles, max_difference):
+    """
+    Group a grid of tile angles into regions of similar orientation
+
+    angles (degrees, NaN for tiles without one) are linked to their right and
+    lower neighbours when they differ by less than max_difference, modulo 180
+    degrees, so a region may bend slowly. Returns int labels of the grid, -1
+    for NaN tiles, and the number of regions.
+    """
+    valid = ~np.isnan(angles)
+    index = np.arange(angles.size).reshape(angles.shape)
+    edges = []
+    for a, b in ((np.s_[:, :-1], np.s_[:, 1:]), (np.s_[:-1, :], np.s_[1:, :])):
+        difference = np.abs((angles[a] - angles[b] + 90) % 180 - 90)
+        linked = valid[a] & valid[b] & (difference < max_difference)
+        edges.append((index[a][linked], index[b][linked]))
+    rows = np.concatenate([a for a, _ in edges])
+    columns = np.concatenate([b for _, b in edges])
+    graph = coo_matrix((np.ones(len(rows)), (rows, columns)), shape=(angles.size, angles.size))
+    _, labels = connected_components(graph, directed=False)
+
+    # Number the regions of valid tiles only
+    labels = labels.reshape(angles.shape)
+    regions, inverse = np.unique(labels[valid], return_inverse=True)
+    labels[valid] = inverse
+    labels[~valid] = -1
+    return labels, len(regions)
+
+
+def _detect_block_rows(detector, vegetation_mask, block_labels, block):
+    """
+    detector.detect_rows() on one block: a copy of detector sees only the
+    block's bounding box, its vegetation and the block as its data mask
+    """
+    block_id, (rows, columns) = block
+    block_mask = block_labels[rows, columns] == block_id
+    detector = copy.copy(detector)
+    detector.vegetation_mask = vegetation_mask[rows, columns] & block_mask
+    detector.data_mask = block_mask
+    detector.transform = detector.transform * Affine.translation(columns.start, rows.start)
+    detector.row_period_px = None
+    return detector.detect_rows()
+
+
+def _init_block_worker(detector, mask_spec, labels_spec, threads):
+    """Process pool initializer: keep the detector template, attach the shared vegetation mask and block labels"""
+    cv2.setNumThreads(threads)
+    mask_shm, vegetation_mask = _attach_array(mask_spec)
+    labels_shm, block_labels = _attach_array(labels_spec)
+    _BLOCK_WORKER.update(shm=(mask_shm, labels_shm), detector=detector, vegetation_mask=vegetation_mask,
+                         block_labels=block_labels)
+
+
+def _detect_block_rows_worker(block):
+    """_detect_block_rows in a pool worker; returns (result, printed log)"""
+    state = _BLOCK_WORKER
+    log = io.StringIO()
+    with redirect_stdout(log):
+        result = _detect_block_rows(state['detector'], state['vegetation_mask'], state['block_labels'], block)
+    return result, log.getvalue()
 
 
 class VineyardRowDetector:
 
-    def __init__(self, orthophoto_path, output_geojson_path=None):
+    # Pyramid orientation engine (see detect_orientation_pyramid)
+    MIN_ROW_SPACING_M = 1.2  # narrowest row spacing looked for
+    MAX_ROW_SPACING_M = 4.0  # longer periods are field shape, not rows
+    COARSE_PERIOD_PX = 6  # the coarse level keeps MIN_ROW_SPACING_M at least this many pixels wide
+    COARSE_MAX_SIDE = 2048  # the coarse spectrum is taken on at most this many pixels per side
+    REFINE_MAX_PIXELS = 16_000_000  # refinement runs on the finest level at most this large
+    ORIENTATION_WINDOW_DEG = 3.0  # half-width of the refinement angle window
+    MIN_SPECTRUM_PEAK = 12.0  # peak / mean magnitude in the row band below which Hough takes over
+
+    # Strip tracking of curved rows (see track_rows)
+    TRACK_STRIP_M = 2.5  # strip length along the rows
+    TRACK_SMOOTH_STRIPS = 1.0  # Gaussian sigma (in strips) the profiles are averaged with across strips
+    TRACK_MIN_PROMINENCE = 0.05  # row peak prominence as a fraction of the strip length in pixels
+    TRACK_MIN_COVERAGE = 0.25  # vegetation along a row peak, as a fraction of the strip length
+    TRACK_MAX_SHIFT = 0.35  # largest row shift between neighbouring strips, in row periods
+    TRACK_MAX_MISSED = 2  # strips a row may skip (missing vines) before its track ends
+    TRACK_MIN_STRIPS = 3  # shorter tracks are noise
+    TRACK_MIN_LENGTH = 0.5  # merged tracks found in fewer strips than this fraction of the longest are fragments
+
+    # Block segmentation (see segment_blocks)
+    BLOCK_TILE_M = 20.0  # side of the tiles whose local row angle is measured
+    BLOCK_ANGLE_TOLERANCE_DEG = 8.0  # neighbouring tiles closer in angle belong to the same block
+    BLOCK_MIN_TILES = 3  # smaller orientation regions are merged into their neighbours
+    BLOCK_MIN_AREA_M2 = 400.0  # smaller separate field parts are dropped
+
+    def __init__(self, orthophoto_path, output_geojson_path=None, orientation='pyramid', rows='extrapolate',
+                 workers=None, blocks=False):
         self.orthophoto_path = Path(orthophoto_path)
+        self.orientation = orientation  # 'pyramid' or 'hough'
+        self.rows = rows  # 'extrapolate' straight rows or 'track' curved rows
+        self.workers = workers  # strip tracking / block processes, None = all CPU cores
+        self.blocks = blocks  # segment the field into blocks with their own row angle
 
         if output_geojson_path:
             self.output_path = Path(output_geojson_path)
@@ -27,8 +447,10 @@ class VineyardRowDetector:
         self.transform = None
         self.crs = None
         self.image_rgb = None
+        self.data_mask = None
         self.vegetation_mask = None
         self.pixel_size_m = None
+        self.row_period_px = None
 
         print(f"🔧 Vineyard Row Detector - Original Detection + Extrapolation")
         print(f"   Input: {self.orthophoto_path.name}")
@@ -64,6 +486,10 @@ class VineyardRowDetector:
                 gray = src.read(1)
                 self.image_rgb = np.dstack([gray, gray, gray])
 
+            # Alpha band / nodata / internal mask; None when every pixel holds data
+            if not all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums[:3]):
+                self.data_mask = src.dataset_mask() > 0
+
         h, w = self.image_rgb.shape[:2]
         pixel_width = abs(self.transform[0])
         pixel_height = abs(self.transform[4])
@@ -78,12 +504,12 @@ class VineyardRowDetector:
         r, g, b = self.image_rgb[:, :, 0], self.image_rgb[:, :, 1], self.image_rgb[:, :, 2]
         indices = self.calculate_vegetation_indices(r, g, b)
 
-        exg_threshold = np.percentile(indices['exg'], 60)
-        vari_threshold = np.percentile(indices['vari'], 55)
+        thresholds = index_percentiles(indices, {'exg': 60, 'vari': 55}, upper=True)
+        exg_threshold, vari_threshold = thresholds['exg'], thresholds['vari']
 
         vegetation_mask = (indices['exg'] > exg_threshold) | (indices['vari'] > vari_threshold)
         vegetation_mask = morphology.remove_small_objects(vegetation_mask, min_size=50)
-        vegetation_mask = morphology.binary_closing(vegetation_mask, morphology.disk(2))
+        vegetation_mask = clean_mask(vegetation_mask, [('close', 2)])
 
         self.vegetation_mask = vegetation_mask
         coverage = np.sum(vegetation_mask) / vegetation_mask.size * 100
@@ -98,7 +524,7 @@ class VineyardRowDetector:
 
         # Use skeleton for better line detection
         skeleton = morphology.skeletonize(self.vegetation_mask)
-        skeleton_dilated = morphology.binary_dilation(skeleton, morphology.disk(1))
+        skeleton_dilated = clean_mask(skeleton, [('dilate', 1)])
         edges_uint8 = (skeleton_dilated * 255).astype(np.uint8)
 
         # Hough transform
@@ -124,8 +550,7 @@ class VineyardRowDetector:
                 return 0.0
         else:
             angles = []
-            for line in lines:
-                x1, y1, x2, y2 = line[0]
+            for x1, y1, x2, y2 in lines.reshape(-1, 4):
                 angle = np.degrees(np.arctan2(y2 - y1, x2 - x1))
                 if angle > 90:
                     angle -= 180
@@ -148,6 +573,87 @@ class VineyardRowDetector:
         print(f"✅ Orientation: {dominant_angle:.1f}° (from {len(lines)} lines)")
         return float(dominant_angle)
 
+    def detect_orientation(self):
+        """Dominant row angle in degrees with the engine picked by self.orientation"""
+        if self.orientation == 'hough':
+            return self.detect_orientation_original_method()
+        return self.detect_orientation_pyramid()
+
+    def coarse_level(self):
+        """Pyramid level where MIN_ROW_SPACING_M is still COARSE_PERIOD_PX pixels wide"""
+        coarse_factor = self.MIN_ROW_SPACING_M / self.pixel_size_m / self.COARSE_PERIOD_PX
+        return max(0, int(np.floor(np.log2(max(coarse_factor, 1)))))
+
+    def detect_orientation_pyramid(self):
+        """
+        Row angle from a coverage pyramid of the vegetation mask
+
+        The coarse estimate is the peak of the 2-D FFT spectrum of a pyramid level
+        where the narrowest expected rows are still COARSE_PERIOD_PX wide: evenly
+        spaced rows concentrate their energy at the frequency normal to them.
+        It is refined on the finest level with at most REFINE_MAX_PIXELS pixels,
+        only within ORIENTATION_WINDOW_DEG of the coarse angle, by maximizing the
+        periodic energy of the projection profile (projection_profile). Falls back
+        to the Hough method when the spectrum shows no clear row period.
+        """
+        print("\n📐 Detecting orientation (pyramid)...")
+
+        h, w = self.vegetation_mask.shape
+        coarse_level = self.coarse_level()
+        refine_level = max(0, int(np.ceil(np.log2(h * w / self.REFINE_MAX_PIXELS) / 2)))
+        pyramid = mask_pyramid(self.vegetation_mask, max(coarse_level, refine_level))
+        coarse_level = min(coarse_level, len(pyramid) - 1)
+        refine_level = min(refine_level, coarse_level)
+
+        # Coarse: 2-D spectrum peak among the row periods, on a window around the vegetation centroid
+        coverage = pyramid[coarse_level]
+        scale = 2 ** coarse_level
+        ys, xs = np.nonzero(coverage > 0)
+        if len(ys) == 0:
+            print("⚠️  No vegetation, using Hough...")
+            return self.detect_orientation_original_method()
+        side = self.COARSE_MAX_SIDE
+        top = int(np.clip(ys.mean() - side // 2, 0, max(0, coverage.shape[0] - side)))
+        left = int(np.clip(xs.mean() - side // 2, 0, max(0, coverage.shape[1] - side)))
+        coverage = coverage[top:top + side, left:left + side]
+
+        min_period = self.MIN_ROW_SPACING_M / self.pixel_size_m / scale
+        max_period = self.MAX_ROW_SPACING_M / self.pixel_size_m / scale
+        coarse = spectrum_orientation(coverage, min_period, max_period)
+        if coarse is None:
+            print("⚠️  Vegetation mask too small for the row band, using Hough...")
+            return self.detect_orientation_original_method()
+
+        coarse_angle, period, peak_ratio = coarse
+        if peak_ratio < self.MIN_SPECTRUM_PEAK:
+            print(f"⚠️  No clear row period (spectrum peak {peak_ratio:.1f}x), using Hough...")
+            return self.detect_orientation_original_method()
+        period *= scale
+        print(f"   🔭 Level 1/{scale}: {coarse_angle:.1f}°, period {period:.1f} px (peak {peak_ratio:.0f}x)")
+
+        # Refine: projection profile periodicity around the coarse angle, coarse-to-fine steps
+        scale = 2 ** refine_level
+        ys, xs = np.nonzero(pyramid[refine_level] >= 0.5)
+        ys, xs = ys.astype(np.float32), xs.astype(np.float32)
+        del pyramid
+
+        def strength(angle):
+            profile, _ = projection_profile(ys, xs, angle)
+            return periodic_strength(profile, period / scale / 1.3, period / scale * 1.3)
+
+        best = coarse_angle
+        for half_width, step in ((self.ORIENTATION_WINDOW_DEG, 0.5), (0.5, 0.1)):
+            candidates = best + np.arange(-half_width, half_width + step / 2, step)
+            results = [strength(angle) for angle in candidates]
+            best_index = int(np.argmax([magnitude for magnitude, _ in results]))
+            best, refined_period = float(candidates[best_index]), results[best_index][1]
+
+        angle = (best + 90) % 180 - 90
+        self.row_period_px = refined_period * scale if refined_period else period
+        print(f"✅ Orientation: {angle:.1f}° (level 1/{scale}), row period {self.row_period_px:.1f} px "
+              f"({self.row_period_px * self.pixel_size_m:.2f}m)")
+        return angle
+
     def detect_sample_rows_original_method(self, angle):
         """
         Use ORIGINAL projection method that detected rows correctly
@@ -155,20 +661,8 @@ class VineyardRowDetector:
         """
         print(f"\n🔍 Detecting sample rows (original method)...")
 
-        h, w = self.vegetation_mask.shape
-        center = (w // 2, h // 2)
-
-        # Rotate
-        M = cv2.getRotationMatrix2D(center, -angle, 1.0)
-        rotated = cv2.warpAffine(
-            self.vegetation_mask.astype(np.uint8),
-            M,
-            (w, h),
-            flags=cv2.INTER_NEAREST
-        )
-
-        # Vertical projection
-        projection = np.sum(rotated, axis=1)
+        # Projection across the rows (row_frame v), without a rotated copy of the mask
+        projection, offset = mask_profile(self.vegetation_mask, angle)
 
         # ORIGINAL smoothing approach
         window_size = min(51, len(projection) // 10 * 2 + 1)
@@ -177,8 +671,11 @@ class VineyardRowDetector:
         else:
             smoothed = projection
 
-        # ORIGINAL peak detection
-        min_distance_px = max(10, int(20 / self.pixel_size_m))
+        # ORIGINAL peak detection; rows at least 0.7 periods apart once the pyramid engine measured the period
+        if self.row_period_px:
+            min_distance_px = max(2, int(0.7 * self.row_period_px))
+        else:
+            min_distance_px = max(10, int(20 / self.pixel_size_m))
         height_threshold = np.max(smoothed) * 0.15
 
         peaks, properties = find_peaks(
@@ -190,7 +687,13 @@ class VineyardRowDetector:
 
         print(f"✅ Detected {len(peaks)} sample rows")
 
-        if len(peaks) >= 2:
+        if self.row_period_px:
+            # Spectral period of the orientation engine; peak gaps double where rows are missing
+            avg_spacing_px = self.row_period_px
+            avg_spacing_m = avg_spacing_px * self.pixel_size_m
+
+            print(f"   📏 Measured spacing: {avg_spacing_m:.2f}m ({avg_spacing_px:.1f} px, row period)")
+        elif len(peaks) >= 2:
             # Calculate spacing from detected peaks
             spacings = np.diff(peaks)
             avg_spacing_px = np.median(spacings)
@@ -203,24 +706,27 @@ class VineyardRowDetector:
             avg_spacing_m = 1.8
             print(f"   ⚠️  Using default spacing: {avg_spacing_m:.2f}m")
 
-        return peaks, rotated, -angle, avg_spacing_px
+        # Peaks as row_frame v coordinates (bin centres), plus the v range of the image
+        return peaks + offset + 0.5, (offset, offset + len(projection)), avg_spacing_px
 
-    def extrapolate_all_rows(self, sample_peaks, avg_spacing_px, rotated_shape):
+    def extrapolate_all_rows(self, sample_peaks, avg_spacing_px, v_range):
         """
         Extrapolate rows across entire field from sample rows
+
+        Positions are row_frame v coordinates within v_range.
         """
         print(f"\n📐 Extrapolating rows across field...")
 
-        h, w = rotated_shape
+        v_min, v_max = v_range
 
         if len(sample_peaks) == 0:
             print("❌ No sample rows")
             return []
 
         # Use middle peak as reference
-        reference_y = int(sample_peaks[len(sample_peaks) // 2])
+        reference_y = sample_peaks[len(sample_peaks) // 2]
 
-        print(f"   🎯 Reference: y={reference_y}")
+        print(f"   🎯 Reference: v={reference_y:.1f}")
         print(f"   📏 Spacing: {avg_spacing_px:.1f} px ({avg_spacing_px * self.pixel_size_m:.2f}m)")
 
         # Generate positions
@@ -228,14 +734,14 @@ class VineyardRowDetector:
 
         # Upward
         current_y = reference_y - avg_spacing_px
-        while current_y > 0:
-            row_positions.append(int(current_y))
+        while current_y > v_min:
+            row_positions.append(current_y)
             current_y -= avg_spacing_px
 
         # Downward
         current_y = reference_y + avg_spacing_px
-        while current_y < h:
-            row_positions.append(int(current_y))
+        while current_y < v_max:
+            row_positions.append(current_y)
             current_y += avg_spacing_px
 
         row_positions = sorted(row_positions)
@@ -244,104 +750,323 @@ class VineyardRowDetector:
 
         return row_positions
 
+    def track_rows(self, angle, avg_spacing_px):
+        """
+        Follow curved rows through strips along the row direction
+
+        The field is cut along the rows (row_frame u) into strips TRACK_STRIP_M
+        long; every strip gets its own projection profile, averaged with its
+        neighbours over TRACK_SMOOTH_STRIPS, and row peaks (strip_peaks), which
+        link_strip_peaks joins into tracks. Tracks interrupted for longer than
+        TRACK_MAX_MISSED strips are joined again (merge_tracks) and fragments
+        shorter than TRACK_MIN_LENGTH of the longest track are dropped, so every
+        row is numbered once; each track becomes one polyline. Cost is linear in
+        the vegetation pixels and the number of strips. Rows start / end at the
+        outer edge of their first / last strip.
+        """
+        print("\n🧵 Tracking rows along strips...")
+
+        strip_px = max(1, int(round(self.TRACK_STRIP_M / self.pixel_size_m)))
+        bounds = frame_bounds(self.vegetation_mask.shape, angle)
+        u_offset, _, v_offset, _ = bounds
+        find_peaks_in_strip = partial(strip_peaks, period_px=avg_spacing_px,
+                                      min_prominence=self.TRACK_MIN_PROMINENCE * strip_px,
+                                      min_coverage=self.TRACK_MIN_COVERAGE * strip_px)
+        peaks_per_strip = self._strip_peaks(angle, strip_px, bounds, find_peaks_in_strip)
+
+        max_shift = self.TRACK_MAX_SHIFT * avg_spacing_px
+        tracks = link_strip_peaks(peaks_per_strip, max_shift, self.TRACK_MAX_MISSED)
+        tracks = [(strips, positions) for strips, positions in tracks if len(strips) >= self.TRACK_MIN_STRIPS]
+        n_tracks = len(tracks)
+        tracks = merge_tracks(tracks, max_shift)
+        if tracks:
+            longest = max(len(strips) for strips, _ in tracks)
+            tracks = [(strips, positions) for strips, positions in tracks
+                      if len(strips) >= self.TRACK_MIN_LENGTH * longest]
+        tracks.sort(key=lambda track: track[1].mean())
+        print(f"   🧩 {sum(len(peaks) for peaks in peaks_per_strip)} peaks in {len(peaks_per_strip)} strips "
+              f"of {strip_px} px, {n_tracks} tracks, {len(tracks)} rows after merging / dropping fragments")
+        if not tracks:
+            print("❌ No tracks")
+            return []
+
+        # Strip centres, plus the outer edges of the first and last strip
+        u, v, point_row = [], [], []
+        for row, (strips, positions) in enumerate(tracks):
+            centres = np.concatenate([[strips[0]], strips + 0.5, [strips[-1] + 1]])
+            u.append(u_offset + centres * strip_px)
+            v.append(v_offset + 0.5 + np.concatenate([positions[:1], positions, positions[-1:]]))
+            point_row.append(np.full(len(centres), row))
+        u, v, point_row = np.concatenate(u), np.concatenate(v), np.concatenate(point_row)
+
+        row_geometries = self.frame_lines(u, v, point_row, np.arange(1, len(tracks) + 1), angle)
+
+        print(f"✅ Tracked {len(row_geometries)} rows")
+
+        return row_geometries
+
+    def _strip_peaks(self, angle, strip_px, bounds, find_peaks_in_strip):
+        """
+        strip_profiles and the row peaks of every strip, across a process pool
+
+        Workers bin one block of image rows each from the vegetation mask, placed
+        in shared memory once; their profiles are added up, smoothed across
+        strips and handed out again strip by strip for peak detection.
+        """
+        mask = self.vegetation_mask
+        workers = min(self.workers or os.cpu_count() or 1, mask.shape[0])
+        if workers <= 1:
+            profiles = strip_profiles(mask, angle, strip_px, bounds)
+            profiles = ndimage.gaussian_filter1d(profiles.astype(float), self.TRACK_SMOOTH_STRIPS, axis=0)
+            return [find_peaks_in_strip(profile) for profile in profiles]
+
+        edges = np.linspace(0, mask.shape[0], workers + 1).astype(int).tolist()
+        blocks = list(zip(edges[:-1], edges[1:]))
+        shm, mask_spec = _share_array(mask)
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_track_worker,
+                                     initargs=(mask_spec, angle, strip_px, bounds)) as pool:
+                profiles = sum(pool.map(_strip_profiles_worker, blocks))
+                profiles = ndimage.gaussian_filter1d(profiles.astype(float), self.TRACK_SMOOTH_STRIPS, axis=0)
+                chunksize = -(-len(profiles) // workers)
+                return list(pool.map(find_peaks_in_strip, profiles, chunksize=chunksize))
+        finally:
+            shm.close()
+            shm.unlink()
+
     def create_field_mask(self):
-        """Create field boundary mask"""
-        r, g, b = self.image_rgb[:, :, 0], self.image_rgb[:, :, 1], self.image_rgb[:, :, 2]
-        brightness = (r.astype(float) + g.astype(float) + b.astype(float)) / 3
-        field_mask = brightness > 15
+        """Create field boundary mask (from the orthophoto's data mask, else dark borders are cut by brightness)"""
+        if self.data_mask is not None:
+            field_mask = self.data_mask
+        else:
+            r, g, b = self.image_rgb[:, :, 0], self.image_rgb[:, :, 1], self.image_rgb[:, :, 2]
+            brightness = (r.astype(float) + g.astype(float) + b.astype(float)) / 3
+            field_mask = brightness > 15
         field_mask = morphology.remove_small_objects(field_mask, min_size=1000)
-        field_mask = morphology.binary_closing(field_mask, morphology.disk(5))
-        field_mask = morphology.binary_erosion(field_mask, morphology.disk(3))
+        field_mask = clean_mask(field_mask, [('close', 5), ('erode', 3)])
         return field_mask
 
-    def extract_row_geometries(self, row_positions, rotated, rotation_angle):
-        """Extract geometries with field boundary clipping"""
+    def extract_row_geometries(self, row_positions, angle, num_points=20, min_length_m=5):
+        """
+        Extract geometries with field boundary clipping (row_positions are row_frame v coordinates)
+
+        num_points are sampled along every row's field extent and turned into
+        lines by frame_lines.
+        """
         print(f"\n📏 Creating row geometries...")
 
-        h, w = rotated.shape
         field_mask = self.create_field_mask()
+        rows, u_start, u_end = row_field_extents(field_mask, angle, row_positions)
 
-        # Rotate field mask
-        center = (w // 2, h // 2)
-        M = cv2.getRotationMatrix2D(center, -rotation_angle, 1.0)
-        field_mask_rotated = cv2.warpAffine(
-            field_mask.astype(np.uint8),
-            M,
-            (w, h),
-            flags=cv2.INTER_NEAREST
-        ).astype(bool)
+        # Sample points in the row frame, (n_rows, num_points)
+        steps = np.linspace(0, 1, num_points)
+        u = u_start[:, None] + (u_end - u_start)[:, None] * steps
+        v = np.broadcast_to(np.asarray(row_positions, dtype=float)[rows][:, None], u.shape)
+        point_row = np.repeat(np.arange(len(rows)), num_points)
 
-        row_geometries = []
+        row_geometries = self.frame_lines(u.ravel(), v.ravel(), point_row, rows + 1, angle, min_length_m)
 
-        for row_idx, row_y in enumerate(row_positions):
-            if row_y < 0 or row_y >= h:
-                continue
+        print(f"✅ Created {len(row_geometries)} rows")
 
-            # Get field mask at this row
-            row_field_mask = field_mask_rotated[row_y, :]
-            field_cols = np.where(row_field_mask)[0]
+        return row_geometries
 
-            if len(field_cols) < 10:
-                continue
+    def frame_lines(self, u, v, point_row, row_numbers, angle, min_length_m=5):
+        """
+        Row dicts from polylines given as row_frame points
 
-            # Find continuous segments
-            gaps = np.diff(field_cols) > 5
-            gap_indices = np.where(gaps)[0]
+        u, v are the points of all rows, point_row (non-decreasing) the index of
+        each point's row into row_numbers. The back-rotation and the geotransform
+        are one affine map applied to all points at once; points outside the image
+        are dropped and rows keep at least two points. Lengths are geodesic on the
+        WGS84 ellipsoid for geographic CRSs, planar in CRS units (metres) otherwise.
+        """
+        h, w = self.vegetation_mask.shape
 
-            segments = []
-            start_idx = 0
-            for gap_idx in gap_indices:
-                segment = field_cols[start_idx:gap_idx + 1]
-                if len(segment) > 10:
-                    segments.append(segment)
-                start_idx = gap_idx + 1
+        # Row frame -> pixel (x = u cos - v sin, y = u sin + v cos) -> pixel centre -> CRS, as one matrix
+        angle_rad = np.radians(angle)
+        cos, sin = np.cos(angle_rad), np.sin(angle_rad)
+        to_pixel = np.array([[cos, -sin, 0.0], [sin, cos, 0.0], [0.0, 0.0, 1.0]])
+        to_crs = np.array(self.transform).reshape(3, 3) @ np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+        points = np.stack([u, v, np.ones_like(u)])  # (3, n_points)
+        x, y = to_pixel[:2] @ points
+        lon, lat = (to_crs @ to_pixel)[:2] @ points
+
+        # Keep the points inside the image, rows with at least two of them
+        inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+        valid_rows = np.bincount(point_row[inside], minlength=len(row_numbers)) >= 2
+        inside &= valid_rows[point_row]
+        point_row, lon, lat = point_row[inside], lon[inside], lat[inside]
+        if len(point_row) == 0:
+            return []
 
-            final_segment = field_cols[start_idx:]
-            if len(final_segment) > 10:
-                segments.append(final_segment)
+        # Length of every row: sum of its segment lengths
+        same_row = point_row[1:] == point_row[:-1]
+        if self.crs is None or self.crs.is_geographic:
+            _, _, segment_lengths = Geod(ellps='WGS84').inv(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        else:
+            segment_lengths = np.hypot(np.diff(lon), np.diff(lat)) * self.crs.linear_units_factor[1]
+        lengths = np.bincount(point_row[:-1][same_row], weights=segment_lengths[same_row],
+                              minlength=len(row_numbers))
+
+        # Objects only at the end: one LineString per kept row
+        kept_rows = np.flatnonzero(valid_rows)
+        geometries = shapely.linestrings(np.column_stack([lon, lat]), indices=np.searchsorted(kept_rows, point_row))
+        return [
+            {'row_number': int(row_numbers[row]), 'geometry': geometry, 'length_m': float(lengths[row]), 'segments': 1}
+            for row, geometry in zip(kept_rows, geometries)
+            if lengths[row] >= min_length_m
+        ]
+
+    def segment_blocks(self):
+        """
+        Split the field into blocks that each hold one row orientation
+
+        Works on the coarse pyramid level (coarse_level). Separate parts of the
+        field mask are split first; within each part the row angle of every
+        BLOCK_TILE_M tile is the spectrum peak of its vegetation coverage
+        (spectrum_orientation), and tiles are grouped by orientation_regions.
+        Tiles without a clear angle, and regions under BLOCK_MIN_TILES, join the
+        nearest region. Returns full-resolution int32 block labels (0 off the
+        field) and a list of (block_id, bounding box slices).
+        """
+        print("\n🧱 Segmenting blocks...")
 
-            if len(segments) == 0:
+        h, w = self.vegetation_mask.shape
+        field_mask = self.create_field_mask()
+        level = self.coarse_level()
+        coverage = mask_pyramid(self.vegetation_mask, level)[-1]
+        field = mask_pyramid(field_mask, level)[-1] >= 0.5
+        scale = h // field.shape[0]
+        pixel_area_m2 = (self.pixel_size_m * scale) ** 2
+        tile = max(8, int(round(self.BLOCK_TILE_M / self.pixel_size_m / scale)))
+        min_period = self.MIN_ROW_SPACING_M / self.pixel_size_m / scale
+        max_period = self.MAX_ROW_SPACING_M / self.pixel_size_m / scale
+
+        parts, n_parts = ndimage.label(field)
+        part_sizes = np.bincount(parts.ravel(), minlength=n_parts + 1)
+        ty, tx = np.indices(field.shape) // tile
+        n_ty, n_tx = -(-field.shape[0] // tile), -(-field.shape[1] // tile)
+        tile_index = ty * n_tx + tx
+
+        blocks = np.zeros(field.shape, dtype=np.int32)
+        n_blocks = 0
+        for part in range(1, n_parts + 1):
+            if part_sizes[part] * pixel_area_m2 < self.BLOCK_MIN_AREA_M2:
+                continue
+            in_part = parts == part
+
+            # Local row angle of the tiles mostly inside this part
+            tile_pixels = np.bincount(tile_index[in_part], minlength=n_ty * n_tx).reshape(n_ty, n_tx)
+            angles = np.full((n_ty, n_tx), np.nan)
+            part_coverage = np.where(in_part, coverage, 0)
+            for y, x in zip(*np.nonzero(tile_pixels >= tile * tile / 2)):
+                window = part_coverage[y * tile:(y + 1) * tile, x * tile:(x + 1) * tile]
+                result = spectrum_orientation(window, min_period, max_period)
+                if result is not None and result[2] >= self.MIN_SPECTRUM_PEAK:
+                    angles[y, x] = result[0]
+
+            # Orientation regions; small ones are dissolved like tiles without an angle
+            regions, n_regions = orientation_regions(angles, self.BLOCK_ANGLE_TOLERANCE_DEG)
+            sizes = np.bincount(regions[regions >= 0], minlength=n_regions)
+            regions[np.isin(regions, np.flatnonzero(sizes < self.BLOCK_MIN_TILES))] = -1
+            if not np.any(regions >= 0):
+                # No region: the whole part is one block
+                n_blocks += 1
+                blocks[in_part] = n_blocks
                 continue
 
-            # Create line for longest segment
-            segment = max(segments, key=len)
-            x_start = segment[0]
-            x_end = segment[-1]
-
-            # Sample points
-            num_points = 20
-            x_points = np.linspace(x_start, x_end, num_points)
-            y_points = np.full_like(x_points, row_y)
-
-            # Rotate back
-            angle_rad = np.radians(-rotation_angle)
-            center_x, center_y = w / 2, h / 2
-
-            x_rot = (x_points - center_x) * np.cos(angle_rad) - (y_points - center_y) * np.sin(angle_rad) + center_x
-            y_rot = (x_points - center_x) * np.sin(angle_rad) + (y_points - center_y) * np.cos(angle_rad) + center_y
-
-            # To geographic
-            geo_coords = []
-            for x, y in zip(x_rot, y_rot):
-                if 0 <= x < w and 0 <= y < h:
-                    lon, lat = xy(self.transform, y, x)
-                    geo_coords.append([lon, lat])
-
-            if len(geo_coords) >= 2:
-                geometry = LineString(geo_coords)
-                length_m = geometry.length * 111000
-
-                if length_m >= 5:
-                    row_geometries.append({
-                        'row_number': row_idx + 1,
-                        'geometry': geometry,
-                        'length_m': length_m,
-                        'segments': 1
-                    })
+            # Every tile of the part takes the region of the nearest region tile
+            _, (near_y, near_x) = ndimage.distance_transform_edt(regions < 0, return_indices=True)
+            regions = regions[near_y, near_x]
+            region_ids, block_of_region = np.unique(regions[tile_pixels > 0], return_inverse=True)
+            block_ids = np.zeros(regions.max() + 1, dtype=np.int32)
+            block_ids[region_ids] = n_blocks + 1 + np.arange(len(region_ids))
+            blocks[in_part] = block_ids[regions.ravel()[tile_index[in_part]]]
+            n_blocks += len(region_ids)
+
+        # Back to full resolution, off-field pixels excluded
+        block_labels = np.zeros((h, w), dtype=np.int32)
+        upsampled = blocks.repeat(scale, axis=0).repeat(scale, axis=1)
+        block_labels[:upsampled.shape[0], :upsampled.shape[1]] = upsampled[:h, :w]
+        block_labels[~field_mask] = 0
+        boxes = ndimage.find_objects(block_labels)
+        blocks = [(block_id, box) for block_id, box in enumerate(boxes, 1) if box is not None]
+
+        print(f"✅ {len(blocks)} blocks ({tile * scale} px tiles)")
+        return block_labels, blocks
+
+    def detect_rows(self):
+        """Orientation, spacing and rows of the vegetation mask; returns (row_geometries, angle, avg_spacing_px)"""
+        # Pyramid orientation (Hough with orientation='hough' or as a fallback), ORIGINAL row detection
+        angle = self.detect_orientation()
+        sample_peaks, v_range, avg_spacing_px = self.detect_sample_rows_original_method(angle)
+
+        if self.rows == 'track':
+            # Follow every row through strips instead of assuming straight rows
+            row_geometries = self.track_rows(angle, avg_spacing_px)
+        else:
+            # Extrapolate
+            all_positions = self.extrapolate_all_rows(sample_peaks, avg_spacing_px, v_range)
 
-        print(f"✅ Created {len(row_geometries)} rows")
+            # Create geometries
+            row_geometries = self.extract_row_geometries(all_positions, angle)
 
-        return row_geometries
+        return row_geometries, angle, avg_spacing_px
+
+    def detect_block_rows(self):
+        """
+        Rows of every block from segment_blocks, detected concurrently
+
+        Each block runs detect_rows on its own bounding box (_detect_block_rows),
+        in a process pool of up to self.workers processes (default all CPU cores)
+        that gets the vegetation mask and block labels through shared memory.
+        Large blocks are submitted first; their logs are printed in block order.
+        Rows are numbered across blocks and keep their block_id and block_row.
+        Returns (row_geometries, [(block_id, angle, avg_spacing_px)]).
+        """
+        block_labels, blocks = self.segment_blocks()
+        if not blocks:
+            return [], []
+
+        # Blocks only need the detector's settings and georeferencing, not its rasters
+        template = copy.copy(self)
+        template.image_rgb = template.vegetation_mask = template.data_mask = None
+        template.workers = 1
+
+        workers = min(self.workers or os.cpu_count() or 1, len(blocks))
+        if workers <= 1:
+            results = []
+            for block in blocks:
+                print(f"\n🧱 Block {block[0]}")
+                results.append(_detect_block_rows(template, self.vegetation_mask, block_labels, block))
+        else:
+            mask_shm, mask_spec = _share_array(self.vegetation_mask)
+            labels_shm, labels_spec = _share_array(block_labels)
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            try:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_block_worker,
+                                         initargs=(template, mask_spec, labels_spec, threads)) as pool:
+                    by_size = sorted(blocks, key=lambda block: -np.prod([s.stop - s.start for s in block[1]]))
+                    futures = {block[0]: pool.submit(_detect_block_rows_worker, block) for block in by_size}
+                    results = []
+                    for block_id, _ in blocks:
+                        result, log = futures[block_id].result()
+                        print(f"\n🧱 Block {block_id}" + log, end='')
+                        results.append(result)
+            finally:
+                for shm in (mask_shm, labels_shm):
+                    shm.close()
+                    shm.unlink()
+
+        row_geometries, block_stats = [], []
+        for (block_id, _), (block_rows, angle, avg_spacing_px) in zip(blocks, results):
+            for row in block_rows:
+                row_geometries.append(dict(row, row_number=len(row_geometries) + 1, block_id=block_id,
+                                           block_row=row['row_number']))
+            block_stats.append((block_id, angle, avg_spacing_px))
+
+        return row_geometries, block_stats
 
     def create_geojson(self, row_geometries):
         """Create GeoJSON"""
@@ -350,13 +1075,18 @@ class VineyardRowDetector:
         for row_info in row_geometries:
             coordinates = [list(row_info['geometry'].coords)]
 
+            properties = {
+                "rand": str(row_info['row_number']),
+                "row_id": row_info['row_number'],
+                "length_m": round(row_info['length_m'], 2)
+            }
+            if 'block_id' in row_info:
+                properties['block_id'] = row_info['block_id']
+                properties['block_row'] = row_info['block_row']
+
             feature = {
                 "type": "Feature",
-                "properties": {
-                    "rand": str(row_info['row_number']),
-                    "row_id": row_info['row_number'],
-                    "length_m": round(row_info['length_m'], 2)
-                },
+                "properties": properties,
                 "geometry": {
                     "type": "MultiLineString",
                     "coordinates": coordinates
@@ -440,15 +1170,12 @@ class VineyardRowDetector:
         self.load_orthophoto()
         indices = self.create_vegetation_mask()
 
-        # Use ORIGINAL detection
-        angle = self.detect_orientation_original_method()
-        sample_peaks, rotated, rotation, avg_spacing_px = self.detect_sample_rows_original_method(angle)
-
-        # Extrapolate
-        all_positions = self.extrapolate_all_rows(sample_peaks, avg_spacing_px, rotated.shape)
-
-        # Create geometries
-        row_geometries = self.extract_row_geometries(all_positions, rotated, rotation)
+        if self.blocks:
+            # One angle, spacing and row set per block
+            row_geometries, block_stats = self.detect_block_rows()
+        else:
+            row_geometries, angle, avg_spacing_px = self.detect_rows()
+            block_stats = [(None, angle, avg_spacing_px)]
 
         if len(row_geometries) == 0:
             print("\n❌ No rows!")
@@ -462,7 +1189,9 @@ class VineyardRowDetector:
         print("✅ COMPLETE!")
         print("="*80)
         print(f"   📊 Rows: {len(row_geometries)}")
-        print(f"   📏 Spacing: {avg_spacing_px * self.pixel_size_m:.2f}m")
+        for block_id, angle, avg_spacing_px in block_stats:
+            block = f" (block {block_id}, {angle:.1f}°)" if block_id is not None else ""
+            print(f"   📏 Spacing: {avg_spacing_px * self.pixel_size_m:.2f}m{block}")
         print(f"   📁 Output: {self.output_path.name}")
         print("="*80 + "\n")
 
@@ -472,14 +1201,17 @@ class VineyardRowDetector:
 def main():
     import sys
 
-    if len(sys.argv) < 2:
-        print("Usage: python detect_rows_final.py <orthophoto.tif> [output.geojson]")
+    args = [arg for arg in sys.argv[1:] if arg not in ('--hough', '--track', '--blocks')]
+    if len(args) < 1:
+        print("Usage: python detect_rows_final.py <orthophoto.tif> [output.geojson] [--hough] [--track] [--blocks]")
         sys.exit(1)
 
-    orthophoto = sys.argv[1]
-    output = sys.argv[2] if len(sys.argv) > 2 else None
+    orthophoto = args[0]
+    output = args[1] if len(args) > 1 else None
+    orientation = 'hough' if '--hough' in sys.argv else 'pyramid'
+    rows = 'track' if '--track' in sys.argv else 'extrapolate'
 
-    detector = VineyardRowDetector(orthophoto, output)
+    detector = VineyardRowDetector(orthophoto, output, orientation, rows, blocks='--blocks' in sys.argv)
     geojson = detector.run()
 
     if geojson:
@@ -0,0 +1,296 @@
+"""
+Gap report writers
+
+Every report of an analysis is written from one columnar gap table (see
+vine.measure_gaps), sorted by row id once. The text summary, CSV, JSON and
+GeoJSON are streamed to disk from the table columns through string
+templates, never as per-gap dicts, one in-memory JSON document or
+GeoDataFrame.to_file. The detailed gap layer is also written as GeoParquet
+(pyarrow) and FlatGeobuf (through pyogrio when installed), both from one
+GeoDataFrame.
+
+Formats are independent, so they are written in parallel threads. File
+I/O, pyarrow and GDAL release the GIL. Settings the writers need (method,
+minimum gap size, ...) are passed in explicitly and not read from
+vine.Config, whose per-analysis overrides are not visible in pool threads.
+"""
+import os
+import json
+import textwrap
+from importlib.util import find_spec
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Optional writers; geopandas, shapely and these are only imported by the columnar formats
+HAS_PYARROW = find_spec('pyarrow') is not None
+HAS_PYOGRIO = find_spec('pyogrio') is not None
+
+REPORT_FORMATS = ('summary', 'csv', 'json', 'geojson', 'parquet', 'fgb')
+
+CHUNK_SIZE = 10000  # gaps converted to Python values at a time
+
+DETAILED_FIELDS = (
+    'row_id', 'gap_id', 'centroid_lon', 'centroid_lat', 'area_pixels', 'area_sqm', 'width_meters',
+    'height_meters', 'bbox_lon_min', 'bbox_lat_min', 'bbox_lon_max', 'bbox_lat_max'
+)
+
+
+# ================================
+# GAP TABLE
+# ================================
+def sort_gap_table(gap_table):
+    """
+    Sort a gap table by row id, keeping the gap order within each row
+
+    Adds 'first_in_row' (bool) and 'row_gap_count' columns so the writers can
+    emit per-row headers without grouping again.
+    """
+    order = np.argsort(np.asarray(gap_table['row_id']), kind='stable')
+    table = {name: np.asarray(values)[order] for name, values in gap_table.items()}
+
+    n_gaps = len(order)
+    first_in_row = np.ones(n_gaps, dtype=bool)
+    if n_gaps > 1:
+        # Group on row_index (position in the rows file) so rows sharing an id stay apart
+        first_in_row[1:] = table['row_index'][1:] != table['row_index'][:-1]
+    starts = np.flatnonzero(first_in_row)
+    counts = np.diff(np.append(starts, n_gaps))
+
+    table['first_in_row'] = first_in_row
+    table['row_gap_count'] = np.repeat(counts, counts)
+    return table
+
+
+def _records(table, names):
+    """Yield tuples of plain Python values for the named columns, CHUNK_SIZE gaps at a time"""
+    n_gaps = len(table['gap_id'])
+    for start in range(0, n_gaps, CHUNK_SIZE):
+        yield from zip(*[table[name][start:start + CHUNK_SIZE].tolist() for name in names])
+
+
+# ================================
+# STREAMING WRITERS
+# ================================
+def write_summary(path, table, info):
+    """Text summary with per-row gap details"""
+    n_gaps = len(table['gap_id'])
+
+    def lines():
+        method = info['method']
+        yield "╔" + "═" * 80 + "╗\n"
+        yield "║" + " " * 20 + f"ORTHOPHOTO GAP ANALYSIS - {method.upper()}" + " " * (39 - len(method)) + "║\n"
+        yield "╚" + "═" * 80 + "╝\n\n"
+
+        yield f"Method: {method.upper()}\n"
+        yield f"Total rows analyzed: {info['total_rows']}\n"
+        yield f"Rows with gaps: {info['rows_with_gaps']}\n"
+        yield f"Total gaps detected: {n_gaps}\n"
+        yield f"Minimum gap size: {info['min_area_pixels']} pixels\n"
+        yield f"CRS: {info['crs']}\n\n"
+
+        if n_gaps:
+            total_area_sqm = float(np.sum(table['area_sqm']))
+
+            yield "STATISTICS:\n"
+            yield f"• Average gaps per row: {n_gaps / info['rows_with_gaps']:.1f}\n"
+            yield f"• Total gap area: {total_area_sqm:.1f} m²\n"
+            yield f"• Average gap area: {total_area_sqm / n_gaps:.1f} m²\n\n"
+
+            yield "ROW DETAILS:\n"
+            names = ('first_in_row', 'row_id', 'row_gap_count', 'gap_id', 'centroid_lat', 'centroid_lon', 'area_sqm')
+            for first, row_id, count, gap_id, lat, lon, area_sqm in _records(table, names):
+                if first:
+                    yield f"\nRow {row_id}: {count} gaps\n"
+                yield f"  Gap {gap_id}: {lat:.6f}°N, {lon:.6f}°E ({area_sqm:.1f} m²)\n"
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(lines())
+
+
+def write_csv(path, table, info):
+    """One line per gap with a Google Maps link"""
+    names = ('row_id', 'gap_id', 'centroid_lat', 'centroid_lon', 'area_pixels', 'area_sqm', 'width_meters',
+             'height_meters')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("row_id,gap_id,latitude,longitude,area_pixels,area_sqm,width_m,height_m,google_maps_link\n")
+        f.writelines(
+            f"{row_id},{gap_id},{lat:.8f},{lon:.8f},{pixels},{area_sqm:.1f},{width:.1f},{height:.1f},"
+            f"https://maps.google.com/?q={lat:.6f},{lon:.6f}\n"
+            for row_id, gap_id, lat, lon, pixels, area_sqm, width, height in _records(table, names)
+        )
+
+
+def write_json(path, table, info):
+    """
+    Metadata and gaps grouped by row
+
+    Streamed gap by gap from string templates; the file is laid out exactly
+    like json.dump(..., indent=2, ensure_ascii=False) of the whole document.
+    """
+    metadata = {
+        'method': info['method'],
+        'total_rows': info['total_rows'],
+        'rows_with_gaps': info['rows_with_gaps'],
+        'total_gaps': len(table['gap_id']),
+        'min_area_pixels': info['min_area_pixels'],
+        'crs': str(info['crs'])
+    }
+
+    def lines():
+        yield '{\n  "metadata": ' + textwrap.indent(json.dumps(metadata, indent=2), "  ").lstrip() + ',\n  "rows": ['
+
+        names = ('first_in_row', 'row_id', 'row_gap_count', 'gap_id', 'centroid_lat', 'centroid_lon', 'area_pixels',
+                 'area_sqm', 'width_meters', 'height_meters')
+        row_open = False
+        for first, row_id, count, gap_id, lat, lon, pixels, area_sqm, width, height in _records(table, names):
+            if first:
+                yield ('\n      ]\n    },' if row_open else '') + (
+                    f'\n    {{\n      "row_id": {json.dumps(row_id, ensure_ascii=False)},'
+                    f'\n      "gap_count": {count},\n      "gaps": [')
+                separator = '\n'
+                row_open = True
+            yield (
+                f'{separator}        {{\n          "gap_id": {gap_id},'
+                f'\n          "coordinates": {{\n            "latitude": {lat!r},\n            "longitude": {lon!r}\n          }},'
+                f'\n          "dimensions": {{\n            "area_pixels": {pixels},\n            "area_sqm": {area_sqm!r},'
+                f'\n            "width_m": {width!r},\n            "height_m": {height!r}\n          }}\n        }}'
+            )
+            separator = ',\n'
+
+        yield '\n      ]\n    }\n  ]\n}' if row_open else ']\n}'
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(lines())
+
+
+def _geojson_crs(crs):
+    """GeoJSON 'crs' member as written by GDAL (CRS84 for EPSG:4326), or None"""
+    epsg = crs.to_epsg() if crs is not None else None
+    if epsg is None:
+        return None
+    name = "urn:ogc:def:crs:OGC:1.3:CRS84" if epsg == 4326 else f"urn:ogc:def:crs:EPSG::{epsg}"
+    return {"type": "name", "properties": {"name": name}}
+
+
+def _write_feature_collection(path, name, crs, features):
+    """Stream a GeoJSON FeatureCollection from an iterable of feature strings"""
+    crs_member = _geojson_crs(crs)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{\n"type": "FeatureCollection",\n' + f'"name": {json.dumps(name)},\n')
+        if crs_member is not None:
+            f.write(f'"crs": {json.dumps(crs_member)},\n')
+        f.write('"features": [\n')
+        for i, feature in enumerate(features):
+            f.write(feature if i == 0 else ",\n" + feature)
+        f.write("\n]\n}\n")
+
+
+def write_geojson(path, table, info):
+    """Gap bounding boxes with all measurements as properties (centroid_point kept as WKT)"""
+    def features():
+        for row_id, gap_id, *values in _records(table, DETAILED_FIELDS):
+            lon, lat, pixels, area_sqm, width, height, lon_min, lat_min, lon_max, lat_max = map(repr, values)
+            yield (
+                f'{{ "type": "Feature", "properties": {{ "row_id": {json.dumps(row_id)}, "gap_id": {gap_id}, '
+                f'"centroid_point": "POINT ({lon} {lat})", "centroid_lon": {lon}, "centroid_lat": {lat}, '
+                f'"area_pixels": {pixels}, "area_sqm": {area_sqm}, "width_meters": {width}, '
+                f'"height_meters": {height}, "bbox_lon_min": {lon_min}, "bbox_lat_min": {lat_min}, '
+                f'"bbox_lon_max": {lon_max}, "bbox_lat_max": {lat_max} }}, '
+                f'"geometry": {{ "type": "Polygon", "coordinates": [ [ [ {lon_max}, {lat_min} ], '
+                f'[ {lon_max}, {lat_max} ], [ {lon_min}, {lat_max} ], [ {lon_min}, {lat_min} ], '
+                f'[ {lon_max}, {lat_min} ] ] ] }} }}'
+            )
+
+    _write_feature_collection(path, os.path.splitext(os.path.basename(path))[0], info['crs'], features())
+
+
+def write_centers_geojson(path, table, info):
+    """Gap centroids as points"""
+    def features():
+        names = ('row_id', 'gap_id', 'centroid_lon', 'centroid_lat', 'area_pixels', 'area_sqm')
+        for row_id, gap_id, *values in _records(table, names):
+            lon, lat, pixels, area_sqm = map(repr, values)
+            yield (
+                f'{{ "type": "Feature", "properties": {{ "row_id": {json.dumps(row_id)}, "gap_id": {gap_id}, '
+                f'"lon": {lon}, "lat": {lat}, "pixels": {pixels}, "area_sqm": {area_sqm} }}, '
+                f'"geometry": {{ "type": "Point", "coordinates": [ {lon}, {lat} ] }} }}'
+            )
+
+    _write_feature_collection(path, os.path.splitext(os.path.basename(path))[0], info['crs'], features())
+
+
+# ================================
+# COLUMNAR FORMATS
+# ================================
+def detailed_gap_frame(table, crs):
+    """GeoDataFrame of gap bounding boxes, shared by the GeoParquet and FlatGeobuf writers"""
+    import shapely
+    import geopandas as gpd
+
+    return gpd.GeoDataFrame(
+        {name: table[name] for name in DETAILED_FIELDS},
+        geometry=shapely.box(table['bbox_lon_min'], table['bbox_lat_min'], table['bbox_lon_max'], table['bbox_lat_max']),
+        crs=crs
+    )
+
+
+def write_parquet(path, frame):
+    frame.to_parquet(path, index=False)
+
+
+def write_flatgeobuf(path, frame):
+    # Features are stored in spatial index (Hilbert) order, not row order
+    if HAS_PYOGRIO:
+        frame.to_file(path, driver='FlatGeobuf', engine='pyogrio')
+    else:
+        frame.to_file(path, driver='FlatGeobuf')
+
+
+# ================================
+# ALL REPORTS
+# ================================
+def write_gap_reports(gap_table, info, output_dir, formats=REPORT_FORMATS, workers=None):
+    """
+    Write the reports of one analysis from a measure_gaps() table
+
+    info holds 'method', 'total_rows', 'min_area_pixels' and 'crs'. formats
+    picks from REPORT_FORMATS; GeoParquet needs pyarrow and is skipped with a
+    warning without it. Formats are written by up to workers threads (None =
+    one per format). Returns the written paths in formats order.
+    """
+    method = info['method']
+    table = sort_gap_table(gap_table)
+    info = dict(info, rows_with_gaps=int(np.count_nonzero(table['first_in_row'])))
+
+    jobs = []
+    frame = None
+    for report_format in formats:
+        if report_format == 'summary':
+            jobs.append((write_summary, f'orthophoto_summary_{method}.txt', table, info))
+        elif report_format == 'csv':
+            jobs.append((write_csv, f'orthophoto_gaps_{method}.csv', table, info))
+        elif report_format == 'json':
+            jobs.append((write_json, f'orthophoto_gaps_{method}.json', table, info))
+        elif report_format == 'geojson':
+            jobs.append((write_geojson, f'vineyard_gaps_detailed_{method}.geojson', table, info))
+            jobs.append((write_centers_geojson, f'vineyard_gap_centers_{method}.geojson', table, info))
+        elif report_format in ('parquet', 'fgb'):
+            if report_format == 'parquet' and not HAS_PYARROW:
+                print("   ⚠️  pyarrow not installed, skipping GeoParquet report")
+                continue
+            if frame is None:
+                frame = detailed_gap_frame(table, info['crs'])
+            if report_format == 'parquet':
+                jobs.append((write_parquet, f'vineyard_gaps_detailed_{method}.parquet', frame))
+            else:
+                jobs.append((write_flatgeobuf, f'vineyard_gaps_detailed_{method}.fgb', frame))
+        else:
+            raise ValueError(f"Unknown report format '{report_format}'. Choose from: {', '.join(REPORT_FORMATS)}")
+
+    paths = [os.path.join(output_dir, filename) for _, filename, *_ in jobs]
+    with ThreadPoolExecutor(max_workers=workers or max(len(jobs), 1)) as executor:
+        futures = [executor.submit(writer, path, *args) for (writer, _, *args), path in zip(jobs, paths)]
+        for future in futures:
+            future.result()
+
+    return paths
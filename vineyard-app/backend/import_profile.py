@@ -0,0 +1,72 @@
+"""
+Cold-start import profile for the analysis scripts
+
+The server starts a fresh Python interpreter for every request, so module
+imports are paid on each call. enable() wraps builtins.__import__ and records
+how long every module took to import the first time, including the modules it
+pulled in. At exit, a report of the slowest imports and the total time since
+enable() is printed to stderr, which leaves the JSON on stdout untouched.
+
+The scripts turn it on with --import-profile or IMPORT_PROFILE=1 in the
+environment (see enable_if_requested). Call it before the heavy imports.
+"""
+import os
+import sys
+import time
+import atexit
+import builtins
+
+FLAG = '--import-profile'
+ENV_VAR = 'IMPORT_PROFILE'
+
+_original_import = builtins.__import__
+_state = {'start': None, 'depth': 0}
+_records = []  # (module, seconds, nesting depth)
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    start = time.perf_counter()
+    _state['depth'] += 1
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _state['depth'] -= 1
+        _records.append((name, time.perf_counter() - start, _state['depth']))
+
+
+def enable(report_at_exit=True):
+    """Start recording import times (and print report() at exit)"""
+    if _state['start'] is not None:
+        return
+    _state['start'] = time.perf_counter()
+    builtins.__import__ = _timed_import
+    if report_at_exit:
+        atexit.register(report)
+
+
+def enable_if_requested(argv=None):
+    """enable() when argv (default sys.argv) has --import-profile, which is removed, or IMPORT_PROFILE is set"""
+    argv = sys.argv if argv is None else argv
+    requested = FLAG in argv
+    if requested:
+        argv.remove(FLAG)
+    if requested or os.environ.get(ENV_VAR, '') not in ('', '0'):
+        enable()
+
+
+def report(top=15, stream=None):
+    """Print the slowest top-level imports (own imports and lazy imports made inside functions)"""
+    if _state['start'] is None:
+        return
+    stream = stream or sys.stderr
+    elapsed = time.perf_counter() - _state['start']
+    outermost = [(name, seconds) for name, seconds, depth in _records if depth == 0]
+    import_seconds = sum(seconds for _, seconds in outermost)
+
+    print(f"⏱️ Import profile: {import_seconds:.2f}s of {elapsed:.2f}s since start spent importing "
+          f"({len(_records)} modules)", file=stream)
+    for name, seconds in sorted(outermost, key=lambda item: item[1], reverse=True)[:top]:
+        print(f"   {seconds * 1000:8.1f} ms  {name}", file=stream)
@@ -0,0 +1,102 @@
+"""
+Binary mask morphology on OpenCV
+
+Drop-in replacement for skimage.morphology.binary_opening / binary_closing /
+binary_erosion / binary_dilation with disk(radius) footprints. Masks are run
+through cv2.morphologyEx as uint8 (a zero-copy view of bool masks), which is
+multi-threaded and much faster than skimage on full orthophotos. The kernel
+is the same disk as skimage.morphology.disk and pixels outside the image are
+ignored as in skimage, so results are identical (see test_morphology.py).
+
+clean_mask() runs a sequence of operations, optionally in tiles: each tile is
+processed with a halo wide enough for the whole sequence, so tiled and
+full-frame results match while peak memory follows the tile size.
+"""
+import numpy as np
+import cv2
+
+OPERATIONS = {
+    'erode': cv2.MORPH_ERODE,
+    'dilate': cv2.MORPH_DILATE,
+    'open': cv2.MORPH_OPEN,
+    'close': cv2.MORPH_CLOSE
+}
+
+# How far (in multiples of the radius) an operation reaches into its neighbourhood
+_REACH = {'erode': 1, 'dilate': 1, 'open': 2, 'close': 2}
+
+_KERNELS = {}
+
+
+def disk_kernel(radius):
+    """uint8 disk footprint, same shape as skimage.morphology.disk(radius)"""
+    if radius not in _KERNELS:
+        y, x = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+        _KERNELS[radius] = (x * x + y * y <= radius * radius).astype(np.uint8)
+    return _KERNELS[radius]
+
+
+def operations_halo(operations):
+    """Halo in pixels a tile needs so a (name, radius) sequence matches the full-frame result"""
+    return sum(_REACH[name] * radius for name, radius in operations)
+
+
+def _as_uint8(mask):
+    mask = np.ascontiguousarray(mask)
+    return mask.view(np.uint8) if mask.dtype == bool else (mask != 0).astype(np.uint8)
+
+
+def _apply(mask, operations):
+    result = _as_uint8(mask)
+    for name, radius in operations:
+        result = cv2.morphologyEx(result, OPERATIONS[name], disk_kernel(radius))
+    return result.view(bool)
+
+
+def clean_mask(mask, operations, tile_size=None, out=None):
+    """
+    Apply a sequence of (name, radius) operations to a 2-D mask
+
+    name is one of OPERATIONS ('erode', 'dilate', 'open', 'close'). With
+    tile_size, the mask is processed in tile_size x tile_size tiles, each read
+    with a halo of operations_halo(operations) pixels; out may then be a
+    preallocated bool array (e.g. a np.memmap) to write into. Returns the
+    cleaned bool mask.
+    """
+    if not tile_size:
+        result = _apply(mask, operations)
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    h, w = mask.shape
+    halo = operations_halo(operations)
+    if out is None:
+        out = np.empty((h, w), dtype=bool)
+
+    for row in range(0, h, tile_size):
+        for col in range(0, w, tile_size):
+            top, left = max(row - halo, 0), max(col - halo, 0)
+            bottom, right = min(row + tile_size + halo, h), min(col + tile_size + halo, w)
+            tile = _apply(mask[top:bottom, left:right], operations)
+            out[row:row + tile_size, col:col + tile_size] = tile[row - top:row - top + tile_size,
+                                                                 col - left:col - left + tile_size]
+
+    return out
+
+
+def binary_opening(mask, radius, tile_size=None):
+    return clean_mask(mask, [('open', radius)], tile_size)
+
+
+def binary_closing(mask, radius, tile_size=None):
+    return clean_mask(mask, [('close', radius)], tile_size)
+
+
+def binary_erosion(mask, radius, tile_size=None):
+    return clean_mask(mask, [('erode', radius)], tile_size)
+
+
+def binary_dilation(mask, radius, tile_size=None):
+    return clean_mask(mask, [('dilate', radius)], tile_size)
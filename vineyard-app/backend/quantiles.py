@@ -0,0 +1,126 @@
+"""
+Histogram-based percentiles for vegetation index rasters
+
+np.percentile sorts / partitions a full copy of the array for every call. A
+QuantileHistogram instead counts the values into fixed bins in one streaming
+pass (array by array, chunk by chunk, or tile by tile) and then answers any
+number of percentile queries from the counts.
+
+Error bound: percentile() returns the lower edge of the bin holding the
+requested rank, so the result is never above the exact np.percentile value and
+less than one bin width below it (upper=True returns the upper edge instead:
+never below, less than one bin width above). With the default 65536 bins the
+width is 2**-14 (~6e-5) for ExG. An index of 8-bit RGB only takes discrete
+values, which the bins resolve, so a `values < p` mask (`values > p` with
+upper=True) matches the exact threshold up to float32 rounding noise of the
+level at the percentile. Values outside the declared range are counted in the
+first / last bin, so percentiles that fall outside the range are clamped to it.
+"""
+import numpy as np
+
+# Value range of each index for RGB normalized to 0-1 (VARI is unbounded; its
+# tails are clamped, the percentiles used by the pipeline lie well inside).
+# Ranges are symmetric powers of two so every bin edge is an exact binary
+# fraction and a value of exactly 0 starts a bin.
+INDEX_RANGES = {
+    'exg': (-2.0, 2.0),
+    'exgr': (-4.0, 4.0),
+    'ndi': (-1.0, 1.0),
+    'grvi': (-1.0, 1.0),
+    'vari': (-4.0, 4.0),
+    'rgbvi': (-1.0, 1.0)
+}
+
+DEFAULT_BINS = 65536
+CHUNK_SIZE = 4_000_000  # values binned at a time, bounds the temporaries of update()
+
+
+class QuantileHistogram:
+    """Fixed-bin histogram over [low, high) that answers percentile queries"""
+
+    def __init__(self, low, high, bins=DEFAULT_BINS):
+        self.low, self.high, self.bins = float(low), float(high), int(bins)
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+
+    @classmethod
+    def for_index(cls, name, bins=DEFAULT_BINS):
+        """Histogram over the INDEX_RANGES range of a vegetation index"""
+        low, high = INDEX_RANGES[name]
+        return cls(low, high, bins)
+
+    @property
+    def bin_width(self):
+        """Maximum error of a percentile answer"""
+        return (self.high - self.low) / self.bins
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def update(self, values, mask=None):
+        """Count an array (any shape) of values, or only those where mask is True, into the histogram; returns self"""
+        values = np.asarray(values).ravel()
+        mask = None if mask is None else np.asarray(mask).ravel()
+        scale = np.float32(self.bins / (self.high - self.low))
+        low = np.float32(self.low)
+
+        for start in range(0, values.size, CHUNK_SIZE):
+            chunk = values[start:start + CHUNK_SIZE]
+            if mask is not None:
+                chunk = chunk[mask[start:start + CHUNK_SIZE]]
+            positions = chunk - low
+            positions *= scale
+            np.clip(positions, 0, self.bins - 1, out=positions)
+            self.counts += np.bincount(positions.astype(np.int32), minlength=self.bins)
+
+        return self
+
+    def merge(self, other):
+        """Add the counts of a histogram with the same bins (e.g. from another tile); returns self"""
+        if (other.low, other.high, other.bins) != (self.low, self.high, self.bins):
+            raise ValueError("Cannot merge histograms with different bins")
+        self.counts += other.counts
+        return self
+
+    def percentile(self, q, upper=False):
+        """
+        Approximate np.percentile(values, q) for q in 0-100 (scalar or sequence)
+
+        Returns the lower edge of the bin that holds the requested rank, or the
+        upper edge with upper=True; see the module docstring for the error bound.
+        """
+        total = self.total
+        if total == 0:
+            raise ValueError("Percentile of an empty histogram")
+
+        ranks = np.floor(np.asarray(q, dtype=float) / 100.0 * (total - 1))
+        bin_ids = np.searchsorted(np.cumsum(self.counts), ranks, side='right')
+        edges = self.low + (bin_ids + (1 if upper else 0)) * self.bin_width
+
+        return float(edges) if np.ndim(edges) == 0 else edges
+
+
+def index_histograms(indices, names, histograms=None, bins=DEFAULT_BINS, mask=None):
+    """
+    Histogram each named index in one pass
+
+    Pass the returned dict back in as histograms to keep accumulating, e.g. one
+    call per tile in windowed runs. With a boolean mask only those pixels are
+    counted (e.g. the orthophoto's data pixels, leaving out nodata borders).
+    """
+    if histograms is None:
+        histograms = {name: QuantileHistogram.for_index(name, bins) for name in names}
+    for name in names:
+        histograms[name].update(indices[name], mask)
+    return histograms
+
+
+def index_percentiles(indices, queries, upper=False, bins=DEFAULT_BINS):
+    """
+    Answer percentile queries on several indices, one histogram pass per index
+
+    queries maps an index name to a percentile or a sequence of percentiles,
+    e.g. {'exg': 25, 'vari': [25, 70]}; the result has the same layout.
+    """
+    histograms = index_histograms(indices, list(queries), bins=bins)
+    return {name: histograms[name].percentile(q, upper=upper) for name, q in queries.items()}
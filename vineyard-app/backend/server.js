@@ -1039,6 +1039,16 @@ app.post('/api/analyze-orthophoto', upload.fields([
     const method = req.body.method || 'kmeans';
     console.log('🎯 Clustering method:', method);
 
+    // Optional bare soil detection budget (seconds / MB); None lets vine.py use its defaults
+    const timeBudget = parseFloat(req.body.time_budget);
+    const memoryBudget = parseFloat(req.body.memory_budget);
+    const pyBudget = (value) => (Number.isFinite(value) && value > 0 ? String(value) : 'None');
+
+    // Optional quick look from the overview pyramid: 'true' (default level) or an overview factor such as 8
+    const previewFactor = parseInt(req.body.preview, 10);
+    const pyPreview = req.body.preview === 'true' ? 'True'
+      : (Number.isFinite(previewFactor) && previewFactor > 1 ? String(previewFactor) : 'None');
+
     const orthophotoPath = path.join(uploadDir, req.files.orthophoto[0].filename);
     let rowsPath = null;
 
@@ -1053,41 +1063,60 @@ import json
 import os
 sys.path.insert(0, '${__dirname.replace(/\\/g, '\\\\')}')
 
-from vine import Config, analyze_orthophoto
+import import_profile
+
+
+# Everything runs under the main guard: vine's process pools re-import this script in their
+# workers under the spawn / forkserver start methods (Windows, macOS, Python 3.14+ on Linux)
+def main():
+    # IMPORT_PROFILE=1 on the server logs import times of this cold start (stderr)
+    import_profile.enable_if_requested()
+
+    from vine import Config, run_orthophoto_analysis
+
+    # Per-job settings; results go to a job_* folder under vine's OUTPUT_DIR
+    config = Config(ortho_path=r'${orthophotoPath.replace(/\\/g, '\\\\')}')
+    ${rowsPath ? `config.ROWS_PATH = r'${rowsPath.replace(/\\/g, '\\\\')}'` : ''}
+
+    try:
+        result = run_orthophoto_analysis(config, method='${method}', time_budget=${pyBudget(timeBudget)},
+                                         memory_budget=${pyBudget(memoryBudget)}, preview=${pyPreview})
+
+        if result is None:
+            print(json.dumps({"error": "Analysis returned no results"}))
+            sys.exit(1)
+
+        output = {
+            'method': result.get('method', 'kmeans'),
+            'detected_gaps': len(result.get('gaps', [])),
+            'total_gap_area_m2': sum(g.get('area_sqm', 0) for g in result.get('gaps', [])),
+            'rows_analyzed': result.get('total_rows', 0),
+            'rows_with_gaps': len(result.get('row_summary', [])),
+            'detector': result.get('detector'),
+            'output_dir': result.get('output_dir'),
+            'preview': result.get('preview'),
+            'row_estimates': result.get('row_estimates'),
+            'details': [{
+                'filename': os.path.basename(config.ORTHO_PATH),
+                'gaps_detected': len(result.get('gaps', [])),
+                'gap_area_m2': sum(g.get('area_sqm', 0) for g in result.get('gaps', [])),
+                'row_details': result.get('row_summary', [])
+            }]
+        }
 
-Config.ORTHO_PATH = r'${orthophotoPath.replace(/\\/g, '\\\\')}'
-${rowsPath ? `Config.ROWS_PATH = r'${rowsPath.replace(/\\/g, '\\\\')}'` : ''}
+        print(json.dumps(output))
 
-try:
-    result = analyze_orthophoto(method='${method}')
-    
-    if result is None:
-        print(json.dumps({"error": "Analysis returned no results"}))
+    except Exception as e:
+        import traceback
+        print(json.dumps({
+            "error": str(e),
+            "traceback": traceback.format_exc()
+        }))
         sys.exit(1)
-    
-    output = {
-        'method': result.get('method', 'kmeans'),
-        'detected_gaps': len(result.get('gaps', [])),
-        'total_gap_area_m2': sum(g.get('area_sqm', 0) for g in result.get('gaps', [])),
-        'rows_analyzed': result.get('total_rows', 0),
-        'rows_with_gaps': len(result.get('row_summary', [])),
-        'details': [{
-            'filename': os.path.basename(Config.ORTHO_PATH),
-            'gaps_detected': len(result.get('gaps', [])),
-            'gap_area_m2': sum(g.get('area_sqm', 0) for g in result.get('gaps', [])),
-            'row_details': result.get('row_summary', [])
-        }]
-    }
-    
-    print(json.dumps(output))
-    
-except Exception as e:
-    import traceback
-    print(json.dumps({
-        "error": str(e),
-        "traceback": traceback.format_exc()
-    }))
-    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
 `;
 
     fs.writeFileSync(tempScript, scriptContent);
@@ -0,0 +1,157 @@
+"""
+On-disk, content-addressed cache for intermediate orthophoto analysis products
+
+Every entry is one .npz file named after a key that hashes the stage name, the
+content hash of its inputs and the stage parameters, so changing a parameter
+or the orthophoto simply misses the cache and stale entries are never read.
+Bool masks are bit-packed and integer rasters stored in the smallest dtype
+that holds them (restored on load), and the archive is deflate-compressed.
+Entries are evicted least recently used first once the directory grows past
+max_bytes.
+"""
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+# Bump when a cached stage changes its output for the same key
+CACHE_VERSION = 1
+
+_HASH_CHUNK = 8 * 1024 * 1024
+
+
+def _compact_int_dtype(array):
+    if array.size == 0:
+        return np.int8
+    low, high = int(array.min()), int(array.max())
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+class StageCache:
+    """Content-addressed .npz store with an LRU size limit"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(stage, *parts):
+        """Cache key of a stage from its input hashes / parameters (anything JSON-serializable or str()-able)"""
+        payload = json.dumps([CACHE_VERSION, stage, parts], default=str, sort_keys=True)
+        return f"{stage}-{hashlib.sha1(payload.encode()).hexdigest()[:32]}"
+
+    def file_hash(self, path):
+        """
+        Content hash of a file
+
+        Memoized per (path, size, mtime) in file_hashes.json, so an unchanged
+        orthophoto is only read once.
+        """
+        stat = os.stat(path)
+        identity = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        memo_path = os.path.join(self.directory, 'file_hashes.json')
+
+        memo = {}
+        if os.path.exists(memo_path):
+            try:
+                with open(memo_path) as f:
+                    memo = json.load(f)
+            except (OSError, ValueError):
+                memo = {}
+
+        if identity not in memo:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+                    digest.update(chunk)
+            memo[identity] = digest.hexdigest()
+            temp_path = f"{memo_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(memo, f, indent=2)
+            os.replace(temp_path, memo_path)
+
+        return memo[identity]
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load(self, key):
+        """Return the stored {name: value} dict of key, or None on a miss"""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(str(data['__meta__']))
+                values = {}
+                for name, kind in meta['kinds'].items():
+                    if kind == 'mask':
+                        shape = tuple(meta['shapes'][name])
+                        bits = np.unpackbits(data[name], count=int(np.prod(shape)))
+                        values[name] = bits.view(bool).reshape(shape)
+                    elif kind == 'array':
+                        values[name] = data[name].astype(meta['dtypes'][name], copy=False)
+                    else:
+                        values[name] = meta['json'][name]
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            # Missing, evicted meanwhile by another analysis, or unreadable
+            return None
+
+        return values
+
+    def store(self, key, values):
+        """
+        Store a {name: value} dict under key
+
+        Values are numpy arrays (bool arrays are bit-packed) or JSON-serializable
+        objects such as scalars and stats dicts.
+        """
+        arrays = {}
+        meta = {'kinds': {}, 'shapes': {}, 'dtypes': {}, 'json': {}}
+        for name, value in values.items():
+            if isinstance(value, np.ndarray) and value.dtype == bool:
+                arrays[name] = np.packbits(value.ravel())
+                meta['kinds'][name] = 'mask'
+                meta['shapes'][name] = value.shape
+            elif isinstance(value, np.ndarray):
+                compact = _compact_int_dtype(value) if np.issubdtype(value.dtype, np.integer) else value.dtype
+                arrays[name] = value.astype(compact, copy=False)
+                meta['kinds'][name] = 'array'
+                meta['dtypes'][name] = value.dtype.str
+            else:
+                meta['kinds'][name] = 'json'
+                meta['json'][name] = value
+
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, __meta__=np.array(json.dumps(meta, default=float)), **arrays)
+        os.replace(temp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Parity test: OpenCV mask morphology backend vs skimage.morphology
+"""
+
+import sys
+import os
+
+import numpy as np
+from skimage import morphology
+
+# Check if we're in the right directory
+if not os.path.exists('mask_morphology.py'):
+    print("❌ Please run this from the backend directory")
+    sys.exit(1)
+
+import mask_morphology
+
+print("=" * 60)
+print("🧪 MASK MORPHOLOGY PARITY TEST")
+print("=" * 60)
+print()
+
+SKIMAGE_OPERATIONS = {
+    'erode': morphology.binary_erosion,
+    'dilate': morphology.binary_dilation,
+    'open': morphology.binary_opening,
+    'close': morphology.binary_closing
+}
+
+# Random masks of different densities and odd shapes, plus blobby masks like real gap masks
+rng = np.random.default_rng(0)
+masks = {f'random {density:.0%}': rng.random((257, 389)) < density for density in (0.1, 0.5, 0.9)}
+blobs = np.zeros((300, 420), dtype=bool)
+for y, x, radius in zip(rng.integers(0, 300, 60), rng.integers(0, 420, 60), rng.integers(2, 25, 60)):
+    yy, xx = np.ogrid[:300, :420]
+    blobs |= (yy - y) ** 2 + (xx - x) ** 2 <= radius ** 2
+masks['blobs'] = blobs ^ (rng.random(blobs.shape) < 0.05)
+
+failures = 0
+
+print("Comparing single operations against skimage...")
+for mask_name, mask in masks.items():
+    for name, skimage_op in SKIMAGE_OPERATIONS.items():
+        for radius in (1, 2, 3, 5):
+            expected = skimage_op(mask, morphology.disk(radius))
+            result = mask_morphology.clean_mask(mask, [(name, radius)])
+            if not np.array_equal(expected, result):
+                failures += 1
+                print(f"❌ {mask_name} {name}({radius}): {np.sum(expected != result)} pixels differ")
+print(f"✅ Checked {len(masks) * len(SKIMAGE_OPERATIONS) * 4} combinations")
+
+print()
+print("Comparing tiled sequences against full frame...")
+sequences = [
+    [('open', 2), ('close', 3)],  # bare soil cleanup
+    [('open', 1), ('close', 2)],  # gap mask cleanup
+    [('close', 5), ('erode', 3)]  # field mask
+]
+for mask_name, mask in masks.items():
+    for operations in sequences:
+        expected = mask
+        for name, radius in operations:
+            expected = SKIMAGE_OPERATIONS[name](expected, morphology.disk(radius))
+        for tile_size in (None, 16, 64, 100):
+            result = mask_morphology.clean_mask(mask, operations, tile_size=tile_size)
+            if not np.array_equal(expected, result):
+                failures += 1
+                print(f"❌ {mask_name} {operations} tile_size={tile_size}: "
+                      f"{np.sum(expected != result)} pixels differ")
+print(f"✅ Checked {len(masks) * len(sequences) * 4} combinations")
+
+print()
+print("=" * 60)
+if failures:
+    print(f"❌ {failures} PARITY CHECKS FAILED")
+    print("=" * 60)
+    sys.exit(1)
+print("✅ ALL TESTS PASSED")
+print("=" * 60)
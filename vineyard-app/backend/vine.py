@@ -1,25 +1,61 @@
+import import_profile
+
+if __name__ == "__main__":
+    import_profile.enable_if_requested()  # --import-profile / IMPORT_PROFILE=1, before the imports below
 
 import os
 import re
+import sys
 import json
+import hashlib
+import tempfile
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
-import rasterio
-import geopandas as gpd
-from shapely.geometry import box, Point
-from rasterio.features import rasterize
-from skimage import io, measure, filters, morphology
-from sklearn.cluster import KMeans
-from math import radians, sin, cos, sqrt, atan2
-from sklearn.cluster import DBSCAN, MeanShift, estimate_bandwidth
-from skimage.segmentation import slic
-from skimage.color import label2rgb
+from threadpoolctl import threadpool_limits
+from quantiles import QuantileHistogram, index_histograms, index_percentiles
+from mask_morphology import clean_mask
+from stage_cache import StageCache
+from gap_reports import write_gap_reports
+
+# matplotlib, rasterio, geopandas, scikit-learn, scikit-image and scipy are imported inside the
+# functions that use them: the server starts a fresh interpreter per request, and this way each
+# analysis mode only pays for the libraries it runs (see import_profile.py)
 
 # ================================
 # CONFIGURATION
 # ================================
-class Config:
+# Config instance of the analysis running in the current thread / context (see Config.activate)
+_ACTIVE_CONFIG = contextvars.ContextVar('vine_active_config', default=None)
+
+
+class _ConfigMeta(type):
+    """Resolve Config.NAME against the active Config instance first, then the class defaults"""
+
+    def __getattribute__(cls, name):
+        if name.isupper():
+            active = _ACTIVE_CONFIG.get()
+            if active is not None and name in active.__dict__:
+                return active.__dict__[name]
+        return super().__getattribute__(name)
+
+
+class Config(metaclass=_ConfigMeta):
+    """
+    Analysis settings
+
+    The class attributes are the process-wide defaults. An instance holds
+    per-analysis overrides, e.g. Config(ortho_path=..., output_dir=...,
+    min_gap_area_pixels=40); while it is active (Config.activate, or
+    run_orthophoto_analysis) every Config.NAME read in that thread or context
+    sees its values, so concurrent analyses never touch each other's settings.
+    """
+
     # Orthophoto paths
     ORTHO_PATH = '/home/praho/Documents/Job/BlajADER/HartiParcele/107Media-orthophoto.tif'
     ROWS_PATH = '/home/praho/Documents/Job/BlajADER/Randuri/107randuri.geojson'
@@ -38,22 +74,95 @@ class Config:
     # Output files
     OUTPUT_DIR = 'vineyard_analysis_results'
 
+    # Orthophoto nodata (alpha band, nodata value or internal mask); see read_data_mask
+    USE_DATA_MASK = True  # keep nodata out of clustering, thresholds and gap masks; skip empty tiles
+
+    # Windowed (bounded-memory) orthophoto analysis
+    WINDOW_SIZE = 2048  # tile side in pixels, rounded to the GeoTIFF block size
+    WINDOW_HALO = 32  # context pixels around each tile; must cover the morphology radii (~21 px)
+    WINDOW_SAMPLE_SIZE = 2_000_000  # pixels sampled to fit the clusterer and percentile thresholds
+
+    # Worker processes for row gap extraction and method comparison (None = serial; the CLI uses all
+    # CPU cores). The pools re-import the calling script under the spawn / forkserver start methods,
+    # so scripts that set this need an if __name__ == '__main__' guard.
+    N_WORKERS = None
+
+    # Scalable K-means: fit on a stratified sample, predict in chunks
+    KMEANS_SAMPLE_SIZE = None  # pixels used to fit K-means (None = every valid pixel)
+    PREDICT_CHUNK_SIZE = 1_000_000  # pixels per chunk when assigning cluster labels
+
+    # Spatially stratified sampling (DBSCAN, Mean Shift and sampled K-means)
+    SAMPLE_GRID_SIZE = 8  # grid cells per side
+
+    # Mask morphology (OpenCV backend, see mask_morphology.py)
+    MORPHOLOGY_TILE_SIZE = None  # tile side in pixels for full-frame mask cleanup (None = whole mask at once)
+
+    # Mean Shift bandwidth cache, keyed by the fit sample and estimation parameters
+    BANDWIDTH_CACHE_FILE = 'meanshift_bandwidth.json'  # inside OUTPUT_DIR (None = always re-estimate)
+
+    # Bare soil detector budget (None = unlimited); see select_detector
+    TIME_BUDGET_S = None  # seconds for the bare soil detection stage
+    MEMORY_BUDGET_MB = None  # peak memory of the bare soil detection stage
+    MAX_DOWNSAMPLE = 8  # largest decimation factor tried to fit a detector into the budget
+
+    # On-disk cache of intermediate products (soil mask, labels, gap mask, row raster)
+    STAGE_CACHE_DIR = 'stage_cache'  # inside OUTPUT_DIR (None = no caching)
+    STAGE_CACHE_MAX_MB = 2048  # least recently used entries are evicted beyond this size
+
+    # Orthophoto gap reports (see gap_reports.py); independent formats are written in parallel
+    REPORT_FORMATS = ('summary', 'csv', 'json', 'geojson', 'parquet', 'fgb')
+    REPORT_WORKERS = None  # threads writing report formats (None = one per format)
+
+    # Debug figures (orthophoto_debug_*.png); see submit_debug_figure
+    DEBUG_FIGURE = None  # None = skip, 'inline', or 'thread' / 'process' to render in the background
+    DEBUG_FIGURE_PIXELS = 1_000_000  # rasters are decimated to about this many pixels per panel
+
+    # Quick-look preview from the overview pyramid (see preview_orthophoto)
+    PREVIEW_FACTOR = 4  # overview level analyzed by analyze_orthophoto(preview=True)
+    PREVIEW_OVERVIEW_LEVELS = (2, 4, 8, 16)  # built when the orthophoto has none
+    PREVIEW_OVERVIEW_DIR = 'overviews'  # inside OUTPUT_DIR, holds the built ones (None = never build)
+
+    def __init__(self, **overrides):
+        for name, value in overrides.items():
+            if name.upper() not in type(self).defaults():
+                raise TypeError(f"Unknown Config setting '{name}'")
+            setattr(self, name.upper(), value)
+
+    @classmethod
+    def defaults(cls):
+        """Class-level settings as {NAME: value}"""
+        return {name: value for name, value in vars(cls).items() if name.isupper()}
+
+    @classmethod
+    def snapshot(cls):
+        """Effective settings (active overrides applied) as {NAME: value}"""
+        return {name: getattr(cls, name) for name in cls.defaults()}
+
+    @contextmanager
+    def activate(self):
+        """Make this instance the settings of the current thread / context for the duration of the block"""
+        token = _ACTIVE_CONFIG.set(self)
+        try:
+            yield self
+        finally:
+            _ACTIVE_CONFIG.reset(token)
+
 
 # ================================
 # UTILITY FUNCTIONS
 # ================================
 def calculate_distance_meters(lat1, lon1, lat2, lon2):
-    """Calculate distance between two GPS coordinates in meters using Haversine formula"""
+    """Calculate distance between GPS coordinates in meters using Haversine formula (scalars or arrays)"""
     R = 6371000  # Earth radius in meters
 
-    lat1_rad, lon1_rad = radians(lat1), radians(lon1)
-    lat2_rad, lon2_rad = radians(lat2), radians(lon2)
+    lat1_rad, lon1_rad = np.radians(lat1), np.radians(lon1)
+    lat2_rad, lon2_rad = np.radians(lat2), np.radians(lon2)
 
     dlat = lat2_rad - lat1_rad
     dlon = lon2_rad - lon1_rad
 
-    a = sin(dlat / 2) ** 2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
     return R * c
 
@@ -78,35 +187,92 @@ def ensure_output_dir():
 # ================================
 # VEGETATION INDICES
 # ================================
-def calculate_vegetation_indices(r, g, b):
-    """Calculate multiple vegetation indices from RGB bands"""
-    r_norm = r.astype(float) / 255.0
-    g_norm = g.astype(float) / 255.0
-    b_norm = b.astype(float) / 255.0
-
-    epsilon = 1e-7
-    indices = {}
-
-    # Excess Green
-    indices['exg'] = 2 * g_norm - r_norm - b_norm
-
-    # Excess Green minus Excess Red
-    excess_red = 1.4 * r_norm - g_norm
-    indices['exgr'] = indices['exg'] - excess_red
-
-    # Normalized Difference Index
-    indices['ndi'] = (g_norm - r_norm) / (g_norm + r_norm + epsilon)
-
-    # Visible Atmospherically Resistant Index
-    indices['vari'] = (g_norm - r_norm) / (g_norm + r_norm - b_norm + epsilon)
+class VegetationIndices:
+    """
+    Lazy vegetation index provider for one set of RGB bands
 
-    # Green-Red Vegetation Index
-    indices['grvi'] = (g_norm - r_norm) / (g_norm + r_norm + epsilon)
+    Used like the old dict of index arrays (indices['exg']), but each index is
+    computed in float32 on first access and memoized for the lifetime of the
+    provider, so one analysis computes every index at most once. Identical
+    formulas share a single array: 'grvi' is the same index as 'ndi'.
+    """
+    NAMES = ('exg', 'exgr', 'ndi', 'vari', 'grvi', 'rgbvi')
+    ALIASES = {'grvi': 'ndi'}
+    EPSILON = np.float32(1e-7)
+
+    def __init__(self, r, g, b):
+        self.r, self.g, self.b = r, g, b
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self.NAMES:
+            raise KeyError(name)
+        key = self.ALIASES.get(name, name)
+        if key not in self._cache:
+            self._cache[key] = getattr(self, f'_compute_{key}')()
+        return self._cache[key]
+
+    def __contains__(self, name):
+        return name in self.NAMES
+
+    def __iter__(self):
+        return iter(self.NAMES)
+
+    def keys(self):
+        return self.NAMES
+
+    def computed(self):
+        """Names of the indices that have been materialized so far"""
+        return tuple(self._cache)
+
+    def materialize(self):
+        """Compute every index now; returns {name: array} without the aliases"""
+        for name in self.NAMES:
+            self[name]
+        return dict(self._cache)
+
+    @classmethod
+    def from_arrays(cls, r, g, b, arrays):
+        """Provider over index arrays computed elsewhere, e.g. attached from shared memory"""
+        indices = cls(r, g, b)
+        indices._cache.update(arrays)
+        return indices
+
+    def _normalized(self):
+        scale = np.float32(255.0)
+        return (self.r.astype(np.float32) / scale,
+                self.g.astype(np.float32) / scale,
+                self.b.astype(np.float32) / scale)
+
+    def _compute_exg(self):
+        # Excess Green
+        r_norm, g_norm, b_norm = self._normalized()
+        return 2 * g_norm - r_norm - b_norm
+
+    def _compute_exgr(self):
+        # Excess Green minus Excess Red
+        r_norm, g_norm, _ = self._normalized()
+        return self['exg'] - (np.float32(1.4) * r_norm - g_norm)
+
+    def _compute_ndi(self):
+        # Normalized Difference Index (== Green-Red Vegetation Index)
+        r_norm, g_norm, _ = self._normalized()
+        return (g_norm - r_norm) / (g_norm + r_norm + self.EPSILON)
+
+    def _compute_vari(self):
+        # Visible Atmospherically Resistant Index
+        r_norm, g_norm, b_norm = self._normalized()
+        return (g_norm - r_norm) / (g_norm + r_norm - b_norm + self.EPSILON)
+
+    def _compute_rgbvi(self):
+        # RGB Vegetation Index
+        r_norm, g_norm, b_norm = self._normalized()
+        return (g_norm ** 2 - b_norm * r_norm) / (g_norm ** 2 + b_norm * r_norm + self.EPSILON)
 
-    # RGB Vegetation Index
-    indices['rgbvi'] = (g_norm ** 2 - b_norm * r_norm) / (g_norm ** 2 + b_norm * r_norm + epsilon)
 
-    return indices
+def calculate_vegetation_indices(r, g, b):
+    """Calculate multiple vegetation indices from RGB bands (lazily, see VegetationIndices)"""
+    return VegetationIndices(r, g, b)
 
 
 def calculate_ndvi(red, nir):
@@ -114,18 +280,17 @@ def calculate_ndvi(red, nir):
     return (nir - red) / (nir + red + 1e-6)
 
 
-# ================================
-# BARE SOIL DETECTION (K-MEANS)
-# ================================
-def detect_bare_soil_kmeans(r, g, b, n_clusters=4):
-    """Detect bare soil using K-means clustering on RGB + ALL vegetation indices"""
-    h, w = r.shape
+def build_cluster_features(r, g, b, indices):
+    """
+    Build the normalized feature matrix used by K-means and Mean Shift
 
-    # Calculează toți indicii vegetativi
-    indices = calculate_vegetation_indices(r, g, b)
+    Features are [R, G, B, ExG, ExGR, NDI, VARI, GRVI, RGBVI]; RGB is scaled to 0-1
+    and the indices are doubled so they weigh more than colour. Works on 2-D tiles
+    as well as on 1-D pixel samples.
 
-    # Creează vectorul de caracteristici: RGB + toți indicii
-    # [R, G, B, ExG, ExGR, NDI, VARI, GRVI, RGBVI]
+    Returns (features_normalized, valid_mask) where valid_mask excludes pixels with
+    saturated or near-black channels.
+    """
     features = np.stack([
         r.flatten(),
         g.flatten(),
@@ -138,76 +303,255 @@ def detect_bare_soil_kmeans(r, g, b, n_clusters=4):
         indices['rgbvi'].flatten()
     ], axis=1)
 
-    # Normalizare pentru ca toți indicii să aibă greutate echilibrată
-    # RGB sunt 0-255, indicii sunt aproximativ -1 to 1
     features_normalized = features.copy()
-    features_normalized[:, 0:3] = features[:, 0:3] / 255.0  # Normalizează RGB
-    # Indicii sunt deja în range -1 to 1, dar îi scalăm ușor pentru echilibru
-    features_normalized[:, 3:] = features[:, 3:] * 2.0  # Dă mai multă greutate indicilor
+    features_normalized[:, 0:3] = features[:, 0:3] / 255.0
+    features_normalized[:, 3:] = features[:, 3:] * 2.0
 
-    # Filtrează pixelii valizi (evită valorile extreme)
-    valid_mask = (features[:, 0] > 10) & (features[:, 0] < 245) & \
-                 (features[:, 1] > 10) & (features[:, 1] < 245) & \
-                 (features[:, 2] > 10) & (features[:, 2] < 245)
+    valid_mask = valid_cluster_pixels(r.ravel(), g.ravel(), b.ravel())
+
+    return features_normalized, valid_mask
+
+
+# Index arrays read by build_cluster_features
+CLUSTER_INDEX_NAMES = ('exg', 'exgr', 'ndi', 'vari', 'grvi', 'rgbvi')
+
+
+def valid_cluster_pixels(r, g, b):
+    """Mask of pixels whose channels are neither near-black nor saturated"""
+    return (r > 10) & (r < 245) & (g > 10) & (g < 245) & (b > 10) & (b < 245)
+
+
+def stratified_grid_sample(valid_mask, shape, grid_size=None, samples_per_cell=1, seed=42):
+    """
+    Spatially stratified, seeded sample of valid pixels
+
+    The image is split into a grid_size x grid_size grid (default
+    Config.SAMPLE_GRID_SIZE) and up to samples_per_cell valid pixels are drawn
+    from every cell: cells with fewer valid pixels contribute all of them, the
+    others one random pixel from each of samples_per_cell equal strata. Fully
+    vectorized (one stable sort of the cell ids).
+
+    valid_mask is a boolean mask of the image, flat or (h, w). Returns sorted
+    positions into the valid pixels, i.e. indices into features[valid_mask].
+    """
+    grid_size = grid_size or Config.SAMPLE_GRID_SIZE
+    h, w = shape
+
+    valid_positions = np.flatnonzero(valid_mask)
+    cells = (valid_positions // w * grid_size // h) * grid_size + (valid_positions % w) * grid_size // w
+    cells = cells.astype(np.uint16 if grid_size <= 256 else np.int64)
+    del valid_positions
+
+    # Group the valid pixels by cell (radix sort for uint16 ids)
+    by_cell = np.argsort(cells, kind='stable')
+    counts = np.bincount(cells, minlength=grid_size * grid_size)
+    starts = np.cumsum(counts) - counts
+    del cells
+
+    # Sample j of a cell is drawn from the j-th of its `take` equal-width strata
+    take = np.minimum(counts, samples_per_cell)
+    sample_cell = np.repeat(np.arange(len(counts)), take)
+    stratum = np.arange(len(sample_cell)) - np.repeat(np.cumsum(take) - take, take)
+    stratum_width = counts[sample_cell] / take[sample_cell]
+
+    rng = np.random.default_rng(seed)
+    offsets = ((stratum + rng.random(len(sample_cell))) * stratum_width).astype(np.int64)
+
+    return np.sort(by_cell[starts[sample_cell] + offsets])
+
+
+def sample_cluster_features(r, g, b, indices, sample_size, seed=42):
+    """Build build_cluster_features rows for a spatially stratified sample of the valid pixels only"""
+    valid_mask = valid_cluster_pixels(r, g, b)
+    samples_per_cell = max(1, sample_size // Config.SAMPLE_GRID_SIZE ** 2)
+    positions = np.flatnonzero(valid_mask)[stratified_grid_sample(valid_mask, r.shape, samples_per_cell=samples_per_cell,
+                                                                  seed=seed)]
+    del valid_mask
+
+    features, _ = build_cluster_features(
+        r.ravel()[positions], g.ravel()[positions], b.ravel()[positions],
+        {name: indices[name].ravel()[positions] for name in CLUSTER_INDEX_NAMES}
+    )
+    return features
+
+
+def predict_cluster_labels(model, r, g, b, indices, chunk_size=None):
+    """
+    Assign every pixel to a cluster of `model` in fixed-size chunks
+
+    Features are built chunk by chunk, so memory is bounded by chunk_size instead
+    of the whole-image feature matrix. Invalid pixels get label -1. Returns a
+    flat int32 label array.
+    """
+    chunk_size = chunk_size or Config.PREDICT_CHUNK_SIZE
+    r_flat, g_flat, b_flat = r.ravel(), g.ravel(), b.ravel()
+    index_flat = {name: indices[name].ravel() for name in CLUSTER_INDEX_NAMES}
+
+    labels = np.full(r_flat.size, -1, dtype=np.int32)
+    for start in range(0, r_flat.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        features, valid = build_cluster_features(
+            r_flat[chunk], g_flat[chunk], b_flat[chunk],
+            {name: values[chunk] for name, values in index_flat.items()}
+        )
+        if np.any(valid):
+            labels[chunk][valid] = model.predict(features[valid])
+
+    return labels
+
+
+def denormalize_centroids(centroids_normalized):
+    """Convert centroids from build_cluster_features space back to RGB / raw index units"""
+    centroids = centroids_normalized.copy()
+    centroids[:, 0:3] = centroids_normalized[:, 0:3] * 255.0
+    centroids[:, 3:] = centroids_normalized[:, 3:] / 2.0
+    return centroids
+
+
+def score_soil(r_val, g_val, b_val, exg_val, exgr_val, vari_val):
+    """
+    Vectorized bare soil score (higher = soil)
+
+    Takes mean RGB in 0-255 and raw ExG / ExGR / VARI values, as scalars or arrays
+    (one entry per cluster or superpixel).
+    """
+    # Soil is reddish and has LOW vegetation index values
+    rgb_soil_score = (r_val - g_val) + (r_val - b_val) + (g_val - b_val) * 0.5
+    veg_indices_score = -(exg_val + exgr_val + vari_val) * 100
+
+    # Moderate brightness bonus (soil is neither too dark nor too bright)
+    brightness = (r_val + g_val + b_val) / 3
+    brightness_bonus = np.where((brightness > 80) & (brightness < 180), 30, 0)
+
+    return rgb_soil_score + veg_indices_score + brightness_bonus
 
-    valid_features = features_normalized[valid_mask]
 
-    # K-means clustering pe caracteristicile extinse
+def score_soil_centroids(centroids_normalized):
+    """Score normalized cluster centroids by how much they look like bare soil (higher = soil)"""
+    centroids = np.asarray(centroids_normalized)
+    return score_soil(centroids[:, 0] * 255, centroids[:, 1] * 255, centroids[:, 2] * 255,
+                      centroids[:, 3] / 2.0, centroids[:, 4] / 2.0, centroids[:, 6] / 2.0)
+
+
+# ================================
+# BARE SOIL DETECTION (K-MEANS)
+# ================================
+def detect_bare_soil_kmeans(r, g, b, n_clusters=4, indices=None, sample_size=None, chunk_size=None):
+    """
+    Detect bare soil using K-means clustering on RGB + ALL vegetation indices
+
+    sample_size switches to the scalable mode: K-means is fitted on a seeded,
+    stratified sample of that many valid pixels and labels are predicted in
+    chunks of chunk_size pixels (default Config.PREDICT_CHUNK_SIZE). Use
+    evaluate_kmeans_sampling to pick a sample size.
+    """
+    from sklearn.cluster import KMeans
+
+    h, w = r.shape
+
+    # Calculează toți indicii vegetativi (sau folosește furnizorul primit)
+    if indices is None:
+        indices = calculate_vegetation_indices(r, g, b)
+
     kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10, max_iter=300)
-    kmeans.fit(valid_features)
 
-    # Atribuie etichetele
-    labels = np.full(len(features), -1)
-    labels[valid_mask] = kmeans.predict(valid_features)
+    if sample_size is None:
+        features_normalized, valid_mask = build_cluster_features(r, g, b, indices)
+        valid_features = features_normalized[valid_mask]
+        del features_normalized
+
+        # K-means clustering pe caracteristicile extinse
+        kmeans.fit(valid_features)
+
+        # Atribuie etichetele
+        labels = np.full(h * w, -1)
+        labels[valid_mask] = kmeans.predict(valid_features)
+    else:
+        # Antrenare pe un eșantion stratificat, predicție pe bucăți
+        kmeans.fit(sample_cluster_features(r, g, b, indices, sample_size))
+        labels = predict_cluster_labels(kmeans, r, g, b, indices, chunk_size)
+
     labels = labels.reshape(h, w)
 
     centroids_normalized = kmeans.cluster_centers_
 
     # Denormalizează centroizii pentru afișare
-    centroids = centroids_normalized.copy()
-    centroids[:, 0:3] = centroids_normalized[:, 0:3] * 255.0
-    centroids[:, 3:] = centroids_normalized[:, 3:] / 2.0
+    centroids = denormalize_centroids(centroids_normalized)
 
     # Identifică clusterul de sol bazat pe RGB ȘI indici vegetativi
-    soil_scores = []
-    for i, centroid_norm in enumerate(centroids_normalized):
-        # Denormalizează pentru calcul
-        r_val = centroid_norm[0] * 255
-        g_val = centroid_norm[1] * 255
-        b_val = centroid_norm[2] * 255
-
-        # Indicii vegetativi (normalizați)
-        exg_val = centroid_norm[3] / 2.0
-        exgr_val = centroid_norm[4] / 2.0
-        vari_val = centroid_norm[6] / 2.0
-
-        # Scor bazat pe RGB (solul e mai roșiatic)
-        rgb_soil_score = (r_val - g_val) + (r_val - b_val) + (g_val - b_val) * 0.5
-
-        # Scor bazat pe indici (solul are valori MICI pentru indici de vegetație)
-        # ExG, ExGR, VARI scăzute = sol
-        veg_indices_score = -(exg_val + exgr_val + vari_val) * 100  # Negativ pentru că vrem valori mici
-
-        # Bonus pentru luminozitate moderată (solul nu e prea întunecos sau prea deschis)
-        brightness = (r_val + g_val + b_val) / 3
-        brightness_bonus = 0
-        if 80 < brightness < 180:
-            brightness_bonus = 30
-
-        # Scor final combinat
-        soil_score = rgb_soil_score + veg_indices_score + brightness_bonus
-        soil_scores.append(soil_score)
-
+    soil_scores = score_soil_centroids(centroids_normalized)
     soil_cluster = np.argmax(soil_scores)
     bare_soil_mask = (labels == soil_cluster)
 
     # Curățare morfologică
-    bare_soil_mask = morphology.binary_opening(bare_soil_mask, morphology.disk(2))
-    bare_soil_mask = morphology.binary_closing(bare_soil_mask, morphology.disk(3))
+    bare_soil_mask = clean_mask(bare_soil_mask, [('open', 2), ('close', 3)], Config.MORPHOLOGY_TILE_SIZE)
 
     return bare_soil_mask, labels, centroids
 
-def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05):
+def evaluate_kmeans_sampling(r, g, b, sample_sizes=(50_000, 200_000, 1_000_000), n_clusters=4, indices=None):
+    """
+    Compare sample-fitted K-means against the full fit to choose a sample size
+
+    For every sample size, reports the fraction of valid pixels assigned to the
+    same cluster as the full fit (clusters matched by centroid distance), the
+    agreement of the resulting soil masks before morphology, and fit/predict
+    times. Returns a list of dicts, one per sample size.
+    """
+    from sklearn.cluster import KMeans
+    from scipy.optimize import linear_sum_assignment
+
+    if indices is None:
+        indices = calculate_vegetation_indices(r, g, b)
+
+    features_normalized, valid_mask = build_cluster_features(r, g, b, indices)
+    valid_features = features_normalized[valid_mask]
+    del features_normalized
+
+    start = time.perf_counter()
+    full = KMeans(n_clusters=n_clusters, random_state=42, n_init=10, max_iter=300).fit(valid_features)
+    full_labels = full.predict(valid_features)
+    full_seconds = time.perf_counter() - start
+    full_soil = full_labels == np.argmax(score_soil_centroids(full.cluster_centers_))
+    del valid_features
+
+    print(f"   Full fit: {valid_mask.sum():,} pixels in {full_seconds:.1f}s")
+
+    report = []
+    for sample_size in sample_sizes:
+        start = time.perf_counter()
+        sampled = KMeans(n_clusters=n_clusters, random_state=42, n_init=10, max_iter=300)
+        sampled.fit(sample_cluster_features(r, g, b, indices, sample_size))
+        fit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        labels = predict_cluster_labels(sampled, r, g, b, indices)[valid_mask.ravel()]
+        predict_seconds = time.perf_counter() - start
+
+        # Match sampled clusters to full-fit clusters by centroid distance
+        distances = np.linalg.norm(sampled.cluster_centers_[:, None, :] - full.cluster_centers_[None, :, :], axis=2)
+        sampled_ids, full_ids = linear_sum_assignment(distances)
+        mapping = np.empty(n_clusters, dtype=np.int64)
+        mapping[sampled_ids] = full_ids
+
+        soil = labels == np.argmax(score_soil_centroids(sampled.cluster_centers_))
+        result = {
+            'sample_size': int(min(sample_size, len(full_labels))),
+            'label_agreement': float(np.mean(mapping[labels] == full_labels)),
+            'soil_agreement': float(np.mean(soil == full_soil)),
+            'fit_seconds': fit_seconds,
+            'predict_seconds': predict_seconds,
+            'full_fit_seconds': full_seconds
+        }
+        report.append(result)
+
+        print(f"   Sample {result['sample_size']:>10,}: labels {result['label_agreement'] * 100:.2f}%, "
+              f"soil {result['soil_agreement'] * 100:.2f}% agree, fit {fit_seconds:.1f}s, predict {predict_seconds:.1f}s")
+
+    return report
+
+
+def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05, indices=None, seed=42,
+                            min_cluster_share=0.02):
     """
     Memory-optimized DBSCAN for bare soil detection in vineyard images
 
@@ -228,15 +572,26 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
         Minimum samples for core point (default: 30)
     sample_ratio : float
         Ratio of pixels to sample (default: 0.05 = 5%)
+    indices : VegetationIndices, optional
+        Shared index provider; computed from r, g, b when omitted
+    seed : int
+        Seed of the pixel sample, so runs are repeatable (default: 42)
+    min_cluster_share : float
+        Smallest share of the sample a cluster needs to be picked as soil; with
+        fewer than two such clusters soil is not separated from the vines and
+        the ExG threshold is used instead (default: 0.02)
     """
+    from sklearn.cluster import DBSCAN
+
     h, w = r.shape
     total_pixels = h * w
 
     print(f"   🔧 DBSCAN - Memory Optimized Version")
     print(f"   📏 Image size: {h}x{w} = {total_pixels:,} pixels")
 
-    # Calculate vegetation indices
-    indices = calculate_vegetation_indices(r, g, b)
+    # Calculate vegetation indices (unless a shared provider was passed in)
+    if indices is None:
+        indices = calculate_vegetation_indices(r, g, b)
 
     # ============================================================================
     # STEP 1: EFFICIENT FEATURE ENGINEERING
@@ -253,14 +608,14 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
     brightness = (r_norm + g_norm + b_norm) / 3.0
     greenness_inv = 1.0 - (2 * g_norm - r_norm - b_norm)
 
-    # Stack features - use float32 to save memory
+    # Stack features - use float32 to save memory (the indices already are)
     features = np.stack([
         r.flatten().astype(np.float32),
         g.flatten().astype(np.float32),
         b.flatten().astype(np.float32),
-        indices['exg'].flatten().astype(np.float32),
-        indices['vari'].flatten().astype(np.float32),
-        indices['ndi'].flatten().astype(np.float32),
+        indices['exg'].ravel(),
+        indices['vari'].ravel(),
+        indices['ndi'].ravel(),
         redness.flatten(),
         brownness.flatten(),
         brightness.flatten(),
@@ -293,7 +648,6 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
     )
 
     valid_features = features_normalized[valid_mask]
-    valid_indices = np.where(valid_mask)[0]
 
     del features_normalized  # Free memory
 
@@ -311,44 +665,19 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
 
     print(f"   🎯 Sampling {sample_size:,} pixels ({sample_size / len(valid_features) * 100:.1f}%)")
 
-    # Simplified grid sampling - smaller grid for efficiency
-    grid_size = 8  # Reduced from 12
+    # Vectorized grid sampling - up to samples_per_cell pixels per grid cell
+    grid_size = Config.SAMPLE_GRID_SIZE
     samples_per_cell = max(1, sample_size // (grid_size * grid_size))
 
-    sampled_indices = []
-
-    for i in range(grid_size):
-        for j in range(grid_size):
-            row_start = int(i * h / grid_size)
-            row_end = int((i + 1) * h / grid_size)
-            col_start = int(j * w / grid_size)
-            col_end = int((j + 1) * w / grid_size)
-
-            # Find valid pixels in cell
-            cell_pixel_indices = []
-            for row in range(row_start, row_end):
-                for col in range(col_start, col_end):
-                    pixel_idx = row * w + col
-                    if valid_mask[pixel_idx]:
-                        # Find position in valid_features array
-                        valid_pos = np.searchsorted(valid_indices, pixel_idx)
-                        if valid_pos < len(valid_indices) and valid_indices[valid_pos] == pixel_idx:
-                            cell_pixel_indices.append(valid_pos)
-
-            # Sample from cell
-            if len(cell_pixel_indices) > 0:
-                n_samples = min(samples_per_cell, len(cell_pixel_indices))
-                selected = np.random.choice(cell_pixel_indices, n_samples, replace=False)
-                sampled_indices.extend(selected)
-
-    sampled_indices = np.array(sampled_indices)
-
-    # Fill to target size
+    sampled_indices = stratified_grid_sample(valid_mask, (h, w), grid_size, samples_per_cell, seed=seed)
+
+    # Fill to target size (seeded too, on its own stream)
     remaining = sample_size - len(sampled_indices)
     if remaining > 0:
         available = np.setdiff1d(np.arange(len(valid_features)), sampled_indices)
         if len(available) > 0:
-            additional = np.random.choice(available, min(remaining, len(available)), replace=False)
+            rng = np.random.default_rng(seed + 1)
+            additional = rng.choice(available, min(remaining, len(available)), replace=False)
             sampled_indices = np.concatenate([sampled_indices, additional])
 
     # Limit to target size if oversampled
@@ -389,7 +718,7 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
     except Exception as e:
         print(f"   ❌ DBSCAN failed: {e}")
         print(f"   🔄 Using threshold-based detection instead")
-        bare_soil_mask = (indices['exg'] < np.percentile(indices['exg'], 30))
+        bare_soil_mask = (indices['exg'] < QuantileHistogram.for_index('exg').update(indices['exg']).percentile(30))
         return bare_soil_mask, np.zeros((h, w), dtype=int), np.array([])
 
     # ============================================================================
@@ -464,7 +793,15 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
     # STEP 9: SOIL IDENTIFICATION
     # ============================================================================
 
-    if len(centroids) > 0:
+    # A handful of points clustering apart is not the soil of the field
+    candidates = cluster_sizes >= min_cluster_share * len(sample_features)
+
+    if np.sum(candidates) < 2:
+        print(f"   ⚠️ {np.sum(candidates)} cluster(s) with at least {min_cluster_share:.0%} of the sample "
+              f"- using threshold-based detection instead")
+        bare_soil_mask = (indices['exg'] < QuantileHistogram.for_index('exg').update(indices['exg']).percentile(30))
+
+    elif len(centroids) > 0:
         print(f"   🔍 Identifying soil cluster...")
 
         soil_scores = []
@@ -485,9 +822,9 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
             size_score = min(15, (size / len(sample_features)) * 150)
 
             total_score = color_score + veg_score + brightness_score + size_score
-            soil_scores.append(total_score)
+            soil_scores.append(total_score if candidates[i] else -np.inf)
 
-            print(f"      Cluster {i}: score={total_score:.1f}, size={size:,}")
+            print(f"      Cluster {i}: score={total_score:.1f}, size={size:,}" + ("" if candidates[i] else " (too small)"))
 
         soil_cluster_idx = np.argmax(soil_scores)
         soil_cluster = unique_labels[soil_cluster_idx]
@@ -510,8 +847,7 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
 
     from skimage import morphology
 
-    bare_soil_mask = morphology.binary_opening(bare_soil_mask, morphology.disk(2))
-    bare_soil_mask = morphology.binary_closing(bare_soil_mask, morphology.disk(3))
+    bare_soil_mask = clean_mask(bare_soil_mask, [('open', 2), ('close', 3)], Config.MORPHOLOGY_TILE_SIZE)
     bare_soil_mask = morphology.remove_small_objects(bare_soil_mask, min_size=50)
     bare_soil_mask = morphology.remove_small_holes(bare_soil_mask, area_threshold=100)
 
@@ -520,8 +856,10 @@ def detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30, sample_ratio=0.05
 
     return bare_soil_mask, labels, centroids
 
-def detect_bare_soil_slic(r, g, b, n_segments=1000, compactness=10):
+def detect_bare_soil_slic(r, g, b, n_segments=1000, compactness=10, indices=None):
     """Detect bare soil using SLIC superpixel segmentation"""
+    from skimage.segmentation import slic
+
     h, w = r.shape
 
     # Create RGB image for SLIC
@@ -532,59 +870,43 @@ def detect_bare_soil_slic(r, g, b, n_segments=1000, compactness=10):
     segments = slic(rgb_img, n_segments=n_segments, compactness=compactness,
                     start_label=0, channel_axis=2)
 
-    # Calculate features for each superpixel
-    indices = calculate_vegetation_indices(r, g, b)
+    # Calculate features for each superpixel in one pass over the image
+    if indices is None:
+        indices = calculate_vegetation_indices(r, g, b)
     n_superpixels = segments.max() + 1
 
-    superpixel_features = []
-    for i in range(n_superpixels):
-        mask = (segments == i)
-        if np.sum(mask) == 0:
-            continue
-
-        # Average RGB and indices for this superpixel
-        r_mean = np.mean(r[mask])
-        g_mean = np.mean(g[mask])
-        b_mean = np.mean(b[mask])
-        exg_mean = np.mean(indices['exg'][mask])
-        exgr_mean = np.mean(indices['exgr'][mask])
-        ndi_mean = np.mean(indices['ndi'][mask])
-        vari_mean = np.mean(indices['vari'][mask])
-        grvi_mean = np.mean(indices['grvi'][mask])
-        rgbvi_mean = np.mean(indices['rgbvi'][mask])
+    flat_segments = segments.ravel()
+    pixel_counts = np.bincount(flat_segments, minlength=n_superpixels)
+    present = pixel_counts > 0
 
-        superpixel_features.append([
-            i, r_mean, g_mean, b_mean, exg_mean, exgr_mean,
-            ndi_mean, vari_mean, grvi_mean, rgbvi_mean
-        ])
+    def superpixel_means(values):
+        sums = np.bincount(flat_segments, weights=values.ravel(), minlength=n_superpixels)
+        return sums[present] / pixel_counts[present]
 
-    superpixel_features = np.array(superpixel_features)
+    # [id, R, G, B, ExG, ExGR, NDI, VARI, GRVI, RGBVI]; GRVI is NDI, so reuse its means
+    ndi_mean = superpixel_means(indices['ndi'])
+    superpixel_features = np.column_stack([
+        np.flatnonzero(present),
+        superpixel_means(r), superpixel_means(g), superpixel_means(b),
+        superpixel_means(indices['exg']), superpixel_means(indices['exgr']),
+        ndi_mean, superpixel_means(indices['vari']), ndi_mean, superpixel_means(indices['rgbvi'])
+    ])
 
     # Identify soil superpixels
-    soil_scores = []
-    for feat in superpixel_features:
-        r_val, g_val, b_val = feat[1], feat[2], feat[3]
-        exg_val, exgr_val, vari_val = feat[4], feat[5], feat[7]
-
-        rgb_soil_score = (r_val - g_val) + (r_val - b_val) + (g_val - b_val) * 0.5
-        veg_indices_score = -(exg_val + exgr_val + vari_val) * 100
-
-        brightness = (r_val + g_val + b_val) / 3
-        brightness_bonus = 30 if 80 < brightness < 180 else 0
-
-        soil_score = rgb_soil_score + veg_indices_score + brightness_bonus
-        soil_scores.append(soil_score)
+    soil_scores = score_soil(superpixel_features[:, 1], superpixel_features[:, 2], superpixel_features[:, 3],
+                             superpixel_features[:, 4], superpixel_features[:, 5], superpixel_features[:, 7])
 
     # Select top soil superpixels (top 25%)
     threshold = np.percentile(soil_scores, 75)
-    soil_superpixel_ids = superpixel_features[np.array(soil_scores) > threshold, 0].astype(int)
+    soil_superpixel_ids = superpixel_features[soil_scores > threshold, 0].astype(int)
 
-    # Create soil mask
-    bare_soil_mask = np.isin(segments, soil_superpixel_ids)
+    # Create soil mask through a superpixel -> soil lookup table
+    is_soil_superpixel = np.zeros(n_superpixels, dtype=bool)
+    is_soil_superpixel[soil_superpixel_ids] = True
+    bare_soil_mask = is_soil_superpixel[segments]
 
     # Morphological cleanup
-    bare_soil_mask = morphology.binary_opening(bare_soil_mask, morphology.disk(2))
-    bare_soil_mask = morphology.binary_closing(bare_soil_mask, morphology.disk(3))
+    bare_soil_mask = clean_mask(bare_soil_mask, [('open', 2), ('close', 3)], Config.MORPHOLOGY_TILE_SIZE)
 
     # Create centroids for visualization
     centroids = superpixel_features[:, 1:4]  # RGB values only
@@ -592,185 +914,970 @@ def detect_bare_soil_slic(r, g, b, n_segments=1000, compactness=10):
     return bare_soil_mask, segments, centroids
 
 
-def detect_bare_soil_meanshift(r, g, b, bandwidth=None):
-    """Detect bare soil using Mean Shift clustering"""
-    h, w = r.shape
+class NearestCentroidLabeler:
+    """
+    Assign feature rows to the nearest of a few cluster centers
 
-    indices = calculate_vegetation_indices(r, g, b)
+    Same labels as MeanShift.predict, but the lookup goes through a KD-tree over
+    the centers, so it can be fed through predict_cluster_labels chunk by chunk.
+    """
 
-    # Feature vector
-    features = np.stack([
-        r.flatten(),
-        g.flatten(),
-        b.flatten(),
-        indices['exg'].flatten(),
-        indices['exgr'].flatten(),
-        indices['ndi'].flatten(),
-        indices['vari'].flatten(),
-        indices['grvi'].flatten(),
-        indices['rgbvi'].flatten()
-    ], axis=1)
+    def __init__(self, cluster_centers):
+        from scipy.spatial import cKDTree
 
-    # Normalize
-    features_normalized = features.copy()
-    features_normalized[:, 0:3] = features[:, 0:3] / 255.0
-    features_normalized[:, 3:] = features[:, 3:] * 2.0
+        self.cluster_centers_ = np.asarray(cluster_centers)
+        self._tree = cKDTree(self.cluster_centers_)
 
-    # Filter valid pixels
-    valid_mask = (features[:, 0] > 10) & (features[:, 0] < 245) & \
-                 (features[:, 1] > 10) & (features[:, 1] < 245) & \
-                 (features[:, 2] > 10) & (features[:, 2] < 245)
+    def predict(self, features):
+        _, labels = self._tree.query(features, k=1)
+        return labels
 
-    valid_features = features_normalized[valid_mask]
 
-    # Subsample for speed (Mean Shift is slow)
-    sample_size = min(10000, len(valid_features))
-    sample_indices = np.random.choice(len(valid_features), sample_size, replace=False)
-    sample_features = valid_features[sample_indices]
+def _bandwidth_cache_path():
+    if not Config.BANDWIDTH_CACHE_FILE:
+        return None
+    return os.path.join(Config.OUTPUT_DIR, Config.BANDWIDTH_CACHE_FILE)
+
+
+def meanshift_bandwidth(sample_features, quantile=0.2, n_samples=2000):
+    """
+    Estimate the Mean Shift bandwidth, reusing a cached value when possible
+
+    The cache key hashes the fit sample together with the estimation parameters,
+    so the same orthophoto and settings skip estimate_bandwidth on repeat runs
+    while any change to the data or parameters estimates afresh.
+    """
+    from sklearn.cluster import estimate_bandwidth
+
+    key = hashlib.sha1(np.ascontiguousarray(sample_features).tobytes())
+    key.update(f"{sample_features.shape}|{quantile}|{n_samples}".encode())
+    key = key.hexdigest()
+
+    cache_path = _bandwidth_cache_path()
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+    if key in cache:
+        print(f"   Cached bandwidth: {cache[key]:.3f}")
+        return cache[key]
+
+    print("   Estimating bandwidth for Mean Shift...")
+    bandwidth = float(estimate_bandwidth(sample_features, quantile=quantile, n_samples=n_samples))
+    print(f"   Estimated bandwidth: {bandwidth:.3f}")
+
+    if cache_path:
+        cache[key] = bandwidth
+        ensure_output_dir()
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(temp_path, cache_path)  # atomic, concurrent analyses may share the file
+
+    return bandwidth
+
+
+def fit_meanshift(sample_features, bandwidth=None):
+    """Fit Mean Shift on a pixel sample; returns a NearestCentroidLabeler over its cluster centers"""
+    from sklearn.cluster import MeanShift
 
-    # Estimate bandwidth if not provided
     if bandwidth is None:
-        print("   Estimating bandwidth for Mean Shift...")
-        bandwidth = estimate_bandwidth(sample_features, quantile=0.2, n_samples=2000)
-        print(f"   Estimated bandwidth: {bandwidth:.3f}")
+        bandwidth = meanshift_bandwidth(sample_features)
 
-    # Mean Shift clustering
     print(f"   Running Mean Shift (bandwidth={bandwidth:.3f})...")
     ms = MeanShift(bandwidth=bandwidth, bin_seeding=True, n_jobs=-1)
     ms.fit(sample_features)
 
-    # Predict all valid pixels
-    labels = np.full(len(features), -1)
-    labels[valid_mask] = ms.predict(valid_features)
-    labels = labels.reshape(h, w)
+    return NearestCentroidLabeler(ms.cluster_centers_)
 
-    centroids = ms.cluster_centers_
 
-    # Denormalize centroids
-    centroids_denorm = centroids.copy()
-    centroids_denorm[:, 0:3] = centroids[:, 0:3] * 255.0
-    centroids_denorm[:, 3:] = centroids[:, 3:] / 2.0
+def detect_bare_soil_meanshift(r, g, b, bandwidth=None, indices=None, chunk_size=None):
+    """
+    Detect bare soil using Mean Shift clustering
 
-    # Identify soil cluster
-    soil_scores = []
-    for i, centroid_norm in enumerate(centroids):
-        r_val = centroid_norm[0] * 255
-        g_val = centroid_norm[1] * 255
-        b_val = centroid_norm[2] * 255
+    Mean Shift is fitted on a stratified sample; every pixel is then labelled
+    with its nearest cluster center in chunks of chunk_size pixels (default
+    Config.PREDICT_CHUNK_SIZE). The estimated bandwidth is cached, see
+    meanshift_bandwidth.
+    """
+    h, w = r.shape
+
+    if indices is None:
+        indices = calculate_vegetation_indices(r, g, b)
 
-        exg_val = centroid_norm[3] / 2.0
-        exgr_val = centroid_norm[4] / 2.0
-        vari_val = centroid_norm[6] / 2.0
+    # Subsample for speed (Mean Shift is slow) - spatially stratified
+    sample_features = sample_cluster_features(r, g, b, indices, sample_size=10000)
 
-        rgb_soil_score = (r_val - g_val) + (r_val - b_val) + (g_val - b_val) * 0.5
-        veg_indices_score = -(exg_val + exgr_val + vari_val) * 100
+    # Mean Shift clustering (bandwidth estimated or taken from the cache if not provided)
+    labeler = fit_meanshift(sample_features, bandwidth=bandwidth)
 
-        brightness = (r_val + g_val + b_val) / 3
-        brightness_bonus = 30 if 80 < brightness < 180 else 0
+    # Label all valid pixels by nearest cluster center
+    labels = predict_cluster_labels(labeler, r, g, b, indices, chunk_size=chunk_size).reshape(h, w)
 
-        soil_score = rgb_soil_score + veg_indices_score + brightness_bonus
-        soil_scores.append(soil_score)
+    centroids = labeler.cluster_centers_
 
+    # Denormalize centroids
+    centroids_denorm = denormalize_centroids(centroids)
+
+    # Identify soil cluster
+    soil_scores = score_soil_centroids(centroids)
     soil_cluster = np.argmax(soil_scores)
     bare_soil_mask = (labels == soil_cluster)
 
     # Morphological cleanup
-    bare_soil_mask = morphology.binary_opening(bare_soil_mask, morphology.disk(2))
-    bare_soil_mask = morphology.binary_closing(bare_soil_mask, morphology.disk(3))
+    bare_soil_mask = clean_mask(bare_soil_mask, [('open', 2), ('close', 3)], Config.MORPHOLOGY_TILE_SIZE)
 
     return bare_soil_mask, labels, centroids_denorm
 
 
 
+# ================================
+# DETECTOR REGISTRY
+# ================================
+# Each detector takes (r, g, b, indices) and returns (bare_soil_mask, labels, centroids).
+# Cost model: seconds = base_seconds + seconds_per_mpx * Mpx and
+# memory_mb = base_memory_mb + memory_mb_per_mpx * Mpx (RSS growth, lazily imported libraries
+# included), calibrated on the 107 / 109 sample orthophotos (1.9 / 4.4 Mpx). rank orders
+# methods by preference (1 = best).
+# indices lists the vegetation indices the detector reads.
+DETECTORS = {
+    'kmeans': {
+        'detect': lambda r, g, b, indices: detect_bare_soil_kmeans(r, g, b, n_clusters=4, indices=indices,
+                                                                    sample_size=Config.KMEANS_SAMPLE_SIZE),
+        'indices': CLUSTER_INDEX_NAMES,
+        'rank': 1,
+        'base_seconds': 5.6, 'seconds_per_mpx': 0.45,
+        'base_memory_mb': 90, 'memory_mb_per_mpx': 150
+    },
+    'slic': {
+        'detect': lambda r, g, b, indices: detect_bare_soil_slic(r, g, b, n_segments=1000, compactness=10,
+                                                                  indices=indices),
+        'indices': ('exg', 'ndi', 'vari'),
+        'rank': 2,
+        'base_seconds': 0.4, 'seconds_per_mpx': 0.85,
+        'base_memory_mb': 25, 'memory_mb_per_mpx': 130
+    },
+    'meanshift': {
+        'detect': lambda r, g, b, indices: detect_bare_soil_meanshift(r, g, b, bandwidth=None, indices=indices),
+        'indices': CLUSTER_INDEX_NAMES,
+        'rank': 3,
+        'base_seconds': 0.6, 'seconds_per_mpx': 0.15,
+        'base_memory_mb': 215, 'memory_mb_per_mpx': 30
+    },
+    'dbscan': {
+        'detect': lambda r, g, b, indices: detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30,
+                                                                    indices=indices),
+        'indices': ('exg', 'ndi', 'vari'),
+        'rank': 4,
+        'base_seconds': 8.4, 'seconds_per_mpx': 0.8,
+        'base_memory_mb': 90, 'memory_mb_per_mpx': 145
+    }
+}
+
+
+def estimate_detector_cost(method, n_pixels):
+    """Predicted (seconds, memory_mb) of a registered detector on n_pixels pixels"""
+    spec = DETECTORS[method]
+    mpx = n_pixels / 1e6
+    return (spec['base_seconds'] + spec['seconds_per_mpx'] * mpx,
+            spec['base_memory_mb'] + spec['memory_mb_per_mpx'] * mpx)
+
+
+def select_detector(method, n_pixels, time_budget=None, memory_budget=None, candidates=None,
+                    memory_pixels=None, max_downsample=None):
+    """
+    Pick the detector and decimation factor that fit a time / memory budget
+
+    method='auto' considers the candidates (default: every registered detector)
+    by rank; any other method is tried first and the rest follow by rank. The
+    first candidate that fits at full resolution wins; otherwise the one that fits
+    with the smallest downsample factor (up to max_downsample, default
+    Config.MAX_DOWNSAMPLE). memory_pixels overrides the pixel count used for the
+    memory estimate (windowed runs only hold one tile).
+
+    Returns (method, downsample).
+    """
+    candidates = sorted(candidates or DETECTORS, key=lambda name: DETECTORS[name]['rank'])
+    if method in candidates:
+        candidates.remove(method)
+        candidates.insert(0, method)
+
+    if time_budget is None and memory_budget is None:
+        return candidates[0], 1
+
+    max_downsample = max_downsample or Config.MAX_DOWNSAMPLE
+    memory_pixels = memory_pixels or n_pixels
+
+    def fits(name, factor):
+        seconds, _ = estimate_detector_cost(name, n_pixels / factor ** 2)
+        _, memory_mb = estimate_detector_cost(name, memory_pixels / factor ** 2)
+        return ((time_budget is None or seconds <= time_budget) and
+                (memory_budget is None or memory_mb <= memory_budget))
+
+    for factor in range(1, max_downsample + 1):
+        for name in candidates:
+            if fits(name, factor):
+                return name, factor
+
+    print(f"⚠️ No detector fits the budget; using {candidates[0].upper()} at 1/{max_downsample} resolution")
+    return candidates[0], max_downsample
+
+
+def _current_rss():
+    """Resident set size of the process in bytes (psutil where /proc is unavailable, else None)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def _max_rss():
+    """High-water mark of the process's resident set size in bytes (None without the resource module)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def measure_stage(func, interval=0.05):
+    """
+    Call func(), returning (result, seconds, peak_memory_mb)
+
+    peak_memory_mb is how far the resident set size rose above its value at the
+    start of the stage: a background thread samples it every interval seconds,
+    and a new process high-water mark (getrusage) reached during the stage
+    catches spikes between samples. Nothing is reset, so concurrent stages never
+    disturb each other's measurement, though their allocations add to it.
+
+    Where the current RSS cannot be read (no /proc and no psutil) only the
+    growth of the high-water mark is reported, which is 0 for a stage that
+    stays below an earlier peak; without getrusage either it is None.
+    """
+    memory_before = _current_rss()
+    max_before = _max_rss()
+    memory_peak = memory_before
+    done = threading.Event()
+
+    def sample():
+        nonlocal memory_peak
+        while not done.wait(interval):
+            memory_peak = max(memory_peak, _current_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True) if memory_before is not None else None
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+
+    try:
+        result = func()
+    finally:
+        seconds = time.perf_counter() - start
+        if sampler:
+            done.set()
+            sampler.join()
+            memory_peak = max(memory_peak, _current_rss())
+        max_after = _max_rss()
+
+    if memory_before is not None:
+        if max_before is not None and max_after > max_before:
+            memory_peak = max(memory_peak, max_after)
+        return result, seconds, (memory_peak - memory_before) / 1e6
+    if max_before is not None:
+        return result, seconds, (max_after - max_before) / 1e6
+    return result, seconds, None
+
+
+def run_detector(method, r, g, b, indices, downsample=1):
+    """
+    Run a registered detector, measuring its wall time and peak memory
+
+    With downsample > 1 the detector sees every downsample-th pixel and its mask
+    and labels are scaled back up to the full resolution.
+
+    Returns (bare_soil_mask, labels, centroids, stats).
+    """
+    h, w = r.shape
+    n_pixels = -(-h // downsample) * -(-w // downsample)
+    predicted_seconds, predicted_memory_mb = estimate_detector_cost(method, n_pixels)
+
+    def detect():
+        if downsample == 1:
+            return DETECTORS[method]['detect'](r, g, b, indices)
+
+        r_small, g_small, b_small = (np.ascontiguousarray(band[::downsample, ::downsample]) for band in (r, g, b))
+        bare_soil_mask, labels, centroids = DETECTORS[method]['detect'](
+            r_small, g_small, b_small, calculate_vegetation_indices(r_small, g_small, b_small))
+        bare_soil_mask, labels = (
+            np.repeat(np.repeat(layer, downsample, axis=0), downsample, axis=1)[:h, :w]
+            for layer in (bare_soil_mask, labels)
+        )
+        return bare_soil_mask, labels, centroids
+
+    (bare_soil_mask, labels, centroids), seconds, peak_memory_mb = measure_stage(detect)
+
+    stats = {
+        'method': method,
+        'downsample': downsample,
+        'pixels': n_pixels,
+        'predicted_seconds': round(predicted_seconds, 2),
+        'predicted_memory_mb': round(predicted_memory_mb, 1),
+        'seconds': round(seconds, 2),
+        'peak_memory_mb': round(peak_memory_mb, 1) if peak_memory_mb is not None else None
+    }
+    peak = f"{stats['peak_memory_mb']:.0f} MB" if peak_memory_mb is not None else "unknown"
+    print(f"   ⏱️ {method.upper()}: {stats['seconds']:.2f}s (predicted {stats['predicted_seconds']:.2f}s), "
+          f"peak {peak} (predicted {stats['predicted_memory_mb']:.0f} MB)")
+
+    return bare_soil_mask, labels, centroids, stats
+
+
 # ================================
 # GAP DETECTION
 # ================================
-def create_gap_mask(indices, bare_soil_mask, approach='combined_improved'):
-    """Create gap mask using various approaches"""
+GAP_MASK_PERCENTILES = {'exg': 25, 'vari': 25, 'exgr': 20}
+
+
+def gap_mask_thresholds(indices=None, histograms=None, data_mask=None):
+    """
+    Percentile thresholds used by the 'combined_improved' gap mask
+
+    Answered from per-index histograms (see quantiles.py): built from indices
+    (over the data_mask pixels only, when given), or passed in ready-made, e.g.
+    accumulated tile by tile with index_histograms.
+    """
+    if histograms is None:
+        histograms = index_histograms(indices, list(GAP_MASK_PERCENTILES), mask=data_mask)
+    return {name: histograms[name].percentile(q) for name, q in GAP_MASK_PERCENTILES.items()}
+
+
+def create_gap_mask(indices, bare_soil_mask, approach='combined_improved', thresholds=None, data_mask=None):
+    """
+    Create gap mask using various approaches
+
+    thresholds optionally overrides the 'combined_improved' percentile thresholds
+    (see gap_mask_thresholds); windowed runs pass whole-orthophoto values here so
+    every tile is cut at the same level. data_mask (see read_data_mask) keeps
+    nodata pixels out of the 'combined_improved' thresholds and mask.
+    """
+    from skimage import morphology
+
     if approach == 'exg_adaptive':
-        threshold = np.percentile(indices['exg'], 25)
+        threshold = QuantileHistogram.for_index('exg').update(indices['exg']).percentile(25)
         return indices['exg'] < threshold
 
     elif approach == 'exgr':
-        threshold = np.percentile(indices['exgr'], 20)
+        threshold = QuantileHistogram.for_index('exgr').update(indices['exgr']).percentile(20)
         return indices['exgr'] < threshold
 
     elif approach == 'vari':
-        threshold = np.percentile(indices['vari'], 30)
+        threshold = QuantileHistogram.for_index('vari').update(indices['vari']).percentile(30)
         return indices['vari'] < threshold
 
     elif approach == 'kmeans':
         return bare_soil_mask
 
     elif approach == 'combined_improved':
+        if thresholds is None:
+            thresholds = gap_mask_thresholds(indices, data_mask=data_mask)
+
         # Combine multiple indices
-        exg_mask = indices['exg'] < np.percentile(indices['exg'], 25)
-        vari_mask = indices['vari'] < np.percentile(indices['vari'], 25)
-        exgr_mask = indices['exgr'] < np.percentile(indices['exgr'], 20)
+        exg_mask = indices['exg'] < thresholds['exg']
+        vari_mask = indices['vari'] < thresholds['vari']
+        exgr_mask = indices['exgr'] < thresholds['exgr']
 
         combined_mask = bare_soil_mask | exg_mask | vari_mask | exgr_mask
 
         # Morphological cleanup
-        combined_mask = morphology.binary_opening(combined_mask, morphology.disk(1))
-        combined_mask = morphology.binary_closing(combined_mask, morphology.disk(2))
+        combined_mask = clean_mask(combined_mask, [('open', 1), ('close', 2)], Config.MORPHOLOGY_TILE_SIZE)
+        if data_mask is not None:
+            combined_mask &= data_mask
         combined_mask = morphology.remove_small_objects(combined_mask, min_size=2)
 
         return combined_mask
 
 
 # ================================
-# ORTHOPHOTO ANALYSIS
+# NODATA / ALPHA MASK
 # ================================
-def analyze_drone_images_rgb_only(image_paths):
+def read_data_mask(src, window=None, out_shape=None):
     """
-    Analyze drone RGB images without NIR
-    Uses RGB-based vegetation indices
+    Boolean mask of the orthophoto pixels that hold data
+
+    Read from the GDAL dataset mask, i.e. the alpha band of ODM orthophotos, the
+    nodata value or an internal mask (window / out_shape as in src.read).
+    Returns None when every pixel is valid or Config.USE_DATA_MASK is off.
     """
-    results = {
-        'total_images': len(image_paths),
-        'images': [],
-        'average_vegetation': 0
-    }
+    from rasterio.enums import MaskFlags
 
-    total_vegetation = 0
+    if not Config.USE_DATA_MASK or all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums[:3]):
+        return None
+    return src.dataset_mask(window=window, out_shape=out_shape) > 0
 
-    for image_path in image_paths:
-        try:
-            # Check file exists
-            if not os.path.exists(image_path):
-                results['images'].append({
-                    'filename': os.path.basename(image_path),
-                    'error': 'File not found'
-                })
-                continue
 
-            # Load image
-            img = cv2.imread(image_path)
-            if img is None:
-                results['images'].append({
-                    'filename': os.path.basename(image_path),
-                    'error': 'Failed to load image'
-                })
-                continue
+def blank_nodata(r, g, b, data_mask):
+    """
+    Zero the bands of nodata pixels in place
 
-            h, w = img.shape[:2]
+    Black pixels already fail valid_cluster_pixels (and the DBSCAN filter), so
+    clusterers never see nodata, whatever RGB the encoder left under the alpha
+    band (JPEG-compressed borders reach ~40).
+    """
+    if data_mask is None:
+        return
+    nodata = ~data_mask
+    for band in (r, g, b):
+        band[nodata] = 0
 
-            # Split channels (OpenCV uses BGR)
-            b, g, r = cv2.split(img)
 
-            # Calculate vegetation indices
-            indices = calculate_vegetation_indices(r, g, b)
+def report_data_mask(data_mask, n_pixels):
+    """Number of data pixels among n_pixels, printed along with their share when there is a data_mask"""
+    if data_mask is None:
+        return n_pixels
+    data_pixels = int(np.count_nonzero(data_mask))
+    print(f"🗺️ Data mask: {data_pixels:,} pixels ({data_pixels / data_mask.size * 100:.1f}%) hold data, "
+          f"nodata is skipped")
+    return data_pixels
 
-            # Create vegetation mask using combined approach
-            exg_threshold = np.percentile(indices['exg'], 75)
-            vari_threshold = np.percentile(indices['vari'], 70)
 
-            vegetation_mask = (indices['exg'] > exg_threshold) | (indices['vari'] > vari_threshold)
+# ================================
+# WINDOWED (BOUNDED-MEMORY) EXECUTION
+# ================================
+# Methods whose model can be fitted on a sample and then applied tile by tile
+WINDOWED_METHODS = ('kmeans', 'meanshift')
 
-            # Morphological cleanup
-            kernel = np.ones((3, 3), np.uint8)
-            vegetation_mask = cv2.morphologyEx(vegetation_mask.astype(np.uint8), cv2.MORPH_CLOSE, kernel)
-            vegetation_mask = cv2.morphologyEx(vegetation_mask, cv2.MORPH_OPEN, kernel)
+
+def _aligned_tile_size(size, block, limit):
+    """Round a tile size down to a multiple of the raster block size"""
+    if block >= limit:
+        return min(size, limit)
+    return max(block, size // block * block)
+
+
+def iter_raster_windows(src, window_size=None, halo=None):
+    """
+    Walk the raster in block-aligned tiles
+
+    Yields (core, read, offset): core is the tile written to the output, read is
+    core grown by `halo` pixels on every side (clipped to the raster) and offset is
+    the (row, col) position of core inside read.
+    """
+    from rasterio.windows import Window
+
+    window_size = window_size or Config.WINDOW_SIZE
+    halo = Config.WINDOW_HALO if halo is None else halo
+
+    block_h, block_w = src.block_shapes[0]
+    tile_h = _aligned_tile_size(window_size, block_h, src.height)
+    tile_w = _aligned_tile_size(window_size, block_w, src.width)
+
+    for row_off in range(0, src.height, tile_h):
+        for col_off in range(0, src.width, tile_w):
+            core_h = min(tile_h, src.height - row_off)
+            core_w = min(tile_w, src.width - col_off)
+
+            read_row = max(0, row_off - halo)
+            read_col = max(0, col_off - halo)
+            read_h = min(src.height, row_off + core_h + halo) - read_row
+            read_w = min(src.width, col_off + core_w + halo) - read_col
+
+            yield (Window(col_off, row_off, core_w, core_h),
+                   Window(read_col, read_row, read_w, read_h),
+                   (row_off - read_row, col_off - read_col))
+
+
+def sample_orthophoto_pixels(src, sample_size=None, seed=42, histogram_names=None):
+    """
+    Draw a seeded RGB pixel sample from the orthophoto in one windowed pass
+
+    Each tile contributes in proportion to its area, so memory is bounded by
+    sample_size. Orthophotos smaller than sample_size are returned whole.
+    Nodata pixels (read_data_mask) are left out and tiles without data are not
+    read at all.
+
+    With histogram_names, the same pass also histograms those indices over every
+    data pixel (see quantiles.py) and (r, g, b, histograms) is returned.
+    """
+    sample_size = sample_size or Config.WINDOW_SAMPLE_SIZE
+    fraction = min(1.0, sample_size / (src.height * src.width))
+    rng = np.random.default_rng(seed)
+
+    samples = []
+    histograms = None
+    for core, _, _ in iter_raster_windows(src, halo=0):
+        data_mask = read_data_mask(src, window=core)
+        if data_mask is not None and not data_mask.any():
+            continue
+
+        rgb = src.read([1, 2, 3], window=core)
+        if histogram_names:
+            histograms = index_histograms(calculate_vegetation_indices(*rgb), histogram_names, histograms,
+                                          mask=data_mask)
+        rgb = rgb.reshape(3, -1)
+        if data_mask is not None:
+            rgb = rgb[:, data_mask.ravel()]
+        if fraction < 1.0:
+            n_pixels = int(round(rgb.shape[1] * fraction))
+            rgb = rgb[:, np.sort(rng.choice(rgb.shape[1], n_pixels, replace=False))]
+        samples.append(rgb)
+
+    r, g, b = np.concatenate(samples, axis=1)
+    if histogram_names:
+        return r, g, b, histograms
+    return r, g, b
+
+
+def fit_windowed_soil_model(method, r, g, b, indices):
+    """
+    Fit the bare soil clusterer on a pixel sample
+
+    Returns (model, soil_cluster, centroids); model.predict() is then applied to
+    the build_cluster_features output of every tile.
+    """
+    from sklearn.cluster import KMeans
+
+    features_normalized, valid_mask = build_cluster_features(r, g, b, indices)
+    valid_features = features_normalized[valid_mask]
+
+    if method == 'meanshift':
+        sample_size = min(10000, len(valid_features))
+        sample_indices = np.random.default_rng(42).choice(len(valid_features), sample_size, replace=False)
+        model = fit_meanshift(valid_features[sample_indices])
+    else:
+        model = KMeans(n_clusters=4, random_state=42, n_init=10, max_iter=300).fit(valid_features)
+
+    centroids_normalized = model.cluster_centers_
+    soil_cluster = int(np.argmax(score_soil_centroids(centroids_normalized)))
+
+    return model, soil_cluster, denormalize_centroids(centroids_normalized)
+
+
+def build_gap_mask_windowed(src, method, gap_mask_path):
+    """
+    Build the gap mask tile by tile into a disk-backed array
+
+    Pass 1 histograms the gap indices of every tile to fix the gap percentile
+    thresholds for the whole image, and samples pixels to fit the clusterer.
+    Pass 2 reads every tile plus its halo,
+    computes indices, soil mask and gap mask for it and writes the core into a
+    np.memmap at gap_mask_path. Peak memory follows Config.WINDOW_SIZE instead
+    of the orthophoto size. Tiles whose core holds no data (read_data_mask) are
+    skipped in both passes and stay empty in the gap mask.
+
+    Returns (gap_mask, soil_percentage, centroids, tile_stats).
+    """
+    print(f"   🧩 Pass 1: sampling up to {Config.WINDOW_SAMPLE_SIZE:,} pixels...")
+    r, g, b, histograms = sample_orthophoto_pixels(src, histogram_names=list(GAP_MASK_PERCENTILES))
+    thresholds = gap_mask_thresholds(histograms=histograms)
+    indices = calculate_vegetation_indices(r, g, b)
+    model, soil_cluster, centroids = fit_windowed_soil_model(method, r, g, b, indices)
+    del r, g, b, indices
+
+    gap_mask = np.memmap(gap_mask_path, dtype=bool, mode='w+', shape=(src.height, src.width))
+    soil_pixels = 0
+    tile_stats = {'tiles': 0, 'empty_tiles': 0, 'data_pixels': 0}
+
+    print("   🧩 Pass 2: building gap mask tile by tile...")
+    for core, read, (dy, dx) in iter_raster_windows(src):
+        core_rows = slice(dy, dy + core.height)
+        core_cols = slice(dx, dx + core.width)
+        tile_stats['tiles'] += 1
+
+        data_mask = read_data_mask(src, window=read)
+        core_data_pixels = core.height * core.width if data_mask is None else \
+            int(np.count_nonzero(data_mask[core_rows, core_cols]))
+        if core_data_pixels == 0:
+            # Nothing to detect; the memmap is created zero-filled
+            tile_stats['empty_tiles'] += 1
+            continue
+        tile_stats['data_pixels'] += core_data_pixels
+
+        r, g, b = src.read([1, 2, 3], window=read)
+        blank_nodata(r, g, b, data_mask)
+        indices = calculate_vegetation_indices(r, g, b)
+
+        features_normalized, valid_mask = build_cluster_features(r, g, b, indices)
+        labels = np.full(len(features_normalized), -1)
+        if np.any(valid_mask):
+            labels[valid_mask] = model.predict(features_normalized[valid_mask])
+        del features_normalized
+
+        bare_soil_mask = labels.reshape(r.shape) == soil_cluster
+        bare_soil_mask = clean_mask(bare_soil_mask, [('open', 2), ('close', 3)])
+
+        tile_gap_mask = create_gap_mask(indices, bare_soil_mask, 'combined_improved', thresholds, data_mask)
+
+        gap_mask[core.row_off:core.row_off + core.height,
+                 core.col_off:core.col_off + core.width] = tile_gap_mask[core_rows, core_cols]
+        soil_pixels += int(np.sum(bare_soil_mask[core_rows, core_cols]))
+
+    gap_mask.flush()
+    soil_percentage = soil_pixels / (src.height * src.width) * 100
+    if tile_stats['empty_tiles']:
+        print(f"   ⏭️ Skipped {tile_stats['empty_tiles']} of {tile_stats['tiles']} tiles without data")
+
+    return gap_mask, soil_percentage, centroids, tile_stats
+
+
+# ================================
+# ROW INDEXING
+# ================================
+# Per-process state of the row indexing pool (see _init_row_index_worker)
+_ROW_INDEX_WORKER = {}
+
+
+def _index_row_gap_tile(shapes, transform, gap_mask, core):
+    """Burn all rows into one tile and return the (row_index, y, x) of gap pixels on rows"""
+    from rasterio import windows
+    from rasterio.features import rasterize
+
+    row_raster = rasterize(
+        shapes,
+        out_shape=(core.height, core.width),
+        transform=windows.transform(core, transform),
+        fill=0,
+        dtype='int32'
+    )
+    tile_gaps = gap_mask[core.row_off:core.row_off + core.height,
+                         core.col_off:core.col_off + core.width]
+
+    tile_y, tile_x = np.nonzero((row_raster > 0) & tile_gaps)
+    return row_raster[tile_y, tile_x] - 1, tile_y + core.row_off, tile_x + core.col_off
+
+
+def _init_row_index_worker(shapes, transform, mask_spec):
+    """Process pool initializer: attach to the shared gap mask and keep the row shapes"""
+    kind, name, shape = mask_spec
+    if kind == 'memmap':
+        gap_mask = np.memmap(name, dtype=bool, mode='r', shape=shape)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        gap_mask = np.ndarray(shape, dtype=bool, buffer=shm.buf)
+        _ROW_INDEX_WORKER['shm'] = shm
+
+    _ROW_INDEX_WORKER.update(shapes=shapes, transform=transform, gap_mask=gap_mask)
+
+
+def _index_row_gap_tile_worker(core):
+    state = _ROW_INDEX_WORKER
+    return _index_row_gap_tile(state['shapes'], state['transform'], state['gap_mask'], core)
+
+
+def _index_row_gap_tiles_parallel(shapes, transform, gap_mask, tiles, workers):
+    """
+    Run _index_row_gap_tile over a process pool
+
+    Workers read the gap mask without copying it: a disk-backed memmap (windowed
+    mode) is reopened by path, an in-memory mask is placed in shared memory once.
+    Results come back in tile order, so the merge is identical to the serial path.
+    """
+    shm = None
+    if isinstance(gap_mask, np.memmap):
+        gap_mask.flush()
+        mask_spec = ('memmap', gap_mask.filename, gap_mask.shape)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=max(1, gap_mask.size))
+        np.ndarray(gap_mask.shape, dtype=bool, buffer=shm.buf)[:] = gap_mask
+        mask_spec = ('shm', shm.name, gap_mask.shape)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_row_index_worker,
+                                 initargs=(shapes, transform, mask_spec)) as pool:
+            return list(pool.map(_index_row_gap_tile_worker, tiles))
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+def _row_shapes(rows):
+    """(geometry, value) pairs burning rows.iloc[i] as i + 1"""
+    return [(geom, i + 1) for i, geom in enumerate(rows.geometry)
+            if geom is not None and not geom.is_empty]
+
+
+def rasterize_rows(src, rows):
+    """
+    Full-frame int32 row-index raster (i + 1 for rows.iloc[i], 0 off rows)
+
+    Lets several gap masks of the same orthophoto share one rasterization, see
+    index_row_gap_pixels(row_raster=...).
+    """
+    from rasterio.features import rasterize
+
+    shapes = _row_shapes(rows)
+    if not shapes:
+        return np.zeros((src.height, src.width), dtype=np.int32)
+    return rasterize(shapes, out_shape=(src.height, src.width), transform=src.transform, fill=0, dtype='int32')
+
+
+def index_row_gap_pixels(src, rows, gap_mask, workers=1, row_raster=None):
+    """
+    Find the gap pixels lying on each row footprint
+
+    All row geometries are burned once per tile into an integer row-index raster
+    (value i + 1 for rows.iloc[i]) instead of one full-frame rasterization per
+    row. Where two footprints overlap, the pixel goes to the row burned last.
+    With workers > 1 the tiles are spread over a process pool. A precomputed
+    rasterize_rows() raster can be passed as row_raster to skip rasterization.
+
+    Returns (row_index, y, x) arrays of gap pixels; row_index is 0-based.
+    """
+    if row_raster is not None:
+        ys, xs = np.nonzero((row_raster > 0) & gap_mask)
+        return row_raster[ys, xs] - 1, ys, xs
+
+    shapes = _row_shapes(rows)
+    tiles = [core for core, _, _ in iter_raster_windows(src, halo=0)]
+    workers = min(workers or 1, len(tiles))
+
+    if not shapes:
+        results = []
+    elif workers > 1:
+        results = _index_row_gap_tiles_parallel(shapes, src.transform, gap_mask, tiles, workers)
+    else:
+        results = [_index_row_gap_tile(shapes, src.transform, gap_mask, core) for core in tiles]
+
+    if not results:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    row_index, ys, xs = zip(*results)
+    return np.concatenate(row_index), np.concatenate(ys), np.concatenate(xs)
+
+
+def extract_row_gap_components(row_index, ys, xs, height, width):
+    """
+    Label and measure 8-connected gap components on sparse row pixels
+
+    Equivalent to measure.label(connectivity=2) + measure.regionprops on each
+    row's gap mask, but components never join two rows and the cost depends only
+    on the number of gap pixels on rows, not on the orthophoto size. Components
+    are sorted by row and, within a row, in raster-scan order of their first
+    pixel, like regionprops.
+
+    Returns a dict of per-component arrays: row_index, area, centroid_row,
+    centroid_col and the regionprops-style bbox (min_row, min_col, max_row,
+    max_col; max bounds exclusive).
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n_pixels = len(ys)
+    if n_pixels == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return {'row_index': empty, 'area': empty,
+                'centroid_row': empty.astype(float), 'centroid_col': empty.astype(float),
+                'min_row': empty, 'min_col': empty, 'max_row': empty, 'max_col': empty}
+
+    # One sortable key per pixel: row first, then raster order
+    keys = (row_index.astype(np.int64) * height + ys) * width + xs
+    order = np.argsort(keys, kind='stable')
+    keys, row_index, ys, xs = keys[order], row_index[order], ys[order], xs[order]
+
+    # Link every pixel to its forward 8-neighbours within the same row
+    edge_from, edge_to = [], []
+    for dy, dx in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        inside = (xs + dx >= 0) & (xs + dx < width) & (ys + dy < height)
+        neighbour_keys = keys + dy * width + dx
+        pos = np.minimum(np.searchsorted(keys, neighbour_keys), n_pixels - 1)
+        linked = inside & (keys[pos] == neighbour_keys)
+        edge_from.append(np.nonzero(linked)[0])
+        edge_to.append(pos[linked])
+
+    edge_from = np.concatenate(edge_from)
+    edge_to = np.concatenate(edge_to)
+    graph = coo_matrix((np.ones(len(edge_from), dtype=np.int8), (edge_from, edge_to)),
+                       shape=(n_pixels, n_pixels))
+    n_components, labels = connected_components(graph, directed=False)
+
+    # Renumber components in order of their first (lowest-key) pixel
+    _, first_pixel = np.unique(labels, return_index=True)
+    rank = np.empty(n_components, dtype=np.int64)
+    rank[np.argsort(first_pixel)] = np.arange(n_components)
+    component = rank[labels]
+
+    by_component = np.argsort(component, kind='stable')
+    area = np.bincount(component, minlength=n_components)
+    starts = np.concatenate([[0], np.cumsum(area)[:-1]])
+    ys_sorted, xs_sorted = ys[by_component], xs[by_component]
+
+    return {
+        'row_index': row_index[by_component][starts],
+        'area': area,
+        'centroid_row': np.bincount(component, weights=ys, minlength=n_components) / area,
+        'centroid_col': np.bincount(component, weights=xs, minlength=n_components) / area,
+        'min_row': np.minimum.reduceat(ys_sorted, starts),
+        'min_col': np.minimum.reduceat(xs_sorted, starts),
+        'max_row': np.maximum.reduceat(ys_sorted, starts) + 1,
+        'max_col': np.maximum.reduceat(xs_sorted, starts) + 1
+    }
+
+
+# ================================
+# GAP MEASUREMENT
+# ================================
+GAP_TABLE_FIELDS = (
+    'row_id', 'gap_id', 'centroid_lon', 'centroid_lat', 'area_pixels', 'area_sqm',
+    'width_meters', 'height_meters', 'bbox_lon_min', 'bbox_lat_min', 'bbox_lon_max', 'bbox_lat_max'
+)
+
+
+def measure_gaps(components, row_ids, transform):
+    """
+    Turn row gap components into a columnar gap table
+
+    Keeps components within Config.MIN/MAX_GAP_AREA_PIXELS, numbers them per row
+    and computes geographic centroids, bbox corners, widths, heights and areas for
+    all gaps at once. Returns a dict of arrays keyed by GAP_TABLE_FIELDS plus
+    'row_index' (position of the row in the rows file). Shapely geometries are
+    only built at export time.
+    """
+    area = components['area']
+    keep = (area >= Config.MIN_GAP_AREA_PIXELS) & (area <= Config.MAX_GAP_AREA_PIXELS)
+    row_index = components['row_index'][keep]
+
+    # Components are grouped by row, so the gap number is the offset from the row's first gap
+    positions = np.arange(len(row_index))
+    gap_id = positions - np.searchsorted(row_index, row_index) + 1
+
+    def to_geographic(cols, rows):
+        return (cols * transform.a + rows * transform.b + transform.c,
+                cols * transform.d + rows * transform.e + transform.f)
+
+    centroid_lon, centroid_lat = to_geographic(components['centroid_col'][keep], components['centroid_row'][keep])
+    lon_min, lat_max = to_geographic(components['min_col'][keep], components['min_row'][keep])
+    lon_max, lat_min = to_geographic(components['max_col'][keep], components['max_row'][keep])
+
+    width_meters = calculate_distance_meters(lat_min, lon_min, lat_min, lon_max)
+    height_meters = calculate_distance_meters(lat_min, lon_min, lat_max, lon_min)
+
+    return {
+        'row_index': row_index,
+        'row_id': np.asarray(row_ids)[row_index],
+        'gap_id': gap_id,
+        'centroid_lon': centroid_lon,
+        'centroid_lat': centroid_lat,
+        'area_pixels': area[keep],
+        'area_sqm': width_meters * height_meters,
+        'width_meters': width_meters,
+        'height_meters': height_meters,
+        'bbox_lon_min': lon_min,
+        'bbox_lat_min': lat_min,
+        'bbox_lon_max': lon_max,
+        'bbox_lat_max': lat_max
+    }
+
+
+def gap_table_records(gap_table):
+    """Convert a columnar gap table into a list of plain-Python gap dicts"""
+    columns = [gap_table[name].tolist() for name in GAP_TABLE_FIELDS]
+    return [dict(zip(GAP_TABLE_FIELDS, values)) for values in zip(*columns)]
+
+
+# ================================
+# STAGE CACHE
+# ================================
+def open_stage_cache():
+    """StageCache under Config.OUTPUT_DIR, or None when Config.STAGE_CACHE_DIR is None"""
+    if not Config.STAGE_CACHE_DIR:
+        return None
+    return StageCache(os.path.join(Config.OUTPUT_DIR, Config.STAGE_CACHE_DIR),
+                      Config.STAGE_CACHE_MAX_MB * 1024 * 1024)
+
+
+def detection_cache_keys(cache, method, downsample=1):
+    """
+    (detect_key, gap_mask_key) of a method on Config.ORTHO_PATH
+
+    The detection key covers the orthophoto content and every setting the
+    detectors read; the gap mask key extends it with the gap mask parameters.
+    Downstream settings (MIN/MAX_GAP_AREA_PIXELS, reports) are not part of
+    either, so changing them reuses both stages.
+    """
+    detect_key = cache.key('detect', cache.file_hash(Config.ORTHO_PATH), method, downsample,
+                           Config.KMEANS_SAMPLE_SIZE, Config.SAMPLE_GRID_SIZE, Config.USE_DATA_MASK)
+    gap_mask_key = cache.key('gap_mask', detect_key, 'combined_improved', GAP_MASK_PERCENTILES)
+    return detect_key, gap_mask_key
+
+
+def cached_row_raster(cache, src, rows):
+    """rasterize_rows() result for Config.ORTHO_PATH / Config.ROWS_PATH, from the cache when possible"""
+    key = cache.key('row_raster', cache.file_hash(Config.ORTHO_PATH), cache.file_hash(Config.ROWS_PATH))
+    cached = cache.load(key)
+    if cached is not None:
+        print("♻️ Using cached row raster")
+        return cached['row_raster']
+
+    row_raster = rasterize_rows(src, rows)
+    cache.store(key, {'row_raster': row_raster})
+    return row_raster
+
+
+# ================================
+# ORTHOPHOTO ANALYSIS
+# ================================
+def analyze_drone_images_rgb_only(image_paths):
+    """
+    Analyze drone RGB images without NIR
+    Uses RGB-based vegetation indices
+    """
+    from skimage import measure
+
+    results = {
+        'total_images': len(image_paths),
+        'images': [],
+        'average_vegetation': 0
+    }
+
+    total_vegetation = 0
+
+    for image_path in image_paths:
+        try:
+            # Check file exists
+            if not os.path.exists(image_path):
+                results['images'].append({
+                    'filename': os.path.basename(image_path),
+                    'error': 'File not found'
+                })
+                continue
+
+            # Load image
+            img = cv2.imread(image_path)
+            if img is None:
+                results['images'].append({
+                    'filename': os.path.basename(image_path),
+                    'error': 'Failed to load image'
+                })
+                continue
+
+            h, w = img.shape[:2]
+
+            # Split channels (OpenCV uses BGR)
+            b, g, r = cv2.split(img)
+
+            # Calculate vegetation indices
+            indices = calculate_vegetation_indices(r, g, b)
+
+            # Create vegetation mask using combined approach
+            thresholds = index_percentiles(indices, {'exg': 75, 'vari': 70}, upper=True)
+            exg_threshold, vari_threshold = thresholds['exg'], thresholds['vari']
+
+            vegetation_mask = (indices['exg'] > exg_threshold) | (indices['vari'] > vari_threshold)
+
+            # Morphological cleanup
+            kernel = np.ones((3, 3), np.uint8)
+            vegetation_mask = cv2.morphologyEx(vegetation_mask.astype(np.uint8), cv2.MORPH_CLOSE, kernel)
+            vegetation_mask = cv2.morphologyEx(vegetation_mask, cv2.MORPH_OPEN, kernel)
             vegetation_mask = vegetation_mask > 0
 
             # Calculate vegetation percentage
@@ -814,8 +1921,108 @@ def analyze_drone_images_rgb_only(image_paths):
 
     return results
 
-def analyze_orthophoto(method='kmeans'):
-    """Main function for orthophoto gap detection with selectable clustering method"""
+def process_row_gaps(src, rows, gap_mask, method, workers=1, row_raster=None, transform=None):
+    """
+    Index, label and measure the gaps on every row, printing a per-row summary
+
+    row_raster optionally passes a shared rasterize_rows() raster (see
+    index_row_gap_pixels). For a gap mask on another grid than src (previews),
+    pass that grid's row_raster and transform. Returns (gap_table, gaps, row_summary).
+    """
+    h, w = gap_mask.shape
+    row_summary = []
+
+    # Process gaps
+    print("\n" + "=" * 80)
+    print(f"PROCESSING GAPS - {method.upper()} METHOD")
+    print("=" * 80)
+
+    if row_raster is None:
+        print(f"\n🧭 Indexing row footprints ({workers} workers)...")
+    row_pixels = index_row_gap_pixels(src, rows, gap_mask, workers, row_raster)
+    components = extract_row_gap_components(*row_pixels, h, w)
+    gap_table = measure_gaps(components, rows['row_id'].to_numpy(), transform or src.transform)
+    gaps = gap_table_records(gap_table)
+
+    components_per_row = np.bincount(components['row_index'], minlength=len(rows))
+    gap_starts = np.searchsorted(gap_table['row_index'], np.arange(len(rows) + 1))
+
+    for row_pos, row_id in enumerate(rows['row_id'].tolist()):
+        row_gaps = gaps[gap_starts[row_pos]:gap_starts[row_pos + 1]]
+
+        if components_per_row[row_pos] > 0:
+            print(f"🔍 Row {row_id}: {components_per_row[row_pos]} components found, {len(row_gaps)} significant gaps")
+
+        if len(row_gaps) > 0:
+            gap_coordinates = [{
+                'gap_id': gap['gap_id'],
+                'lon': gap['centroid_lon'],
+                'lat': gap['centroid_lat'],
+                'pixels': gap['area_pixels'],
+                'area_sqm': gap['area_sqm'],
+                'width_m': gap['width_meters'],
+                'height_m': gap['height_meters']
+            } for gap in row_gaps]
+
+            print(f"\n📍 ROW {row_id}:")
+            print(f"   🔢 Significant gaps: {len(row_gaps)}")
+            print(f"   📍 GPS coordinates:")
+
+            for gap_coord in gap_coordinates:
+                print(f"      Gap {gap_coord['gap_id']}: {gap_coord['lat']:.6f}°N, {gap_coord['lon']:.6f}°E "
+                      f"({gap_coord['pixels']} pixels, {gap_coord['area_sqm']:.1f} m²)")
+
+            row_summary.append({
+                'row_id': row_id,
+                'gap_count': len(row_gaps),
+                'gap_coordinates': gap_coordinates
+            })
+
+    return gap_table, gaps, row_summary
+
+
+def analyze_orthophoto(method='kmeans', windowed=False, workers=None, time_budget=None, memory_budget=None,
+                       preview=None):
+    """
+    Main function for orthophoto gap detection with selectable clustering method
+
+    method is a DETECTORS key or 'auto'. With a time_budget (seconds) or
+    memory_budget (MB) for bare soil detection (defaults Config.TIME_BUDGET_S /
+    Config.MEMORY_BUDGET_MB) the detector and decimation factor are picked by
+    select_detector; the predicted and measured cost end up in result['detector'].
+
+    windowed=True streams the orthophoto in Config.WINDOW_SIZE tiles (see
+    build_gap_mask_windowed) so multi-gigapixel orthophotos fit in memory. It
+    supports the K-means and Mean Shift methods and skips the debug figure,
+    which needs the full-frame rasters.
+
+    The debug figure is only rendered when Config.DEBUG_FIGURE is set, from
+    decimated rasters and optionally in the background (submit_debug_figure).
+
+    workers sets the number of processes used for row gap extraction
+    (default Config.N_WORKERS, serial when unset); results do not depend on it.
+
+    A list of methods runs them all in one go, see compare_orthophoto_methods.
+
+    preview=True (or an overview factor such as 8) returns a quick per-row gap
+    estimate from the overview pyramid instead, see preview_orthophoto.
+    """
+    import rasterio
+    import geopandas as gpd
+
+    if preview:
+        factor = Config.PREVIEW_FACTOR if preview is True else int(preview)
+        if not isinstance(method, str):
+            return {'methods': {m: preview_orthophoto(m, factor, time_budget, memory_budget)
+                                for m in dict.fromkeys(method)}}
+        return preview_orthophoto(method, factor, time_budget, memory_budget)
+
+    if not isinstance(method, str):
+        methods = list(dict.fromkeys(method))
+        if len(methods) > 1:
+            return compare_orthophoto_methods(methods, windowed=windowed, workers=workers)
+        method = methods[0]
+
     print("\n" + "=" * 80)
     print(f"ORTHOPHOTO GAP ANALYSIS - {method.upper()} METHOD")
     print("=" * 80)
@@ -831,9 +2038,7 @@ def analyze_orthophoto(method='kmeans'):
     # Load data
     print("\n📂 Loading orthophoto and rows...")
     src = rasterio.open(Config.ORTHO_PATH)
-    r, g, b = src.read(1), src.read(2), src.read(3)
     h, w = src.height, src.width
-    transform = src.transform
 
     rows = gpd.read_file(Config.ROWS_PATH)
     if 'row_id' not in rows.columns:
@@ -843,154 +2048,133 @@ def analyze_orthophoto(method='kmeans'):
     print(f"✅ Loaded {len(rows)} rows")
     print(f"📍 CRS: {src.crs}")
 
-    # Calculate vegetation indices
-    print("\n🧮 Calculating vegetation indices...")
-    indices = calculate_vegetation_indices(r, g, b)
-
-    # Select clustering method based on user choice
-    print(f"\n🎯 Using {method.upper()} clustering method...")
-
-    clustering_methods = {
-        'kmeans': lambda: detect_bare_soil_kmeans(r, g, b, n_clusters=4),
-        'dbscan': lambda: detect_bare_soil_dbscan(r, g, b, eps=0.12, min_samples=30),
-        'slic': lambda: detect_bare_soil_slic(r, g, b, n_segments=1000, compactness=10),
-        'meanshift': lambda: detect_bare_soil_meanshift(r, g, b, bandwidth=None)
-    }
-
-    if method not in clustering_methods:
+    if method != 'auto' and method not in DETECTORS:
         print(f"❌ Unknown method '{method}'. Using 'kmeans' as default.")
         method = 'kmeans'
 
-    try:
-        bare_soil_mask, labels, centroids = clustering_methods[method]()
-        soil_percentage = np.sum(bare_soil_mask) / bare_soil_mask.size * 100
-        print(f"✅ {method.upper()}: {soil_percentage:.1f}% bare soil detected")
-
-        if len(centroids) > 0:
-            print(f"📊 Found {len(centroids)} clusters")
-    except Exception as e:
-        print(f"❌ {method.upper()} failed: {e}")
-        print("🔄 Falling back to K-means...")
+    if windowed and method not in WINDOWED_METHODS + ('auto',):
+        print(f"⚠️ {method.upper()} has no windowed mode. Using 'kmeans' instead.")
         method = 'kmeans'
-        bare_soil_mask, labels, centroids = detect_bare_soil_kmeans(r, g, b, n_clusters=4)
-
-    # Create gap mask
-    final_gap_mask = create_gap_mask(indices, bare_soil_mask, 'combined_improved')
 
-    gaps = []
-    row_summary = []
+    # Pick the detector (and decimation) that fits the budget
+    time_budget = time_budget if time_budget is not None else Config.TIME_BUDGET_S
+    memory_budget = memory_budget if memory_budget is not None else Config.MEMORY_BUDGET_MB
+    if windowed:
+        # Only one tile plus the fit sample is in memory at a time; tiles are not decimated
+        tile_side = Config.WINDOW_SIZE + 2 * Config.WINDOW_HALO
+        method, downsample = select_detector(method, h * w, time_budget, memory_budget,
+                                             candidates=WINDOWED_METHODS,
+                                             memory_pixels=tile_side ** 2 + Config.WINDOW_SAMPLE_SIZE,
+                                             max_downsample=1)
+    else:
+        method, downsample = select_detector(method, h * w, time_budget, memory_budget)
 
     ensure_output_dir()
+    gap_mask_path = None
+    cache = None
+
+    if windowed:
+        print(f"\n🧩 Windowed mode: {Config.WINDOW_SIZE}px tiles, {Config.WINDOW_HALO}px halo")
+        print(f"\n🎯 Using {method.upper()} clustering method...")
+
+        fd, gap_mask_path = tempfile.mkstemp(suffix='_gap_mask.dat', dir=Config.OUTPUT_DIR)
+        os.close(fd)
+        (final_gap_mask, soil_percentage, centroids, tile_stats), seconds, peak_memory_mb = measure_stage(
+            lambda: build_gap_mask_windowed(src, method, gap_mask_path))
+        predicted_seconds, _ = estimate_detector_cost(method, h * w)
+        detector_stats = {
+            'method': method,
+            'downsample': 1,
+            'pixels': h * w,
+            'predicted_seconds': round(predicted_seconds, 2),
+            'seconds': round(seconds, 2),
+            'peak_memory_mb': round(peak_memory_mb, 1) if peak_memory_mb is not None else None,
+            'windowed': True,
+            **tile_stats
+        }
+        print(f"✅ {method.upper()}: {soil_percentage:.1f}% bare soil detected")
+    else:
+        r, g, b = src.read(1), src.read(2), src.read(3)
+        data_mask = read_data_mask(src)
+        blank_nodata(r, g, b, data_mask)
+        data_pixels = report_data_mask(data_mask, h * w)
+
+        # Calculate vegetation indices
+        print("\n🧮 Calculating vegetation indices...")
+        indices = calculate_vegetation_indices(r, g, b)
+
+        cache = open_stage_cache()
+        detection = gap_stage = None
+        if cache is not None:
+            detect_key, gap_mask_key = detection_cache_keys(cache, method, downsample)
+            detection, gap_stage = cache.load(detect_key), cache.load(gap_mask_key)
+
+        if detection is not None:
+            print(f"\n♻️ Using cached {method.upper()} detection")
+            bare_soil_mask, labels, centroids = detection['bare_soil_mask'], detection['labels'], detection['centroids']
+            soil_percentage, detector_stats = detection['soil_percentage'], detection['detector']
+            detector_stats['cached'] = True
+        else:
+            # Run the selected detector
+            print(f"\n🎯 Using {method.upper()} clustering method"
+                  + (f" at 1/{downsample} resolution..." if downsample > 1 else "..."))
+
+            try:
+                bare_soil_mask, labels, centroids, detector_stats = run_detector(method, r, g, b, indices, downsample)
+                soil_percentage = np.sum(bare_soil_mask) / bare_soil_mask.size * 100
+                print(f"✅ {method.upper()}: {soil_percentage:.1f}% bare soil detected")
+
+                if len(centroids) > 0:
+                    print(f"📊 Found {len(centroids)} clusters")
+
+                if cache is not None:
+                    cache.store(detect_key, {'bare_soil_mask': bare_soil_mask, 'labels': labels,
+                                             'centroids': np.asarray(centroids),
+                                             'soil_percentage': soil_percentage, 'detector': detector_stats})
+            except Exception as e:
+                print(f"❌ {method.upper()} failed: {e}")
+                print("🔄 Falling back to K-means...")
+                failed_method, method = method, 'kmeans'
+                bare_soil_mask, labels, centroids, detector_stats = run_detector(method, r, g, b, indices, downsample)
+                soil_percentage = np.sum(bare_soil_mask) / bare_soil_mask.size * 100
+                detector_stats['fallback_from'] = failed_method
+                gap_stage, cache = None, None
+
+        # Create gap mask
+        if gap_stage is not None:
+            final_gap_mask, thresholds = gap_stage['gap_mask'], gap_stage['thresholds']
+        else:
+            thresholds = gap_mask_thresholds(indices, data_mask=data_mask)
+            final_gap_mask = create_gap_mask(indices, bare_soil_mask, 'combined_improved', thresholds, data_mask)
+            if cache is not None:
+                cache.store(gap_mask_key, {'gap_mask': final_gap_mask, 'thresholds': thresholds})
+        detector_stats['data_pixels'] = data_pixels
 
-    # Process gaps
-    print("\n" + "=" * 80)
-    print(f"PROCESSING GAPS - {method.upper()} METHOD")
-    print("=" * 80)
-
-    for idx, row in rows.iterrows():
-        try:
-            mask = rasterize(
-                [(row.geometry, 1)],
-                out_shape=(h, w),
-                transform=transform,
-                fill=0,
-                dtype='uint8'
-            )
-
-            if np.sum(mask) == 0:
-                continue
-
-            row_gaps_mask = np.logical_and(final_gap_mask, mask == 1)
-            gap_labels = measure.label(row_gaps_mask, connectivity=2)
-            props = measure.regionprops(gap_labels)
-
-            row_gaps = []
-            gap_coordinates = []
-            total_components = len(props)
-            valid_components = 0
-
-            for prop in props:
-                if prop.area < Config.MIN_GAP_AREA_PIXELS or prop.area > Config.MAX_GAP_AREA_PIXELS:
-                    continue
-
-                valid_components += 1
-
-                centroid_row, centroid_col = prop.centroid
-                gap_lon, gap_lat = pixel_to_geographic(centroid_row, centroid_col, src.transform)
-
-                minr, minc, maxr, maxc = prop.bbox
-                lon_min, lat_max = src.transform * (minc, minr)
-                lon_max, lat_min = src.transform * (maxc, maxr)
-
-                width_meters = calculate_distance_meters(lat_min, lon_min, lat_min, lon_max)
-                height_meters = calculate_distance_meters(lat_min, lon_min, lat_max, lon_min)
-                area_sqm = width_meters * height_meters
-
-                poly = box(lon_min, lat_min, lon_max, lat_max)
-                gap_info = {
-                    'row_id': row.row_id,
-                    'gap_id': valid_components,
-                    'geometry': poly,
-                    'centroid_point': Point(gap_lon, gap_lat),
-                    'centroid_lon': gap_lon,
-                    'centroid_lat': gap_lat,
-                    'area_pixels': prop.area,
-                    'area_sqm': area_sqm,
-                    'width_meters': width_meters,
-                    'height_meters': height_meters,
-                    'bbox_lon_min': lon_min,
-                    'bbox_lat_min': lat_min,
-                    'bbox_lon_max': lon_max,
-                    'bbox_lat_max': lat_max
-                }
-                gaps.append(gap_info)
-                row_gaps.append(gap_info)
-                gap_coordinates.append({
-                    'gap_id': valid_components,
-                    'lon': gap_lon,
-                    'lat': gap_lat,
-                    'pixels': prop.area,
-                    'area_sqm': area_sqm,
-                    'width_m': width_meters,
-                    'height_m': height_meters
-                })
-
-            if total_components > 0:
-                print(f"🔍 Row {row.row_id}: {total_components} components found, {valid_components} significant gaps")
-
-            if len(row_gaps) > 0:
-                print(f"\n📍 ROW {row.row_id}:")
-                print(f"   🔢 Significant gaps: {len(row_gaps)}")
-                print(f"   📍 GPS coordinates:")
-
-                for gap_coord in gap_coordinates:
-                    print(f"      Gap {gap_coord['gap_id']}: {gap_coord['lat']:.6f}°N, {gap_coord['lon']:.6f}°E "
-                          f"({gap_coord['pixels']} pixels, {gap_coord['area_sqm']:.1f} m²)")
-
-                row_summary.append({
-                    'row_id': row.row_id,
-                    'gap_count': len(row_gaps),
-                    'gap_coordinates': gap_coordinates
-                })
+    detector_stats['time_budget_s'] = time_budget
+    detector_stats['memory_budget_mb'] = memory_budget
 
-        except Exception as e:
-            print(f"❌ Error processing row {row.row_id}: {e}")
-            continue
+    workers = workers or Config.N_WORKERS or 1
+    row_raster = cached_row_raster(cache, src, rows) if cache is not None else None
+    gap_table, gaps, row_summary = process_row_gaps(src, rows, final_gap_mask, method, workers, row_raster)
 
     # Save results
     if gaps:
         print(f"\n💾 Saving {method.upper()} results...")
-        save_orthophoto_reports(gaps, row_summary, rows, src.crs, method)
+        save_orthophoto_reports(gap_table, rows, src.crs, method)
         print(f"   ✅ {method.upper()}: {len(gaps)} gaps saved")
 
-    # Save debug visualization
-    save_debug_visualization(r, g, b, bare_soil_mask, labels, indices,
-                             'combined_improved', {method: {
-            'mask': bare_soil_mask,
-            'labels': labels,
-            'centroids': centroids,
-            'percentage': soil_percentage
-        }}, method)
+    debug_file = None
+    if windowed:
+        # Drop the disk-backed gap mask; the debug figure needs full-frame rasters
+        del final_gap_mask
+        os.remove(gap_mask_path)
+    elif Config.DEBUG_FIGURE:
+        figure = decimate_for_figure({'r': r, 'g': g, 'b': b, 'mask': bare_soil_mask, 'labels': labels,
+                                      **{name: indices[name] for name in ('exg', 'vari', 'exgr', 'ndi', 'rgbvi')}})
+        debug_file = submit_debug_figure(
+            save_debug_visualization, os.path.join(Config.OUTPUT_DIR, f'orthophoto_debug_{method}.png'),
+            figure.pop('r'), figure.pop('g'), figure.pop('b'), figure.pop('mask'), figure.pop('labels'), figure,
+            'combined_improved', method=method, thresholds=thresholds)
 
     print(f"\n🎉 FINAL RESULTS ({method.upper()}):")
     print(f"📊 Total gaps detected: {len(gaps)}")
@@ -1006,116 +2190,656 @@ def analyze_orthophoto(method='kmeans'):
         'detected_gaps': len(gaps),
         'total_gap_area_m2': sum(g['area_sqm'] for g in gaps) if gaps else 0,
         'rows_analyzed': len(rows),
-        'rows_with_gaps': len(row_summary)
+        'rows_with_gaps': len(row_summary),
+        'soil_percentage': soil_percentage,
+        'detector': detector_stats,
+        'debug_figure': debug_file
     }
 
-def save_orthophoto_reports(gaps, row_summary, rows, crs, method_name='kmeans'):
-    """Save detailed reports for orthophoto analysis"""
 
-    # Text summary
-    summary_file = os.path.join(Config.OUTPUT_DIR, f'orthophoto_summary_{method_name}.txt')
-    with open(summary_file, 'w', encoding='utf-8') as f:
-        f.write("╔" + "═" * 80 + "╗\n")
-        f.write("║" + " " * 20 + f"ORTHOPHOTO GAP ANALYSIS - {method_name.upper()}" + " " * (39 - len(method_name)) + "║\n")
-        f.write("╚" + "═" * 80 + "╝\n\n")
+def run_orthophoto_analysis(config, method='kmeans', **options):
+    """
+    Re-entrant orthophoto analysis with per-call settings
 
-        f.write(f"Method: {method_name.upper()}\n")
-        f.write(f"Total rows analyzed: {len(rows)}\n")
-        f.write(f"Rows with gaps: {len(row_summary)}\n")
-        f.write(f"Total gaps detected: {len(gaps)}\n")
-        f.write(f"Minimum gap size: {Config.MIN_GAP_AREA_PIXELS} pixels\n")
-        f.write(f"CRS: {crs}\n\n")
-
-        if row_summary:
-            total_area_sqm = sum(gap['area_sqm'] for gap in gaps)
-            avg_gaps_per_row = sum(r['gap_count'] for r in row_summary) / len(row_summary)
-
-            f.write("STATISTICS:\n")
-            f.write(f"• Average gaps per row: {avg_gaps_per_row:.1f}\n")
-            f.write(f"• Total gap area: {total_area_sqm:.1f} m²\n")
-            f.write(f"• Average gap area: {total_area_sqm / len(gaps):.1f} m²\n\n")
-
-            f.write("ROW DETAILS:\n")
-            for row_info in sorted(row_summary, key=lambda x: x['row_id']):
-                f.write(f"\nRow {row_info['row_id']}: {row_info['gap_count']} gaps\n")
-                for gap in row_info['gap_coordinates']:
-                    f.write(
-                        f"  Gap {gap['gap_id']}: {gap['lat']:.6f}°N, {gap['lon']:.6f}°E ({gap['area_sqm']:.1f} m²)\n")
-
-    # GeoJSON files
-    gdf = gpd.GeoDataFrame(gaps, crs=crs)
-    out_geojson = os.path.join(Config.OUTPUT_DIR, f'vineyard_gaps_detailed_{method_name}.geojson')
-    gdf.to_file(out_geojson, driver='GeoJSON')
-
-    # Gap centers
-    gap_points = [{
-        'row_id': gap['row_id'],
-        'gap_id': gap['gap_id'],
-        'geometry': gap['centroid_point'],
-        'lon': gap['centroid_lon'],
-        'lat': gap['centroid_lat'],
-        'pixels': gap['area_pixels'],
-        'area_sqm': gap['area_sqm']
-    } for gap in gaps]
-
-    gdf_points = gpd.GeoDataFrame(gap_points, crs=crs)
-    out_points = os.path.join(Config.OUTPUT_DIR, f'vineyard_gap_centers_{method_name}.geojson')
-    gdf_points.to_file(out_points, driver='GeoJSON')
+    config is a Config instance carrying the paths, thresholds and output
+    location of this analysis, e.g.
 
-    # CSV export
-    csv_file = os.path.join(Config.OUTPUT_DIR, f'orthophoto_gaps_{method_name}.csv')
-    with open(csv_file, 'w', encoding='utf-8') as f:
-        f.write("row_id,gap_id,latitude,longitude,area_pixels,area_sqm,width_m,height_m,google_maps_link\n")
-        for row_info in sorted(row_summary, key=lambda x: x['row_id']):
-            for gap in row_info['gap_coordinates']:
-                link = f"https://maps.google.com/?q={gap['lat']:.6f},{gap['lon']:.6f}"
-                f.write(f"{row_info['row_id']},{gap['gap_id']},{gap['lat']:.8f},{gap['lon']:.8f},"
-                        f"{gap['pixels']},{gap['area_sqm']:.1f},{gap['width_m']:.1f},{gap['height_m']:.1f},{link}\n")
+        run_orthophoto_analysis(Config(ortho_path=tif, rows_path=rows, min_gap_area_pixels=40), 'slic')
 
-    # JSON export
-    json_file = os.path.join(Config.OUTPUT_DIR, f'orthophoto_gaps_{method_name}.json')
-    json_data = {
-        'metadata': {
-            'method': method_name,
-            'total_rows': len(rows),
-            'rows_with_gaps': len(row_summary),
-            'total_gaps': len(gaps),
-            'min_area_pixels': Config.MIN_GAP_AREA_PIXELS,
-            'crs': str(crs)
+    Nothing global is modified, so analyses can run concurrently in one
+    process (e.g. from a thread pool; keep workers / N_WORKERS unset there, so
+    no process pools are started). Without an output_dir in config, each call writes into a new
+    job_* folder under the default OUTPUT_DIR, sharing its stage and overview caches.
+    options are passed on to analyze_orthophoto; the result gets an 'output_dir' key.
+    """
+    overrides = dict(vars(config))
+    if 'OUTPUT_DIR' not in overrides:
+        base_dir = os.path.abspath(Config.OUTPUT_DIR)
+        os.makedirs(base_dir, exist_ok=True)
+        overrides['OUTPUT_DIR'] = tempfile.mkdtemp(prefix='job_', dir=base_dir)
+        for name in ('STAGE_CACHE_DIR', 'PREVIEW_OVERVIEW_DIR'):
+            cache_dir = overrides.get(name, getattr(Config, name))
+            if cache_dir:
+                overrides[name] = os.path.join(base_dir, cache_dir)
+
+    job_config = Config(**overrides)
+    with job_config.activate():
+        result = analyze_orthophoto(method, **options)
+
+    if result is not None:
+        result['output_dir'] = job_config.OUTPUT_DIR
+    return result
+
+
+# ================================
+# PREVIEW (OVERVIEW PYRAMID)
+# ================================
+def _prune_overviews(overview_dir):
+    """Delete overview VRTs (and their .ovr) whose orthophoto no longer exists"""
+    import xml.etree.ElementTree as ElementTree
+
+    for name in os.listdir(overview_dir):
+        if not name.endswith('.vrt'):
+            continue
+        vrt_path = os.path.join(overview_dir, name)
+        try:
+            source = ElementTree.parse(vrt_path).findtext('.//SourceFilename')
+            if source and not os.path.exists(source):
+                for stale in (vrt_path, f"{vrt_path}.ovr"):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+        except (OSError, ElementTree.ParseError):
+            continue  # being written or removed by another analysis
+
+
+def ensure_overviews(path, levels=None):
+    """
+    Path to read the orthophoto at overview levels (default Config.PREVIEW_OVERVIEW_LEVELS) from
+
+    Existing overviews of the orthophoto are used as they are. Missing ones are
+    built once, with nearest resampling, for a VRT wrapper of the orthophoto in
+    Config.PREVIEW_OVERVIEW_DIR (an external .ovr next to the VRT). GDAL reads
+    the wrapper like the orthophoto itself; nothing is written next to the
+    orthophoto, so its folder and stage cache hash are left untouched. Wrappers
+    are named after the orthophoto's path, size and modification time, and
+    those whose orthophoto is gone are deleted on the next build.
+
+    Returns (path to read, whether overviews were built). Without an overview
+    directory, or when the overviews cannot be built, it is the orthophoto and
+    decimated reads fall back to resampling the full resolution.
+    """
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+
+    levels = sorted(levels or Config.PREVIEW_OVERVIEW_LEVELS)
+    with rasterio.open(path) as src:
+        if all(level in src.overviews(1) for level in levels):
+            return path, False
+        levels = [level for level in levels if level < min(src.height, src.width)]
+    if not levels or not Config.PREVIEW_OVERVIEW_DIR:
+        return path, False
+
+    overview_dir = os.path.join(Config.OUTPUT_DIR, Config.PREVIEW_OVERVIEW_DIR)
+    source = os.path.abspath(path)
+    stat = os.stat(source)
+    digest = hashlib.sha256(f"{source}\0{stat.st_size}\0{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    vrt_path = os.path.join(overview_dir, f"{os.path.splitext(os.path.basename(source))[0]}-{digest}.vrt")
+
+    if os.path.exists(vrt_path) and os.path.exists(f"{vrt_path}.ovr"):
+        with rasterio.open(vrt_path) as src:
+            if all(level in src.overviews(1) for level in levels):
+                return vrt_path, False
+
+    print(f"🏗️ Building overviews {levels} for {os.path.basename(path)}...")
+    temp_path = f"{vrt_path}.{os.getpid()}.{threading.get_ident()}.vrt"
+    try:
+        os.makedirs(overview_dir, exist_ok=True)
+        _prune_overviews(overview_dir)
+        rasterio.shutil.copy(source, temp_path, driver='VRT')
+        with rasterio.open(temp_path, 'r+') as dst:
+            dst.build_overviews(levels, Resampling.nearest)
+        # .ovr first: a VRT in place always has its overviews
+        os.replace(f"{temp_path}.ovr", f"{vrt_path}.ovr")
+        os.replace(temp_path, vrt_path)
+    except (rasterio.errors.RasterioError, OSError) as e:
+        print(f"⚠️ Could not build overviews ({e}); reading from full resolution")
+        for stale in (temp_path, f"{temp_path}.ovr"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        return path, False
+    return vrt_path, True
+
+
+def preview_orthophoto(method='kmeans', factor=None, time_budget=None, memory_budget=None):
+    """
+    Quick-look gap estimate from an overview level of the orthophoto
+
+    Reads the bands decimated by factor (default Config.PREVIEW_FACTOR) with a
+    rasterio out_shape read, which GDAL serves from the overview pyramid
+    (ensure_overviews). Then runs the same index / bare soil / gap mask / row
+    pipeline on it. Gap area limits are scaled to keep their ground size
+    (see below), while morphology radii stay in pixels, so gaps only a few
+    coarse pixels wide drop out. Nothing is written to OUTPUT_DIR apart from
+    the overview cache (Config.PREVIEW_OVERVIEW_DIR).
+
+    Returns the analyze_orthophoto result layout plus 'row_estimates' (gap
+    count and area for every row) and a 'preview' tag with the level used.
+    """
+    import rasterio
+    import geopandas as gpd
+    from rasterio.enums import Resampling
+    from rasterio.features import rasterize
+    from rasterio.transform import Affine
+
+    factor = factor or Config.PREVIEW_FACTOR
+    start = time.perf_counter()
+
+    print("\n" + "=" * 80)
+    print(f"ORTHOPHOTO GAP PREVIEW - {method.upper()} METHOD, 1/{factor} RESOLUTION")
+    print("=" * 80)
+
+    if not os.path.exists(Config.ORTHO_PATH):
+        print(f"❌ Orthophoto not found: {Config.ORTHO_PATH}")
+        return None
+
+    if not os.path.exists(Config.ROWS_PATH):
+        print(f"❌ Rows file not found: {Config.ROWS_PATH}")
+        return None
+
+    read_path, overviews_built = ensure_overviews(Config.ORTHO_PATH)
+
+    # Decimated read; the output size matches GDAL's overview size for this factor. Nearest (not
+    # average) keeps the pixel colour distribution, so clustering and percentile thresholds behave as
+    # at full resolution instead of seeing blended soil / vine / background colours
+    with rasterio.open(read_path) as src:
+        h, w = src.height, src.width
+        out_h, out_w = -(-h // factor), -(-w // factor)
+        r, g, b = src.read([1, 2, 3], out_shape=(3, out_h, out_w), resampling=Resampling.nearest)
+        data_mask = read_data_mask(src, out_shape=(out_h, out_w))
+        blank_nodata(r, g, b, data_mask)
+        transform = src.transform * Affine.scale(w / out_w, h / out_h)
+        overview_levels = src.overviews(1)
+
+        rows = gpd.read_file(Config.ROWS_PATH)
+        if 'row_id' not in rows.columns:
+            rows['row_id'] = range(1, len(rows) + 1)
+
+        print(f"✅ Read {out_w}x{out_h} pixels (orthophoto {w}x{h}, overviews {overview_levels})")
+
+        if method != 'auto' and method not in DETECTORS:
+            print(f"❌ Unknown method '{method}'. Using 'kmeans' as default.")
+            method = 'kmeans'
+        time_budget = time_budget if time_budget is not None else Config.TIME_BUDGET_S
+        memory_budget = memory_budget if memory_budget is not None else Config.MEMORY_BUDGET_MB
+        method, downsample = select_detector(method, out_h * out_w, time_budget, memory_budget)
+
+        indices = calculate_vegetation_indices(r, g, b)
+        bare_soil_mask, labels, centroids, detector_stats = run_detector(method, r, g, b, indices, downsample)
+        soil_percentage = np.sum(bare_soil_mask) / bare_soil_mask.size * 100
+        print(f"✅ {method.upper()}: {soil_percentage:.1f}% bare soil detected")
+
+        gap_mask = create_gap_mask(indices, bare_soil_mask, 'combined_improved', data_mask=data_mask)
+
+        shapes = _row_shapes(rows)
+        row_raster = (rasterize(shapes, out_shape=(out_h, out_w), transform=transform, fill=0, dtype='int32')
+                      if shapes else np.zeros((out_h, out_w), dtype=np.int32))
+
+        # Same minimum / maximum gap size on the ground at the coarser pixel size. Row lines burn one
+        # pixel wide at any resolution, so there a gap's pixel count is its length and shrinks by
+        # factor; polygon footprints shrink by factor² like any area
+        lines = rows.geom_type.isin(['LineString', 'MultiLineString']).all()
+        area_scale = factor if lines else factor ** 2
+        min_area = max(1, round(Config.MIN_GAP_AREA_PIXELS / area_scale))
+        max_area = max(min_area, round(Config.MAX_GAP_AREA_PIXELS / area_scale))
+        scaled = Config(**dict(Config.snapshot(), MIN_GAP_AREA_PIXELS=min_area, MAX_GAP_AREA_PIXELS=max_area))
+        with scaled.activate():
+            gap_table, gaps, row_summary = process_row_gaps(src, rows, gap_mask, method, row_raster=row_raster,
+                                                            transform=transform)
+
+    gap_counts = np.bincount(gap_table['row_index'], minlength=len(rows))
+    gap_areas = np.bincount(gap_table['row_index'], weights=gap_table['area_sqm'], minlength=len(rows))
+    row_estimates = [{'row_id': row_id, 'gap_count': int(count), 'gap_area_m2': round(float(area), 2)}
+                     for row_id, count, area in zip(rows['row_id'].tolist(), gap_counts, gap_areas)]
+
+    seconds = time.perf_counter() - start
+    print(f"\n🔎 PREVIEW RESULTS ({method.upper()}, 1/{factor} resolution, {seconds:.1f}s):")
+    print(f"📊 About {len(gaps)} gaps on {len(row_summary)} of {len(rows)} rows")
+
+    return {
+        'method': method,
+        'preview': {
+            'factor': factor,
+            'size': [out_w, out_h],
+            'overview_levels': overview_levels,
+            'overviews_built': overviews_built,
+            'min_gap_area_pixels': min_area,
+            'max_gap_area_pixels': max_area,
+            'seconds': round(seconds, 2)
         },
-        'rows': []
+        'gaps': gaps,
+        'row_summary': row_summary,
+        'row_estimates': row_estimates,
+        'total_rows': len(rows),
+        'detected_gaps': len(gaps),
+        'total_gap_area_m2': float(np.sum(gap_table['area_sqm'])),
+        'rows_analyzed': len(rows),
+        'rows_with_gaps': len(row_summary),
+        'soil_percentage': soil_percentage,
+        'detector': detector_stats
+    }
+
+
+# ================================
+# MULTI-METHOD COMPARISON
+# ================================
+# Per-process state of the detection pool (see _init_detection_worker)
+_DETECTION_WORKER = {}
+
+
+def _share_arrays(arrays):
+    """Copy named arrays into one shared memory block; returns (shm, spec) for _attach_arrays"""
+    layout, offset = [], 0
+    for name, array in arrays.items():
+        layout.append((name, array.dtype.str, array.shape, offset))
+        offset += array.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, offset))
+    for (name, dtype, shape, start), array in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = array
+
+    return shm, (shm.name, layout)
+
+
+def _attach_arrays(spec):
+    """Map the arrays of a _share_arrays block; returns (shm, {name: array})"""
+    shm_name, layout = spec
+    shm = shared_memory.SharedMemory(name=shm_name)
+    arrays = {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+              for name, dtype, shape, start in layout}
+    return shm, arrays
+
+
+def _detect_gaps(method, r, g, b, indices, thresholds, data_mask=None):
+    """Run one detector and build its gap mask; returns a dict, with 'error' if the detector failed"""
+    try:
+        bare_soil_mask, labels, centroids, stats = run_detector(method, r, g, b, indices)
+    except Exception as e:
+        print(f"❌ {method.upper()} failed: {e}")
+        return {'error': str(e)}
+
+    soil_percentage = np.sum(bare_soil_mask) / bare_soil_mask.size * 100
+    print(f"✅ {method.upper()}: {soil_percentage:.1f}% bare soil detected")
+
+    return {
+        'gap_mask': create_gap_mask(indices, bare_soil_mask, 'combined_improved', thresholds, data_mask),
+        'bare_soil_mask': bare_soil_mask,
+        'labels': labels,
+        'centroids': centroids,
+        'soil_percentage': soil_percentage,
+        'detector': stats
     }
 
-    for row_info in sorted(row_summary, key=lambda x: x['row_id']):
-        row_data = {
-            'row_id': row_info['row_id'],
-            'gap_count': row_info['gap_count'],
-            'gaps': [{
-                'gap_id': g['gap_id'],
-                'coordinates': {'latitude': g['lat'], 'longitude': g['lon']},
-                'dimensions': {
-                    'area_pixels': g['pixels'],
-                    'area_sqm': g['area_sqm'],
-                    'width_m': g['width_m'],
-                    'height_m': g['height_m']
-                }
-            } for g in row_info['gap_coordinates']]
+
+def _init_detection_worker(config, spec, thresholds, threads):
+    """Process pool initializer: apply the parent's Config, attach the shared bands and indices"""
+    for name, value in config.items():
+        setattr(Config, name, value)
+    threadpool_limits(threads)
+    cv2.setNumThreads(threads)
+
+    shm, arrays = _attach_arrays(spec)
+    r, g, b = arrays.pop('r'), arrays.pop('g'), arrays.pop('b')
+    data_mask = arrays.pop('data_mask', None)
+    _DETECTION_WORKER.update(shm=shm, r=r, g=g, b=b, thresholds=thresholds, data_mask=data_mask,
+                             indices=VegetationIndices.from_arrays(r, g, b, arrays))
+
+
+def _detect_gaps_worker(method):
+    state = _DETECTION_WORKER
+    return _detect_gaps(method, state['r'], state['g'], state['b'], state['indices'], state['thresholds'],
+                        state['data_mask'])
+
+
+def run_detections(methods, r, g, b, indices, thresholds, workers=None, data_mask=None):
+    """
+    Run several detectors on the same bands and indices, concurrently
+
+    With more than one worker (default Config.N_WORKERS, serial when unset) the
+    bands, the data_mask and only the indices the requested detectors and the
+    gap mask read (DETECTORS[...]['indices'], GAP_MASK_PERCENTILES) are placed in
+    shared memory once, and the detectors run in a process pool, the cores split
+    between them. Any other index is computed lazily in the worker that asks for
+    it. Returns {method: result} as produced by _detect_gaps.
+    """
+    workers = min(workers or Config.N_WORKERS or 1, len(methods))
+    if workers <= 1:
+        return {method: _detect_gaps(method, r, g, b, indices, thresholds, data_mask) for method in methods}
+
+    names = set(GAP_MASK_PERCENTILES)
+    for method in methods:
+        names.update(DETECTORS[method]['indices'] if method in DETECTORS else ())
+    names = {VegetationIndices.ALIASES.get(name, name) for name in names}
+    shared = {'r': r, 'g': g, 'b': b, **{name: indices[name] for name in sorted(names)}}
+    if data_mask is not None:
+        shared['data_mask'] = data_mask
+    shm, spec = _share_arrays(shared)
+    config = Config.snapshot()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_detection_worker,
+                                 initargs=(config, spec, thresholds, threads)) as pool:
+            return dict(zip(methods, pool.map(_detect_gaps_worker, methods)))
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def compare_orthophoto_methods(methods, windowed=False, workers=None):
+    """
+    Run several bare soil detectors on one orthophoto, sharing the common stages
+
+    The orthophoto, rows, vegetation indices, gap thresholds and row raster are
+    loaded / computed once and the detectors that are not in the stage cache
+    run concurrently (run_detections).
+    Every method still gets its own reports; a comparison summary goes to
+    orthophoto_gaps_comparison.json and, with Config.DEBUG_FIGURE, a single debug
+    figure to orthophoto_debug_comparison.png. Windowed runs analyze the methods one
+    after the other and share only the summary.
+
+    Returns {'methods': {method: result}, 'comparison': summary}.
+    """
+    import rasterio
+    import geopandas as gpd
+
+    allowed = WINDOWED_METHODS if windowed else tuple(DETECTORS)
+    for method in [m for m in methods if m not in allowed]:
+        print(f"⚠️ Skipping '{method}': not available{' in windowed mode' if windowed else ''}")
+    methods = [m for m in methods if m in allowed]
+    if not methods:
+        print("❌ No methods to compare")
+        return None
+
+    if windowed:
+        results = {method: analyze_orthophoto(method, windowed=True, workers=workers) for method in methods}
+        if any(result is None for result in results.values()):
+            return None
+        return {'methods': results, 'comparison': save_method_comparison(results)}
+
+    print("\n" + "=" * 80)
+    print(f"ORTHOPHOTO GAP ANALYSIS - COMPARING {', '.join(m.upper() for m in methods)}")
+    print("=" * 80)
+
+    if not os.path.exists(Config.ORTHO_PATH):
+        print(f"❌ Orthophoto not found: {Config.ORTHO_PATH}")
+        return None
+
+    if not os.path.exists(Config.ROWS_PATH):
+        print(f"❌ Rows file not found: {Config.ROWS_PATH}")
+        return None
+
+    # Shared stages: load, indices, gap thresholds, row raster
+    print("\n📂 Loading orthophoto and rows...")
+    src = rasterio.open(Config.ORTHO_PATH)
+    h, w = src.height, src.width
+    r, g, b = src.read(1), src.read(2), src.read(3)
+    data_mask = read_data_mask(src)
+    blank_nodata(r, g, b, data_mask)
+
+    rows = gpd.read_file(Config.ROWS_PATH)
+    if 'row_id' not in rows.columns:
+        rows['row_id'] = range(1, len(rows) + 1)
+
+    print(f"✅ Loaded orthophoto: {w}x{h} pixels")
+    print(f"✅ Loaded {len(rows)} rows")
+    report_data_mask(data_mask, h * w)
+
+    print("\n🧮 Calculating vegetation indices...")
+    indices = calculate_vegetation_indices(r, g, b)
+
+    ensure_output_dir()
+    cache = open_stage_cache()
+    row_raster = cached_row_raster(cache, src, rows) if cache is not None else rasterize_rows(src, rows)
+
+    # Reuse cached detections and gap masks
+    detections, cache_keys = {}, {}
+    if cache is not None:
+        for method in methods:
+            cache_keys[method] = detection_cache_keys(cache, method)
+            detection, gap_stage = (cache.load(key) for key in cache_keys[method])
+            if detection is not None and gap_stage is not None:
+                print(f"♻️ Using cached {method.upper()} detection")
+                detection['detector']['cached'] = True
+                detections[method] = {**detection, 'gap_mask': gap_stage['gap_mask']}
+
+    # Remaining detectors, concurrently
+    missing = [method for method in methods if method not in detections]
+    if missing:
+        thresholds = gap_mask_thresholds(indices, data_mask=data_mask)
+        print(f"\n🎯 Running {len(missing)} detectors...")
+        for method, detection in run_detections(missing, r, g, b, indices, thresholds, workers, data_mask).items():
+            detections[method] = detection
+            if cache is not None and 'error' not in detection:
+                detect_key, gap_mask_key = cache_keys[method]
+                cache.store(detect_key, {'bare_soil_mask': detection['bare_soil_mask'], 'labels': detection['labels'],
+                                         'centroids': np.asarray(detection['centroids']),
+                                         'soil_percentage': detection['soil_percentage'],
+                                         'detector': detection['detector']})
+                cache.store(gap_mask_key, {'gap_mask': detection['gap_mask'], 'thresholds': thresholds})
+    detections = {method: detections[method] for method in methods}
+
+    results = {}
+    for method, detection in detections.items():
+        if 'error' in detection:
+            continue
+
+        gap_table, gaps, row_summary = process_row_gaps(src, rows, detection['gap_mask'], method,
+                                                        row_raster=row_raster)
+        if gaps:
+            print(f"\n💾 Saving {method.upper()} results...")
+            save_orthophoto_reports(gap_table, rows, src.crs, method)
+            print(f"   ✅ {method.upper()}: {len(gaps)} gaps saved")
+
+        results[method] = {
+            'method': method,
+            'gaps': gaps,
+            'row_summary': row_summary,
+            'total_rows': len(rows),
+            'detected_gaps': len(gaps),
+            'total_gap_area_m2': sum(g['area_sqm'] for g in gaps) if gaps else 0,
+            'rows_analyzed': len(rows),
+            'rows_with_gaps': len(row_summary),
+            'soil_percentage': detection['soil_percentage'],
+            'detector': detection['detector']
         }
-        json_data['rows'].append(row_data)
 
-    with open(json_file, 'w', encoding='utf-8') as f:
-        json.dump(json_data, f, indent=2, ensure_ascii=False)
+    succeeded = {method: detection for method, detection in detections.items() if 'error' not in detection}
+    comparison = save_method_comparison(results, {m: d['gap_mask'] for m, d in succeeded.items()})
+    comparison['failed'] = {m: d['error'] for m, d in detections.items() if 'error' in d}
+    if succeeded and Config.DEBUG_FIGURE:
+        figure = decimate_for_figure({'r': r, 'g': g, 'b': b})
+        figure_detections = {method: dict(decimate_for_figure({'labels': d['labels'], 'gap_mask': d['gap_mask']}),
+                                          soil_percentage=d['soil_percentage'])
+                             for method, d in succeeded.items()}
+        comparison['debug_figure'] = submit_debug_figure(
+            save_comparison_visualization, os.path.join(Config.OUTPUT_DIR, 'orthophoto_debug_comparison.png'),
+            figure['r'], figure['g'], figure['b'], figure_detections)
 
-    print(f"   ✅ Saved: {out_geojson}")
-    print(f"   ✅ Saved: {out_points}")
-    print(f"   ✅ Saved: {summary_file}")
-    print(f"   ✅ Saved: {csv_file}")
-    print(f"   ✅ Saved: {json_file}")
+    src.close()
+
+    return {'methods': results, 'comparison': comparison}
+
+
+def save_method_comparison(results, gap_masks=None):
+    """
+    Print and save a side-by-side summary of several methods' results
+
+    gap_masks ({method: mask}) adds the pairwise Jaccard agreement of the gap
+    masks. Returns the summary dict written to orthophoto_gaps_comparison.json.
+    """
+    summary = {
+        'methods': {method: {
+            'detected_gaps': result['detected_gaps'],
+            'total_gap_area_m2': round(result['total_gap_area_m2'], 2),
+            'rows_with_gaps': result['rows_with_gaps'],
+            'soil_percentage': round(float(result['soil_percentage']), 2) if 'soil_percentage' in result else None,
+            'seconds': result.get('detector', {}).get('seconds'),
+            'peak_memory_mb': result.get('detector', {}).get('peak_memory_mb')
+        } for method, result in results.items()},
+        'gaps_per_row': {},
+        'gap_mask_agreement': {}
+    }
+
+    for method, result in results.items():
+        for row in result['row_summary']:
+            summary['gaps_per_row'].setdefault(str(row['row_id']), {})[method] = row['gap_count']
+
+    if gap_masks:
+        names = list(gap_masks)
+        for i, first in enumerate(names):
+            for second in names[i + 1:]:
+                union = np.count_nonzero(gap_masks[first] | gap_masks[second])
+                both = np.count_nonzero(gap_masks[first] & gap_masks[second])
+                summary['gap_mask_agreement'][f'{first}/{second}'] = round(both / union, 4) if union else 1.0
+
+    print("\n" + "=" * 80)
+    print("METHOD COMPARISON")
+    print("=" * 80)
+    print(f"{'Method':<12}{'Gaps':>8}{'Area m²':>12}{'Rows':>8}{'Soil %':>9}{'Time s':>9}")
+    for method, stats in summary['methods'].items():
+        soil = f"{stats['soil_percentage']:.1f}" if stats['soil_percentage'] is not None else '-'
+        seconds = f"{stats['seconds']:.1f}" if stats['seconds'] is not None else '-'
+        print(f"{method.upper():<12}{stats['detected_gaps']:>8}{stats['total_gap_area_m2']:>12.1f}"
+              f"{stats['rows_with_gaps']:>8}{soil:>9}{seconds:>9}")
+    for pair, jaccard in summary['gap_mask_agreement'].items():
+        print(f"   🔗 {pair.upper()}: gap mask agreement {jaccard:.1%}")
+
+    ensure_output_dir()
+    comparison_file = os.path.join(Config.OUTPUT_DIR, 'orthophoto_gaps_comparison.json')
+    with open(comparison_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f"✅ Saved: {comparison_file}")
+
+    return summary
+
+
+def save_comparison_visualization(r, g, b, detections, output_file=None):
+    """Save one debug figure with the clustering result and gap mask of every method"""
+    from matplotlib.figure import Figure
+
+    # Figure API instead of pyplot: pyplot state is global and not safe across concurrent analyses
+    fig = Figure(figsize=(6 * (len(detections) + 1), 11))
+    axes = fig.subplots(2, len(detections) + 1, squeeze=False)
+
+    axes[0, 0].imshow(np.stack([r, g, b], axis=2))
+    axes[0, 0].set_title('Original RGB', fontsize=12, fontweight='bold')
+    axes[1, 0].axis('off')
+    axes[0, 0].axis('off')
+
+    for col, (method, detection) in enumerate(detections.items(), start=1):
+        axes[0, col].imshow(detection['labels'], cmap='tab10')
+        axes[0, col].set_title(f'{method.upper()} Clustering Result', fontsize=12, fontweight='bold')
+        axes[0, col].axis('off')
+
+        axes[1, col].imshow(detection['gap_mask'], cmap='Reds')
+        axes[1, col].set_title(f'{method.upper()} Gaps ({detection["soil_percentage"]:.1f}% soil)', fontsize=11)
+        axes[1, col].axis('off')
 
-def save_debug_visualization(r, g, b, gap_mask, labels, indices, approach, clustering_results=None, method='kmeans'):
-    """Save debug visualization with selected clustering method"""
+    fig.tight_layout()
+    debug_file = output_file or os.path.join(Config.OUTPUT_DIR, 'orthophoto_debug_comparison.png')
+    fig.savefig(debug_file, dpi=150, bbox_inches='tight')
+
+    print(f"✅ Saved: {debug_file}")
 
-    fig, axes = plt.subplots(3, 3, figsize=(20, 18))
+
+def save_orthophoto_reports(gap_table, rows, crs, method_name='kmeans'):
+    """Save detailed reports for orthophoto analysis from a measure_gaps() table (see gap_reports.py)"""
+    info = {
+        'method': method_name,
+        'total_rows': len(rows),
+        'min_area_pixels': Config.MIN_GAP_AREA_PIXELS,
+        'crs': crs
+    }
+    paths = write_gap_reports(gap_table, info, Config.OUTPUT_DIR, Config.REPORT_FORMATS, Config.REPORT_WORKERS)
+
+    for path in paths:
+        print(f"   ✅ Saved: {path}")
+
+# ================================
+# DEBUG FIGURES
+# ================================
+# Background renderers, created on first use (see submit_debug_figure)
+_FIGURE_EXECUTORS = {}
+_PENDING_FIGURES = []
+_FIGURE_LOCK = threading.Lock()
+
+
+def decimate_for_figure(rasters):
+    """
+    Strided copies of {name: raster} with about Config.DEBUG_FIGURE_PIXELS pixels each
+
+    The copies are small and do not keep the full-resolution rasters alive
+    while a figure is rendered in the background.
+    """
+    decimated = {}
+    for name, raster in rasters.items():
+        step = max(1, int(np.ceil(np.sqrt(raster.shape[0] * raster.shape[1] / Config.DEBUG_FIGURE_PIXELS))))
+        decimated[name] = np.ascontiguousarray(raster[::step, ::step])
+    return decimated
+
+
+def _report_figure_error(future):
+    if future.exception() is not None:
+        print(f"⚠️ Debug figure failed: {future.exception()}")
+
+
+def submit_debug_figure(render, output_file, *args, **kwargs):
+    """
+    Render a debug figure to output_file as set by Config.DEBUG_FIGURE
+
+    'inline' renders it right away; 'thread' and 'process' queue it on a
+    background thread / process and return at once, so the analysis result
+    is available before the figure is written (wait_for_debug_figures blocks
+    until it is; the interpreter also waits at exit). Pass decimated rasters
+    and an explicit output_file, background renderers do not see Config
+    overrides. Returns output_file.
+    """
+    mode = Config.DEBUG_FIGURE
+    if mode == 'inline':
+        render(*args, output_file=output_file, **kwargs)
+        return output_file
+    if mode not in ('thread', 'process'):
+        raise ValueError(f"Unknown Config.DEBUG_FIGURE '{mode}'. Choose from: None, 'inline', 'thread', 'process'")
+
+    with _FIGURE_LOCK:
+        if mode not in _FIGURE_EXECUTORS:
+            _FIGURE_EXECUTORS[mode] = ThreadPoolExecutor(1) if mode == 'thread' else ProcessPoolExecutor(1)
+        future = _FIGURE_EXECUTORS[mode].submit(render, *args, output_file=output_file, **kwargs)
+        future.add_done_callback(_report_figure_error)
+        _PENDING_FIGURES.append(future)
+
+    print(f"🖼️ Debug figure queued on a background {mode}: {output_file}")
+    return output_file
+
+
+def wait_for_debug_figures():
+    """Block until every queued debug figure is written; re-raises the first rendering error"""
+    with _FIGURE_LOCK:
+        pending = list(_PENDING_FIGURES)
+        _PENDING_FIGURES.clear()
+    for future in pending:
+        future.result()
+
+
+def save_debug_visualization(r, g, b, gap_mask, labels, indices, approach, clustering_results=None, method='kmeans',
+                             thresholds=None, output_file=None):
+    """Save debug visualization with selected clustering method (thresholds: see gap_mask_thresholds)"""
+    from matplotlib.figure import Figure
+
+    # Figure API instead of pyplot: pyplot state is global and not safe across concurrent analyses
+    fig = Figure(figsize=(20, 18))
+    axes = fig.subplots(3, 3)
 
     rgb_img = np.stack([r, g, b], axis=2)
 
@@ -1136,33 +2860,35 @@ def save_debug_visualization(r, g, b, gap_mask, labels, indices, approach, clust
     im1 = axes[1, 0].imshow(indices['exg'], cmap='RdYlGn')
     axes[1, 0].set_title('Excess Green (ExG)', fontsize=11)
     axes[1, 0].axis('off')
-    plt.colorbar(im1, ax=axes[1, 0], fraction=0.046)
+    fig.colorbar(im1, ax=axes[1, 0], fraction=0.046)
 
     im2 = axes[1, 1].imshow(indices['vari'], cmap='RdYlGn')
     axes[1, 1].set_title('VARI Index', fontsize=11)
     axes[1, 1].axis('off')
-    plt.colorbar(im2, ax=axes[1, 1], fraction=0.046)
+    fig.colorbar(im2, ax=axes[1, 1], fraction=0.046)
 
     im3 = axes[1, 2].imshow(indices['exgr'], cmap='RdYlGn')
     axes[1, 2].set_title('ExG - ExR (ExGR)', fontsize=11)
     axes[1, 2].axis('off')
-    plt.colorbar(im3, ax=axes[1, 2], fraction=0.046)
+    fig.colorbar(im3, ax=axes[1, 2], fraction=0.046)
 
     # Row 3: More indices + final result
     im4 = axes[2, 0].imshow(indices['ndi'], cmap='RdYlGn')
     axes[2, 0].set_title('NDI Index', fontsize=11)
     axes[2, 0].axis('off')
-    plt.colorbar(im4, ax=axes[2, 0], fraction=0.046)
+    fig.colorbar(im4, ax=axes[2, 0], fraction=0.046)
 
     im5 = axes[2, 1].imshow(indices['rgbvi'], cmap='RdYlGn')
     axes[2, 1].set_title('RGBVI Index', fontsize=11)
     axes[2, 1].axis('off')
-    plt.colorbar(im5, ax=axes[2, 1], fraction=0.046)
+    fig.colorbar(im5, ax=axes[2, 1], fraction=0.046)
 
     # Final vegetation detection
-    exg_mask = indices['exg'] < np.percentile(indices['exg'], 25)
-    vari_mask = indices['vari'] < np.percentile(indices['vari'], 25)
-    exgr_mask = indices['exgr'] < np.percentile(indices['exgr'], 20)
+    if thresholds is None:
+        thresholds = gap_mask_thresholds(indices)
+    exg_mask = indices['exg'] < thresholds['exg']
+    vari_mask = indices['vari'] < thresholds['vari']
+    exgr_mask = indices['exgr'] < thresholds['exgr']
     vegetation_mask = ~(exg_mask | vari_mask | exgr_mask)
 
     masked_rgb = rgb_img.copy()
@@ -1172,15 +2898,16 @@ def save_debug_visualization(r, g, b, gap_mask, labels, indices, approach, clust
     axes[2, 2].set_title('Final Vegetation Detection', fontsize=11, fontweight='bold')
     axes[2, 2].axis('off')
 
-    plt.tight_layout()
-    debug_file = os.path.join(Config.OUTPUT_DIR, f'orthophoto_debug_{method}.png')
-    plt.savefig(debug_file, dpi=150, bbox_inches='tight')
-    plt.close()
+    fig.tight_layout()
+    debug_file = output_file or os.path.join(Config.OUTPUT_DIR, f'orthophoto_debug_{method}.png')
+    fig.savefig(debug_file, dpi=150, bbox_inches='tight')
 
     print(f"✅ Saved: {debug_file}")
 
 def analyze_drone_images():
     """Analyze individual drone RGB/NIR image pairs"""
+    from skimage import io, measure
+
     print("\n" + "=" * 80)
     print("DRONE IMAGE NDVI ANALYSIS")
     print("=" * 80)
@@ -1284,6 +3011,8 @@ def analyze_drone_images():
 
 def save_drone_visualizations(rgb, ndvi, veg_mask, vine_mask, filename, idx):
     """Save visualizations for drone image analysis"""
+    import matplotlib.pyplot as plt
+
     fig, axes = plt.subplots(2, 2, figsize=(15, 12))
 
     # Original RGB
@@ -1383,6 +3112,9 @@ def main():
 
     ensure_output_dir()
 
+    # Command line runs use every core (library calls stay serial unless N_WORKERS is set)
+    Config.N_WORKERS = Config.N_WORKERS or os.cpu_count()
+
     # Run orthophoto analysis
     ortho_results = None
     try:
@@ -3,6 +3,11 @@
 Standalone vineyard analysis for web app
 Extracts core logic from vine.py without requiring full vine.py import
 """
+import import_profile
+
+if __name__ == '__main__':
+    import_profile.enable_if_requested()  # --import-profile / IMPORT_PROFILE=1, before the imports below
+
 import sys
 import json
 import os
@@ -10,6 +15,7 @@ from pathlib import Path
 import numpy as np
 import cv2
 from skimage import measure
+from quantiles import index_percentiles
 
 
 def calculate_vegetation_indices(r, g, b):
@@ -75,8 +81,8 @@ def analyze_drone_images_rgb_only(image_paths):
             indices = calculate_vegetation_indices(r, g, b)
 
             # Create vegetation mask using combined approach (from vine.py)
-            exg_threshold = np.percentile(indices['exg'], 75)
-            vari_threshold = np.percentile(indices['vari'], 70)
+            thresholds = index_percentiles(indices, {'exg': 75, 'vari': 70}, upper=True)
+            exg_threshold, vari_threshold = thresholds['exg'], thresholds['vari']
 
             vegetation_mask = (indices['exg'] > exg_threshold) | (indices['vari'] > vari_threshold)
 
@@ -149,9 +155,8 @@ def analyze_orthophoto_simple(orthophoto_path, rows_geojson_path=None):
         indices = calculate_vegetation_indices(r, g, b)
 
         # Create gap mask (inverse of vegetation)
-        exg_threshold = np.percentile(indices['exg'], 30)
-        vari_threshold = np.percentile(indices['vari'], 30)
-        exgr_threshold = np.percentile(indices['exgr'], 25)
+        thresholds = index_percentiles(indices, {'exg': 30, 'vari': 30, 'exgr': 25})
+        exg_threshold, vari_threshold, exgr_threshold = thresholds['exg'], thresholds['vari'], thresholds['exgr']
 
         gap_mask = (indices['exg'] < exg_threshold) | (indices['vari'] < vari_threshold) | (indices['exgr'] < exgr_threshold)
 
@@ -199,35 +204,23 @@ def analyze_orthophoto_simple(orthophoto_path, rows_geojson_path=None):
 def run_original_vine_orthophoto(orthophoto_path, rows_geojson_path):
     """
     Run the original vine.py orthophoto analysis with full GeoJSON support
-    This temporarily modifies vine.py's Config paths
+    Paths are passed per call (vine.run_orthophoto_analysis), vine.Config is not modified
     """
     try:
         # Import vine.py
-        import vine
-        from vine import Config, analyze_orthophoto
-
-        # Store original paths
-        original_ortho = Config.ORTHO_PATH
-        original_rows = Config.ROWS_PATH
+        from vine import Config, run_orthophoto_analysis
 
-        # Update paths
-        Config.ORTHO_PATH = orthophoto_path
-        if rows_geojson_path and os.path.exists(rows_geojson_path):
-            Config.ROWS_PATH = rows_geojson_path
+        rows_path = rows_geojson_path if rows_geojson_path and os.path.exists(rows_geojson_path) else Config.ROWS_PATH
 
         # Check files exist
-        if not os.path.exists(Config.ORTHO_PATH):
-            return {"error": f"Orthophoto not found: {Config.ORTHO_PATH}"}
+        if not os.path.exists(orthophoto_path):
+            return {"error": f"Orthophoto not found: {orthophoto_path}"}
 
-        if not os.path.exists(Config.ROWS_PATH):
-            return {"error": f"Rows GeoJSON not found: {Config.ROWS_PATH}. Please upload it or ensure default path exists."}
+        if not os.path.exists(rows_path):
+            return {"error": f"Rows GeoJSON not found: {rows_path}. Please upload it or ensure default path exists."}
 
         # Run analysis
-        result = analyze_orthophoto()
-
-        # Restore paths
-        Config.ORTHO_PATH = original_ortho
-        Config.ROWS_PATH = original_rows
+        result = run_orthophoto_analysis(Config(ortho_path=orthophoto_path, rows_path=rows_path))
 
         if result is None:
             return {"error": "Analysis returned no results"}
@@ -256,7 +249,7 @@ if __name__ == '__main__':
     try:
         if len(sys.argv) < 3:
             error_msg = {
-                "error": "Usage: vine_analysis.py <analysis_type> <file_path1> [file_path2 ...]",
+                "error": "Usage: vine_analysis.py [--import-profile] <analysis_type> <file_path1> [file_path2 ...]",
                 "examples": {
                     "drone": "vine_analysis.py drone image1.jpg image2.jpg",
                     "orthophoto": "vine_analysis.py orthophoto orthophoto.tif [rows.geojson]"